@@ -0,0 +1,243 @@
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import stat
+import tempfile
+import threading
+import time
+
+import yaml
+
+from osci.config import Configuration
+from osci import constants
+from osci.job import Job
+from osci.scheduler import WakeupChannel
+from osci import time_services
+
+
+def write_atomically(path, data):
+    # Readers see either the old file or the new one, never half of it
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as tmp:
+            # mkstemp makes the file private; keep the mode and owner of
+            # the file it replaces, so its readers still can
+            try:
+                current = os.stat(path)
+            except OSError:
+                os.fchmod(tmp.fileno(), 0644)
+            else:
+                os.fchmod(tmp.fileno(), stat.S_IMODE(current.st_mode))
+                try:
+                    os.fchown(tmp.fileno(), current.st_uid, current.st_gid)
+                except OSError:
+                    # Only root may give a file to another user
+                    pass
+            tmp.write(data)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def measure_demand(database, image, window, samples):
+    counts = Job.countInStates(database)
+    since = time_services.now() - datetime.timedelta(seconds=window)
+    arrivals = Job.countCreatedSince(database, since)
+    durations = Job.recentDurations(database, samples)
+    mean_duration = None
+    if durations:
+        mean_duration = sum(durations) / len(durations)
+    return {
+        'image': image,
+        'generated': time.time(),
+        'states': dict((constants.STATES[state], count)
+                       for state, count in counts.items()
+                       if state in constants.STATES),
+        'queued': counts.get(constants.QUEUED, 0),
+        'running': counts.get(constants.RUNNING, 0),
+        'window': window,
+        'arrivals_per_hour': arrivals * 3600.0 / window,
+        'mean_duration': mean_duration,
+        'duration_samples': len(durations),
+    }
+
+
+class DemandPublisher(object):
+    log = logging.getLogger('citrix.DemandPublisher')
+
+    def __init__(self, database, path, image, window, samples):
+        self.db = database
+        self.path = path
+        self.image = image
+        self.window = window
+        self.samples = samples
+
+    def publish(self):
+        demand = measure_demand(self.db, self.image, self.window,
+                                self.samples)
+        write_atomically(self.path, json.dumps(demand, sort_keys=True))
+        self.log.debug('Published demand %s', demand)
+        return demand
+
+
+class DemandThread(threading.Thread):
+    log = logging.getLogger('citrix.DemandThread')
+
+    def __init__(self, publisher, interval):
+        threading.Thread.__init__(self, name='DemandThread')
+        self.daemon = True
+        self.publisher = publisher
+        self.interval = interval
+        self.wakeup = WakeupChannel(self.name)
+
+    def run(self):
+        while True:
+            try:
+                self.publisher.publish()
+            except Exception, e:
+                self.log.exception(e)
+            self.wakeup.wait(self.interval)
+
+
+def get_publisher(database):
+    config = Configuration()
+    return DemandPublisher(
+        database, os.path.expanduser(config.DEMAND_FILE),
+        config.NODEPOOL_IMAGE, config.get_int('DEMAND_WINDOW'),
+        config.get_int('DEMAND_SAMPLES'))
+
+
+def image_entries(nodepool_config, image):
+    # Newer nodepool sets min-ready per label, older per provider image
+    labels = [label for label in nodepool_config.get('labels') or []
+              if label.get('name') == image]
+    if labels:
+        return labels
+    return [provider_image
+            for provider in nodepool_config.get('providers') or []
+            for provider_image in provider.get('images') or []
+            if provider_image.get('name') == image]
+
+
+class CapacityController(object):
+    log = logging.getLogger('citrix.CapacityController')
+
+    def __init__(self, config_path, image, minimum, maximum, lead_time,
+                 max_age):
+        self.config_path = config_path
+        self.image = image
+        self.minimum = minimum
+        self.maximum = maximum
+        self.lead_time = lead_time
+        self.max_age = max_age
+
+    def target(self, demand):
+        # Queued jobs want a node now; on top of that keep enough ready
+        # for the jobs arriving while nodepool builds replacements
+        expected = demand['arrivals_per_hour'] * self.lead_time / 3600.0
+        wanted = int(math.ceil(demand['queued'] + expected))
+        return max(self.minimum, min(self.maximum, wanted))
+
+    def apply(self, demand, dry_run=False):
+        age = time.time() - demand['generated']
+        if age > self.max_age:
+            # osci has stopped publishing; leave the pool as it is
+            self.log.warning('Demand is %ds old; not adjusting %s',
+                             age, self.image)
+            return None
+
+        target = self.target(demand)
+        with open(self.config_path) as config_file:
+            nodepool_config = yaml.safe_load(config_file)
+        entries = image_entries(nodepool_config, self.image)
+        if not entries:
+            self.log.error('%s is not in %s', self.image, self.config_path)
+            return None
+
+        # Split between providers, so their total is the target
+        shares = [target // len(entries) + (1 if i < target % len(entries)
+                                            else 0)
+                  for i in range(len(entries))]
+        if [entry.get('min-ready') for entry in entries] == shares:
+            return target
+        self.log.info('min-ready for %s: %s -> %s (queued %d, %.1f/hour)',
+                      self.image, [entry.get('min-ready') for entry in entries],
+                      shares, demand['queued'], demand['arrivals_per_hour'])
+        if dry_run:
+            return target
+        for entry, share in zip(entries, shares):
+            entry['min-ready'] = share
+        write_atomically(self.config_path,
+                         yaml.safe_dump(nodepool_config,
+                                        default_flow_style=False))
+        return target
+
+
+def read_demand(path):
+    with open(path) as demand_file:
+        return json.load(demand_file)
+
+
+def get_parser():
+    config = Configuration()
+    parser = argparse.ArgumentParser(
+        description='Set min-ready in the nodepool config from the demand '
+                    'published by osci-manage')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        default=False, help='enable verbose (debug) logging')
+    parser.add_argument('--demand', dest='demand',
+                        default=os.path.expanduser(config.DEMAND_FILE),
+                        help='Demand file written by osci-manage')
+    parser.add_argument('--config', dest='config',
+                        default=config.NODEPOOL_CONFIG,
+                        help='nodepool.yaml to adjust')
+    parser.add_argument('--image', dest='image',
+                        default=config.NODEPOOL_IMAGE,
+                        help='Image or label whose min-ready is set')
+    parser.add_argument('--min', dest='minimum', type=int,
+                        default=config.get_int('CAPACITY_MIN'),
+                        help='Fewest nodes kept ready')
+    parser.add_argument('--max', dest='maximum', type=int,
+                        default=config.get_int('CAPACITY_MAX'),
+                        help='Most nodes kept ready')
+    parser.add_argument('--lead-time', dest='lead_time', type=int,
+                        default=config.get_int('CAPACITY_LEAD_TIME'),
+                        help='Seconds nodepool takes to make a node ready')
+    parser.add_argument('--interval', dest='interval', type=int,
+                        default=config.get_int('CAPACITY_INTERVAL'),
+                        help='Seconds between adjustments; 0 adjusts once')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        default=False,
+                        help='Log the change without writing the config')
+    return parser
+
+
+def main():
+    parser = get_parser()
+    options = parser.parse_args()
+
+    level = logging.DEBUG if options.verbose else logging.INFO
+    logging.basicConfig(
+        format=u'%(asctime)s %(levelname)s %(name)s %(message)s',
+        level=level)
+
+    controller = CapacityController(
+        options.config, options.image, options.minimum, options.maximum,
+        options.lead_time, Configuration().get_int('CAPACITY_MAX_AGE'))
+    while True:
+        try:
+            controller.apply(read_demand(options.demand), options.dry_run)
+        except Exception, e:
+            if not options.interval:
+                raise
+            controller.log.exception(e)
+        if not options.interval:
+            return
+        time.sleep(options.interval)
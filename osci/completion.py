@@ -0,0 +1,56 @@
+import BaseHTTPServer
+import SocketServer
+import logging
+import re
+import threading
+
+
+class CompletionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    PATH_RE = re.compile(r'^/done/(\d+)/([0-9a-f]+)$')
+
+    def do_POST(self):
+        match = self.PATH_RE.match(self.path)
+        accepted = False
+        if match:
+            accepted = self.server.listener.complete(int(match.group(1)),
+                                                     match.group(2))
+        self.send_response(200 if accepted else 404)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.listener.log.debug(format, *args)
+
+
+class CompletionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class CompletionListener(threading.Thread):
+    log = logging.getLogger('citrix.CompletionListener')
+
+    def __init__(self, jobQueue, port, host=''):
+        threading.Thread.__init__(self, name='CompletionListener')
+        self.daemon = True
+        self.jobQueue = jobQueue
+        self.server = CompletionServer((host, port), CompletionHandler)
+        self.server.listener = self
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def complete(self, job_id, token):
+        try:
+            return self.jobQueue.markCompleted(job_id, token)
+        except Exception, e:
+            self.log.exception(e)
+            return False
+
+    def run(self):
+        self.log.info('Listening for completions on port %s', self.port)
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -22,20 +22,85 @@ class Configuration(object):
         'GERRIT_USERNAME': 'citrix_xenserver_ci',
         'GERRIT_PORT': '29418',
         'MAX_RUNNING_TIME': str(3*3600+15*60), # 3 hours and 15 minutes
+        'BATCHED_BOOTSTRAP': 'True',
+        'BOOTSTRAP_READY_TIMEOUT': '30',
+        'ARCHIVE_AFTER_DAYS': '0',
+        'ARCHIVE_BATCH': '500',
+        'ARCHIVE_INTERVAL': '3600',
+        'COLLECT_BACKLOG': '4',
+        'COLLECT_DOWNLOAD_WORKERS': '4',
+        'COLLECT_ANALYSE_WORKERS': '2',
+        'COLLECT_UPLOAD_WORKERS': '4',
+        'COLLECT_UPDATE_WORKERS': '1',
+        'COLLECT_STREAMING': 'False',
+        'COMPRESS_LOGS': 'True',
+        'COMPRESS_LEVEL': '6',
+        'COMPRESS_THRESHOLD': '65536',
+        'COMMAND_TIMEOUT': '3600',
+        'COMMAND_OUTPUT_LIMIT': str(1024*1024),
+        'COMPLETION_HOST': '',
+        'COMPLETION_PORT': '0',
+        'COMPLETION_URL': '',
+        'COMPLETION_SECRET': '',
+        'COMPLETION_FALLBACK_POLL': '900',
+        'CAPACITY_INTERVAL': '60',
+        'CAPACITY_LEAD_TIME': '900',
+        'CAPACITY_MAX': '10',
+        'CAPACITY_MAX_AGE': '600',
+        'CAPACITY_MIN': '1',
         'DATABASE_URL': 'mysql://root:@127.0.0.1/openstack_ci',
+        'DB_POOL_SIZE': '10',
+        'DB_MAX_OVERFLOW': '10',
+        'DB_POOL_RECYCLE': '3600',
+        'DELETE_ATTEMPTS': '3',
+        'DELETE_RETRY_DELAY': '5',
+        'DELETE_WORKERS': '4',
+        'DEMAND_FILE': '~/.osci/demand.json',
+        'DEMAND_INTERVAL': '0',
+        'DEMAND_SAMPLES': '50',
+        'DEMAND_WINDOW': '3600',
+        'DISPATCH_WORKERS': '8',
+        'LOG_ARCHIVE_COMPRESSION': 'gzip',
+        'LOG_ARCHIVE_LEVEL': '',
         'NODEPOOL_CONFIG': '/etc/nodepool/nodepool.yaml',
         'NODEPOOL_IMAGE': 'XSDSVM',
         'NODE_USERNAME': 'jenkins',
         'NODE_KEY': '/usr/workspace/scratch/openstack/infrastructure.hg/keys/nodepool',
+        'NODE_LOG_TRANSFER': 'sftp',
         'POLL': '30',
+        'PROBE_TIMEOUT': '30',
+        'PROBE_WORKERS': '16',
         'PROJECT_CONFIG': 'openstack/nova,openstack/tempest,openstack-dev/devstack',
         'RUN_TESTS': 'True',
         'RECHECK_REGEXP': '^(citrix recheck|xenserver recheck|recheck xenserver|recheck bug|recheck nobug).*',
         'REVIEW_REPO_NAME': 'review',
+        'SFTP_CHANNELS': '4',
+        'SSH_POOL': 'True',
+        'SSH_CONTROL_DIR': '~/.osci/ssh',
+        'SSH_CONTROL_PERSIST': '600',
+        'SSH_MASTER_TIMEOUT': '30',
+        'SSH_POOL_IDLE': '600',
+        'STORAGE_BACKEND': 'swift',
+        'STORAGE_HTTP_URL': '',
+        'STORAGE_LOCAL_DIR': '~/.osci/logs',
+        'STORAGE_LOCAL_URL': '',
+        'STATUS_CONTAINER': 'status',
+        'STATUS_DIR': '/tmp/ci_status',
+        'STATUS_INTERVAL': '0',
+        'STATUS_MAX_AGE': '900',
+        'STATUS_PREFIX': 'ci_status',
         'SWIFT_CONTAINER': 'CILogs',
         'SWIFT_USERNAME': 'citrix.nodepool2',
         'SWIFT_UPLOAD_ATTEMPTS': '5',
+        'SWIFT_TOKEN_REFRESH': '300',
+        'UPLOAD_RETRY_DELAY': '1',
+        'UPLOAD_WORKERS': '8',
         'SWIFT_API_KEY': ' ',
+        'VALIDATE_INTERVAL': '30',
+        'VALIDATE_MAX_AGE': '300',
+        'VALIDATE_NODES': 'False',
+        'VALIDATE_POOL': '4',
+        'VALIDATE_TIMEOUT': '30',
         'VOTE': 'True',
         'VOTE_PASSED_ONLY': 'False',
         'VOTE_NEGATIVE': 'True',
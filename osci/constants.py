@@ -4,6 +4,7 @@ COLLECTED = 3
 FINISHED = 4
 COLLECTING = 5
 OBSOLETE = 6
+UPLOADING = 7
 
 STATES = {
     QUEUED: 'Queued',
@@ -12,6 +13,7 @@ STATES = {
     FINISHED: 'Finished',
     COLLECTING: 'Collecting',
     OBSOLETE: 'Obsolete',
+    UPLOADING: 'Uploading',
     }
 
 # Statuses
@@ -1,14 +1,16 @@
 import logging
 import contextlib
-from sqlalchemy import create_engine
+import threading
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import StaticPool
 
 # Import these, so that other modules can import it from here
-from sqlalchemy import Column, Integer, String, DateTime, Text, UniqueConstraint
+from sqlalchemy import Column, Integer, String, DateTime, Text, UniqueConstraint, Index
 from sqlalchemy.exc import IntegrityError
 
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select, func
 
 Base = declarative_base()
 
@@ -16,17 +18,70 @@ Base = declarative_base()
 class DB(object):
     log = logging.getLogger('citrix.db')
 
-    def __init__(self, database_url):
+    def __init__(self, database_url, pool_size=None, max_overflow=None,
+                 pool_recycle=None):
         self.database_url = database_url
-        self.engine = create_engine(self.database_url)
+        if database_url in ('sqlite://', 'sqlite:///:memory:'):
+            # Each connection would otherwise get its own empty in-memory
+            # database, hiding the data from worker threads
+            self.engine = create_engine(
+                self.database_url, poolclass=StaticPool,
+                connect_args={'check_same_thread': False})
+        elif database_url.startswith('sqlite'):
+            self.engine = create_engine(self.database_url)
+        else:
+            pool_args = {}
+            if pool_size is not None:
+                pool_args['pool_size'] = pool_size
+            if max_overflow is not None:
+                pool_args['max_overflow'] = max_overflow
+            if pool_recycle is not None:
+                pool_args['pool_recycle'] = pool_recycle
+            self.engine = create_engine(self.database_url, **pool_args)
         self.conn = None
-        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        # Objects stay usable once their session has gone, so callers can
+        # keep the jobs they queried and update them later
+        self.Session = scoped_session(
+            sessionmaker(bind=self.engine, expire_on_commit=False))
+        self.local = threading.local()
 
     @contextlib.contextmanager
     def get_session(self):
+        depth = getattr(self.local, 'depth', 0)
         session = self.Session()
-        yield session
-        session.commit()
+        self.local.depth = depth + 1
+        try:
+            yield session
+            if depth == 0:
+                session.commit()
+        except:
+            if depth == 0:
+                session.rollback()
+            raise
+        finally:
+            self.local.depth = depth
+            if depth == 0:
+                # Drop the identity map and return the connection to the
+                # pool rather than holding both for the thread's lifetime
+                self.Session.remove()
+
+    def unit_of_work(self):
+        """Group every get_session() inside it into a single commit."""
+        return self.get_session()
 
     def create_schema(self):
         Base.metadata.create_all(self.engine)
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        # create_all skips tables that already exist, including any indexes
+        # added to them since, so add those separately
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = set(index['name']
+                           for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    self.log.info('Creating index %s on %s',
+                                  index.name, table.name)
+                    index.create(self.engine)
@@ -0,0 +1,145 @@
+import argparse
+import datetime
+import logging
+import os
+import random
+import tempfile
+import time
+
+from prettytable import PrettyTable
+
+from osci import constants
+from osci import db
+from osci.job import Job
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Time the Job queries used by osci-manage as the '
+                    'test table grows')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        default=False, help='enable verbose (debug) logging')
+    parser.add_argument('--url', dest='url', default=None,
+                        help='Database to fill.  Defaults to a temporary '
+                             'sqlite file.  Existing rows are deleted!')
+    parser.add_argument('--sizes', dest='sizes',
+                        default='10000,100000,1000000',
+                        help='Comma separated table sizes to measure at')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help='Times each query is run; the best is reported')
+    parser.add_argument('--no-indexes', dest='indexes', action='store_false',
+                        default=True,
+                        help='Drop the indexes first to measure without them')
+    return parser
+
+
+ACTIVE_JOBS = [constants.QUEUED] * 10 + [constants.RUNNING] * 10 + \
+    [constants.COLLECTING] * 2 + [constants.COLLECTED] * 2
+
+
+def make_row(i, state, updated):
+    return dict(project_name='openstack/nova',
+                change_num=str(i // 3),
+                change_ref='refs/changes/%02d/%d/%d' % (i % 100, i // 3, i % 3),
+                state=state,
+                created=updated,
+                updated=updated,
+                node_id=0,
+                result='Passed')
+
+
+def fill(database, start, count):
+    # A long running CI: the history grows but the number of jobs in
+    # flight stays the same
+    now = datetime.datetime.now()
+    rows = []
+    for i in xrange(start, start + count):
+        state = random.choice([constants.FINISHED] * 20 + [constants.OBSOLETE])
+        rows.append(make_row(i, state, now - datetime.timedelta(
+            minutes=start + count - i)))
+    with database.get_session() as session:
+        session.execute(Job.__table__.insert(), rows)
+
+
+def add_active_jobs(database):
+    now = datetime.datetime.now()
+    rows = []
+    for i, state in enumerate(ACTIVE_JOBS):
+        row = make_row(-i - 1, state, now)
+        if state != constants.QUEUED:
+            row['node_id'] = i + 1
+        rows.append(row)
+    with database.get_session() as session:
+        session.execute(Job.__table__.insert(), rows)
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def queries(database, size):
+    change_num = str(random.randint(0, size // 3))
+    return [
+        ('queued', lambda: Job.getAllWhere(database, state=constants.QUEUED)),
+        ('running', lambda: Job.getAllWhere(database, state=constants.RUNNING)),
+        ('nodes to delete', lambda: Job.getAllInStates(
+            database, [constants.UPLOADING, constants.COLLECTED,
+                       constants.FINISHED, constants.OBSOLETE],
+            Job.node_id > 0)),
+        ('retrieve change', lambda: Job.retrieve(
+            database, 'openstack/nova', change_num)),
+    ]
+
+
+def run(database, sizes, repeat):
+    table = PrettyTable(['Rows'] + [name for name, _ in queries(database, 1)])
+    table.align = 'r'
+    add_active_jobs(database)
+    filled = 0
+    for size in sizes:
+        while filled < size:
+            batch = min(10000, size - filled)
+            fill(database, filled, batch)
+            filled += batch
+        table.add_row([size] + ['%.2fms' % (best_time(func, repeat) * 1000)
+                                for _, func in queries(database, size)])
+    return table
+
+
+def main():
+    parser = get_parser()
+    options = parser.parse_args()
+
+    level = logging.DEBUG if options.verbose else logging.INFO
+    logging.basicConfig(
+        format=u'%(asctime)s %(levelname)s %(name)s %(message)s',
+        level=level)
+
+    tmpfile = None
+    url = options.url
+    if not url:
+        fd, tmpfile = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        url = 'sqlite:///%s' % tmpfile
+
+    try:
+        database = db.DB(url)
+        database.create_schema()
+        if not options.indexes:
+            for index in Job.__table__.indexes:
+                index.drop(database.engine)
+        with database.get_session() as session:
+            session.execute(Job.__table__.delete())
+
+        sizes = [int(size) for size in options.sizes.split(',')]
+        print run(database, sizes, options.repeat)
+    finally:
+        if tmpfile:
+            os.remove(tmpfile)
@@ -1,5 +1,12 @@
-import subprocess
+import collections
+import errno
 import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
 
 
 log = logging.getLogger(__name__)
@@ -30,9 +37,16 @@ class FakeExecutor(object):
 
 
 class RealExecutor(object):
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
     def run(self, args):
         log.info('Executing %s', args)
-        return subprocess.call(args)
+        result = run_command(args, timeout=self.timeout,
+                             stdout=sys.stdout, stderr=sys.stderr)
+        if result.timed_out:
+            log.error('%s killed after %ss', args, self.timeout)
+        return result.returncode
 
     def pipe_run(self, args1, args2):
         log.info('Pipe the output of %s to %s', args1, args2)
@@ -46,8 +60,212 @@ class RealExecutor(object):
         log.info('Consumer returned %s', proc2.returncode)
 
 
+# Output kept from a command whose output is not sent to a file
+DEFAULT_OUTPUT_LIMIT = 1024 * 1024
+
+
+class OutputBuffer(object):
+    # Keeps only the last limit bytes written, so a chatty command cannot
+    # use more memory than that
+    def __init__(self, limit=DEFAULT_OUTPUT_LIMIT):
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.limit:
+            excess = self.size - self.limit
+            head = self.chunks[0]
+            if len(head) <= excess:
+                self.chunks.popleft()
+                self.size -= len(head)
+                self.dropped += len(head)
+            else:
+                self.chunks[0] = head[excess:]
+                self.size -= excess
+                self.dropped += excess
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class CommandResult(object):
+    def __init__(self, args, returncode, stdout, stderr, timed_out, elapsed):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<CommandResult %s returned %s%s in %.1fs>' % (
+            self.args, self.returncode,
+            ' (timed out)' if self.timed_out else '', self.elapsed)
+
+
+class Command(object):
+    # stdout and stderr are files to stream the output to; without one the
+    # output is kept in an OutputBuffer
+    def __init__(self, args, stdin_data=None, timeout=None, stdout=None,
+                 stderr=None, limit=DEFAULT_OUTPUT_LIMIT):
+        self.args = args
+        self.stdin_data = stdin_data
+        self.timeout = timeout
+        self.stdout = stdout if stdout is not None else OutputBuffer(limit)
+        self.stderr = stderr if stderr is not None else OutputBuffer(limit)
+        self.process = None
+        self.deadline = None
+        self.started = None
+        self.timed_out = False
+        self.sinks = {}
+
+    def start(self):
+        self.started = time.time()
+        if self.timeout:
+            self.deadline = self.started + self.timeout
+        # Its own process group, so a timeout also kills whatever the
+        # command started
+        self.process = subprocess.Popen(
+            self.args, close_fds=True, preexec_fn=os.setpgrp,
+            stdin=subprocess.PIPE if self.stdin_data is not None else None,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.sinks[self.process.stdout.fileno()] = (
+            self.process.stdout, self.stdout)
+        self.sinks[self.process.stderr.fileno()] = (
+            self.process.stderr, self.stderr)
+        if self.stdin_data is not None:
+            self.sinks[self.process.stdin.fileno()] = (
+                self.process.stdin, None)
+
+    def fds(self):
+        return self.sinks.keys()
+
+    def wants_input(self, fd):
+        return self.sinks[fd][1] is None
+
+    def close(self, fd):
+        pipe, _ = self.sinks.pop(fd)
+        pipe.close()
+
+    def read(self, fd):
+        data = os.read(fd, 65536)
+        if not data:
+            self.close(fd)
+        else:
+            self.sinks[fd][1].write(data)
+
+    def write(self, fd):
+        # POLLOUT promises room for PIPE_BUF bytes without blocking
+        try:
+            written = os.write(fd, self.stdin_data[:select.PIPE_BUF])
+        except OSError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            # The command stopped reading; the rest is not wanted
+            written = len(self.stdin_data)
+        self.stdin_data = self.stdin_data[written:]
+        if not self.stdin_data:
+            self.close(fd)
+
+    def kill(self):
+        self.timed_out = True
+        self.deadline = None
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # Already exited
+            pass
+        # Anything that left the group may still hold the pipes open
+        for fd in self.fds():
+            self.close(fd)
+
+    def finished(self):
+        return not self.sinks and self.process.poll() is not None
+
+    def result(self):
+        def value(sink):
+            return sink.getvalue() if isinstance(sink, OutputBuffer) else None
+        return CommandResult(self.args, self.process.returncode,
+                             value(self.stdout), value(self.stderr),
+                             self.timed_out, time.time() - self.started)
+
+
+def run_many(commands):
+    # Drives every command from this thread with a single poll loop; no
+    # thread is needed per command or per pipe
+    for command in commands:
+        command.start()
+    running = list(commands)
+    poller = select.poll()
+    owners = {}
+    while running:
+        for command in running:
+            for fd in command.fds():
+                if fd not in owners:
+                    owners[fd] = command
+                    poller.register(fd, select.POLLOUT
+                                    if command.wants_input(fd)
+                                    else select.POLLIN)
+
+        now = time.time()
+        for command in running:
+            if command.deadline is not None and now >= command.deadline:
+                log.warning('Killing %s after %ss', command.args,
+                            command.timeout)
+                command.kill()
+        for fd in [fd for fd, command in owners.items()
+                   if fd not in command.sinks]:
+            poller.unregister(fd)
+            del owners[fd]
+
+        deadlines = [command.deadline for command in running
+                     if command.deadline is not None]
+        wait = None
+        if deadlines:
+            wait = max(0, min(deadlines) - now)
+        if not owners:
+            # Only exits left to wait for
+            wait = 0.05 if wait is None else min(wait, 0.05)
+
+        if owners:
+            try:
+                events = poller.poll(None if wait is None else wait * 1000)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                command = owners[fd]
+                if command.wants_input(fd):
+                    if event & select.POLLOUT:
+                        command.write(fd)
+                    else:
+                        command.close(fd)
+                else:
+                    command.read(fd)
+                if fd not in command.sinks:
+                    poller.unregister(fd)
+                    del owners[fd]
+        else:
+            time.sleep(wait)
+
+        running = [command for command in running
+                   if not command.finished()]
+    return [command.result() for command in commands]
+
+
+def run_command(args, stdin_data=None, timeout=None, stdout=None,
+                stderr=None, limit=DEFAULT_OUTPUT_LIMIT):
+    return run_many([Command(args, stdin_data, timeout, stdout, stderr,
+                             limit)])[0]
+
+
 def escaped(args):
-    return [arg.replace('*', '\\*') for arg in args]
+    return [arg.replace('*', '\\*').replace('|', '\\|') for arg in args]
 
 
 def fake_pipe(args1, args2):
@@ -8,4 +8,32 @@ def check_out_testrunner():
 def execute_test_runner():
     return (
         '/home/jenkins/xenapi-os-testing/run_tests.sh'.split()
-    )
\ No newline at end of file
+    )
+
+def report_completion(url):
+    return (
+        'curl -s -m 30 -X POST {0} || true'.format(url).split()
+    )
+
+
+BOOTSTRAP_READY = 'OSCI-BOOTSTRAP-READY'
+
+def bootstrap_test_runner(env_lines, ready_timeout):
+    # Written to the node in one go and run by a single "bash -s": store the
+    # environment, start it detached and wait for it to report that it runs
+    return '\n'.join(
+        ["cat > /home/jenkins/run_tests_env <<'OSCI_ENV_EOF'"]
+        + env_lines
+        + ['OSCI_ENV_EOF',
+           'rm -f /home/jenkins/run_tests_env.started',
+           "nohup bash -c 'echo $$ > /home/jenkins/run_tests_env.started;"
+           " exec bash /home/jenkins/run_tests_env'"
+           ' < /dev/null > run_tests.log 2>&1 &',
+           'for i in $(seq %d); do' % (ready_timeout * 5),
+           '    [ -s /home/jenkins/run_tests_env.started ] && break',
+           '    sleep 0.2',
+           'done',
+           '[ -s /home/jenkins/run_tests_env.started ] &&'
+           ' echo %s $(cat /home/jenkins/run_tests_env.started)' % BOOTSTRAP_READY,
+           '']
+    )
@@ -1,4 +1,8 @@
 import datetime
+import hashlib
+import heapq
+import hmac
+import itertools
 import logging
 import time
 
@@ -11,11 +15,12 @@ from osci import utils
 from osci import environment
 from osci import db
 from osci import time_services
+from osci import ssh_pool
+from osci import storage
 
 
-class Job(db.Base):
-    __tablename__ = 'test'
-
+class JobRecord(object):
+    # Columns shared by the live test table and its archive
     id = db.Column(db.Integer, primary_key=True)
     project_name = db.Column('project_name', db.String(50))
     change_num = db.Column('change_num', db.String(10))
@@ -33,6 +38,35 @@ class Job(db.Base):
     test_stopped = db.Column('test_stopped', db.DateTime())
     failed = db.Column('failed', db.Text())
 
+    def __repr__(self):
+        return "%(id)s (%(project_name)s/%(change_num)s) %(state)s" %self
+
+    def __getitem__(self, item):
+        return getattr(self, item)
+
+
+class ArchivedJob(JobRecord, db.Base):
+    __tablename__ = 'test_archive'
+    # Rows keep the id they had in test, but that is no key here: MySQL
+    # may hand out the ids of archived jobs again after a restart
+    archive_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column('id', db.Integer(), nullable=False)
+    __table_args__ = (
+        db.Index('ix_test_archive_id', 'id'),
+        db.Index('ix_test_archive_updated', 'updated'),
+        db.Index('ix_test_archive_change_ref', 'change_ref'),
+    )
+
+
+class Job(JobRecord, db.Base):
+    __tablename__ = 'test'
+    __table_args__ = (
+        db.Index('ix_test_state_updated', 'state', 'updated'),
+        db.Index('ix_test_project_change_state',
+                 'project_name', 'change_num', 'state'),
+        db.Index('ix_test_change_ref', 'change_ref'),
+        db.Index('ix_test_state_node', 'state', 'node_id'),
+    )
 
     log = logging.getLogger('citrix.job')
 
@@ -64,6 +98,17 @@ class Job(db.Base):
                     .order_by(cls.updated).all()
             )
 
+    @classmethod
+    def getAllInStates(cls, db, states, *criteria):
+        with db.get_session() as session:
+            return (
+                session
+                    .query(cls)
+                    .filter(cls.state.in_(states))
+                    .filter(*criteria)
+                    .order_by(cls.updated).all()
+            )
+
     @classmethod
     def retrieve(cls, database, project_name, change_num):
         with database.get_session() as session:
@@ -77,6 +122,144 @@ class Job(db.Base):
             )
             return results
 
+    @classmethod
+    def getHistoryWhere(cls, db, **kwargs):
+        # Jobs are moved to the archive once finished, so history spans
+        # both tables
+        with db.get_session() as session:
+            jobs = session.query(cls).filter_by(**kwargs).all()
+            jobs.extend(session.query(ArchivedJob).filter_by(**kwargs).all())
+        return sorted(jobs, key=lambda job: job.updated)
+
+    @classmethod
+    def _historyQueries(cls, session, since=None, states=None, failed=False):
+        queries = []
+        for model in (cls, ArchivedJob):
+            query = session.query(model)
+            if since is not None:
+                query = query.filter(model.updated >= since)
+            if states is not None:
+                query = query.filter(model.state.in_(states))
+            if failed:
+                query = query.filter(db.or_(model.result == 'Failed',
+                                            model.result.like('Aborted%')))
+            queries.append((model, query))
+        return queries
+
+    @staticmethod
+    def _pages(model, query, batch_size):
+        # Each page is fetched in full before the next query is run.  A
+        # streaming cursor per table would not do: MySQLdb cannot have two
+        # of them open on one connection
+        key = model.__mapper__.primary_key[0]
+        last = None
+        while True:
+            page = query
+            if last is not None:
+                page = page.filter(db.or_(
+                    model.updated > last.updated,
+                    db.and_(model.updated == last.updated,
+                            key > getattr(last, key.key))))
+            jobs = page.order_by(model.updated, key).limit(batch_size).all()
+            for job in jobs:
+                yield job
+            if len(jobs) < batch_size:
+                return
+            last = jobs[-1]
+
+    @classmethod
+    def iterHistory(cls, database, since=None, states=None, failed=False,
+                    batch_size=500):
+        with database.get_session() as session:
+            streams = []
+            for order, (model, query) in enumerate(
+                    cls._historyQueries(session, since, states, failed)):
+                streams.append(((job.updated, order, job.id, job)
+                                for job in cls._pages(model, query,
+                                                      batch_size)))
+            # Both streams are sorted, so merging keeps the output in
+            # update order without loading either table
+            for _, _, _, job in heapq.merge(*streams):
+                yield job
+
+    @classmethod
+    def historySignature(cls, database, since=None, states=None,
+                         failed=False):
+        # Any job entering, leaving or changing within the selection
+        # changes either the count or the latest update time
+        signature = []
+        with database.get_session() as session:
+            for model, query in cls._historyQueries(session, since, states,
+                                                    failed):
+                count, latest = query.with_entities(
+                    db.func.count(model.id), db.func.max(model.updated)).one()
+                signature.append([count, latest and str(latest)])
+        return signature
+
+    @classmethod
+    def countHistory(cls, database, name, since=None):
+        counts = {}
+        with database.get_session() as session:
+            for model in (cls, ArchivedJob):
+                column = getattr(model, name)
+                query = session.query(column, db.func.count(model.id))
+                if since is not None:
+                    query = query.filter(model.updated >= since)
+                for value, count in query.group_by(column):
+                    counts[value] = counts.get(value, 0) + count
+        return counts
+
+    @classmethod
+    def countInStates(cls, database):
+        with database.get_session() as session:
+            return dict(session.query(cls.state, db.func.count(cls.id))
+                        .group_by(cls.state).all())
+
+    @classmethod
+    def countCreatedSince(cls, database, since):
+        with database.get_session() as session:
+            return (session.query(db.func.count(cls.id))
+                    .filter(cls.created >= since).scalar())
+
+    @classmethod
+    def recentDurations(cls, database, limit):
+        # Seconds between start and stop of the latest completed test runs
+        with database.get_session() as session:
+            rows = (session.query(cls.test_started, cls.test_stopped)
+                    .filter(cls.test_started != None)
+                    .filter(cls.test_stopped != None)
+                    .order_by(cls.test_stopped.desc())
+                    .limit(limit).all())
+        return [(stopped - started).total_seconds()
+                for started, stopped in rows if stopped >= started]
+
+    @classmethod
+    def archiveFinished(cls, database, before, batch_size):
+        columns = [column.name for column in cls.__table__.columns]
+        archived = 0
+        while True:
+            # Small batches keep each transaction short so the live
+            # table is not locked for long
+            with database.get_session() as session:
+                ids = [row.id for row in
+                       session.query(cls.id)
+                           .filter(cls.state.in_([constants.FINISHED,
+                                                  constants.OBSOLETE]))
+                           .filter(db.or_(cls.node_id == None,
+                                          cls.node_id == 0))
+                           .filter(cls.updated < before)
+                           .limit(batch_size)]
+                if not ids:
+                    return archived
+                session.execute(
+                    ArchivedJob.__table__.insert().from_select(
+                        columns,
+                        db.select([cls.__table__.c[name] for name in columns])
+                            .where(cls.id.in_(ids))))
+                session.query(cls).filter(cls.id.in_(ids)).delete(
+                    synchronize_session=False)
+            archived += len(ids)
+
     def update(self, db, **kwargs):
         if self.state == constants.RUNNING and kwargs.get('state', constants.RUNNING) != constants.RUNNING:
             kwargs['test_stopped'] = time_services.now()
@@ -90,9 +273,10 @@ class Job(db.Base):
         self.update_database_record(db, **kwargs)
 
     def update_database_record(self, db, **kwargs):
+        for name, value in kwargs.iteritems():
+            setattr(self, name, value)
         with db.get_session() as session:
-            for name, value in kwargs.iteritems():
-                setattr(self, name, value)
+            session.add(self)
 
     def delete(self, db):
         with db.get_session() as session:
@@ -100,91 +284,225 @@ class Job(db.Base):
                 project_name=self.project_name, change_num=self.change_num).all()
             session.delete(obj)
 
-    def runJob(self, db, nodepool):
+    def runJob(self, db, nodepool, node=None):
         if self.node_id:
             nodepool.deleteNode(self.node_id)
             self.update(db, node_id=0)
 
-        node_id, node_ip = nodepool.getNode()
+        if node is None:
+            node = nodepool.getNode()
+        node_id, node_ip = node
 
         if not node_id:
             return
         self.log.info("Running job for %s on %s/%s"%(self, node_id, node_ip))
 
-        if not utils.testSSH(node_ip, Configuration().NODE_USERNAME, Configuration().NODE_KEY):
+        # A node checked by the validator moments ago needs no second check
+        validated = (Configuration().get_bool('VALIDATE_NODES') and
+                     nodepool.isValidated(node_id))
+        if not validated and not utils.testSSH(node_ip, Configuration().NODE_USERNAME, Configuration().NODE_KEY):
             self.log.error('Failed to get SSH object for node %s/%s.  Deleting node.'%(node_id, node_ip))
             nodepool.deleteNode(node_id)
+            ssh_pool.get_pool().evict_host(node_ip, Configuration().NODE_USERNAME)
             self.update(db, node_id=0)
             return
 
         self.update(db, node_id=node_id, node_ip=node_ip, result='')
+        # Bootstrap and collection then share one authenticated connection
+        ssh_pool.get_pool().start_master(node_ip,
+                                         Configuration().NODE_USERNAME,
+                                         Configuration().NODE_KEY)
+
+        if Configuration().get_bool('BATCHED_BOOTSTRAP'):
+            if not self.bootstrap(node_ip):
+                self.log.error('Test runner did not start on node %s/%s.  Deleting node.'%(node_id, node_ip))
+                nodepool.deleteNode(node_id)
+                ssh_pool.get_pool().evict_host(node_ip, Configuration().NODE_USERNAME)
+                self.update(db, node_id=0)
+                return
+        else:
+            self.legacyBootstrap(node_ip)
+        self.update(db, state=constants.RUNNING)
 
-        cmd = 'echo %s >> run_tests_env' % ' '.join(instructions.check_out_testrunner())
-        utils.execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s %s'%(
-                Configuration().NODE_KEY, Configuration().NODE_USERNAME, node_ip, cmd))
-        cmd = 'echo "%s %s" >> run_tests_env' % (
-            ' '.join(environment.get_environment(self.change_ref)),
-            ' '.join(instructions.execute_test_runner()))
-        utils.execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s %s'%(
-                Configuration().NODE_KEY, Configuration().NODE_USERNAME, node_ip, cmd))
+    def completionToken(self):
+        return hmac.new(Configuration().COMPLETION_SECRET,
+                        '%s/%s' % (self.id, self.commit_id),
+                        hashlib.sha1).hexdigest()
+
+    def completionURL(self):
+        base_url = Configuration().COMPLETION_URL
+        if not base_url or not Configuration().COMPLETION_SECRET:
+            return None
+        return '%s/done/%s/%s' % (base_url.rstrip('/'), self.id,
+                                  self.completionToken())
+
+    def runnerEnvironment(self):
+        lines = [
+            ' '.join(instructions.check_out_testrunner()),
+            '%s %s' % (' '.join(environment.get_environment(self.change_ref)),
+                       ' '.join(instructions.execute_test_runner())),
+        ]
+        url = self.completionURL()
+        if url:
+            lines.append(' '.join(instructions.report_completion(url)))
+        return lines
+
+    def bootstrap(self, node_ip):
+        script = instructions.bootstrap_test_runner(
+            self.runnerEnvironment(),
+            Configuration().get_int('BOOTSTRAP_READY_TIMEOUT'))
+        code, stdout, stderr = utils.execute_command(
+            utils.ssh_command(node_ip,
+                              Configuration().NODE_USERNAME,
+                              Configuration().NODE_KEY,
+                              'bash -s'),
+            return_streams=True,
+            stdin_data=script)
+        for line in stdout.splitlines():
+            if line.startswith(instructions.BOOTSTRAP_READY):
+                self.log.info('Test runner for %s started: %s'%(self, line))
+                return True
+        self.log.error('Bootstrap of %s failed with code %s: %s %s'%(
+                       self, code, stdout, stderr))
+        return False
+
+    def legacyBootstrap(self, node_ip):
+        for line in self.runnerEnvironment():
+            cmd = 'echo "%s" >> run_tests_env' % line
+            utils.execute_command(utils.ssh_command(
+                    node_ip, Configuration().NODE_USERNAME, Configuration().NODE_KEY, cmd))
         # For some reason invoking this immediately fails...
         time.sleep(5)
-        utils.execute_command('ssh$-q$-o$BatchMode=yes$-o$UserKnownHostsFile=/dev/null$-o$StrictHostKeyChecking=no$-i$%s$%s@%s$nohup bash /home/jenkins/run_tests_env < /dev/null > run_tests.log 2>&1 &'%(
-                Configuration().NODE_KEY, Configuration().NODE_USERNAME, node_ip), '$')
-        self.update(db, state=constants.RUNNING)
+        cmd = 'nohup bash /home/jenkins/run_tests_env < /dev/null > run_tests.log 2>&1 &'
+        utils.execute_command(utils.ssh_command(
+                node_ip, Configuration().NODE_USERNAME, Configuration().NODE_KEY, cmd))
+
+    def secondsSinceUpdate(self):
+        # pylint: disable=E
+        updated = time.mktime(self.updated.timetuple())
+        # pylint: enable=E
+        return time.time() - updated
+
+    def needsLivenessProbe(self):
+        if not self.node_ip:
+            return False
+        elapsed = self.secondsSinceUpdate()
+        return 300 <= elapsed <= Configuration().get_int('MAX_RUNNING_TIME')
+
+    @classmethod
+    def probeRunning(cls, node_ip):
+        return utils.execute_command(
+            utils.ssh_command(node_ip,
+                              Configuration().NODE_USERNAME,
+                              Configuration().NODE_KEY,
+                              'ps -p `cat /home/jenkins/run_tests.pid`'),
+            silent=True,
+            timeout=Configuration().get_int('PROBE_TIMEOUT'))
 
-    def isRunning(self, db):
+    @classmethod
+    def probeAllRunning(cls, node_ips):
+        return utils.execute_commands(
+            [utils.ssh_command(node_ip,
+                               Configuration().NODE_USERNAME,
+                               Configuration().NODE_KEY,
+                               'ps -p `cat /home/jenkins/run_tests.pid`')
+             for node_ip in node_ips],
+            silent=True,
+            timeout=Configuration().get_int('PROBE_TIMEOUT'))
+
+    def isRunning(self, db, probed=None):
         if not self.node_ip:
             self.log.error('Checking job %s is running but no node IP address'%self)
             return False
 
-        # pylint: disable=E
-        updated = time.mktime(self.updated.timetuple())
-        # pylint: enable=E
+        elapsed = self.secondsSinceUpdate()
 
-        if (time.time() - updated < 300):
+        if (elapsed < 300):
             # Allow 5 minutes for the gate PID to exist
             return True
 
         # Absolute maximum running time of 2 hours.  Note that if by happy chance the tests have finished
         # this result will be over-written by retrieveResults
-        if (time.time() - updated > Configuration().get_int('MAX_RUNNING_TIME')):
-            self.log.error('Timed out job %s (Running for %d seconds)'%(self, time.time()-updated))
+        if (elapsed > Configuration().get_int('MAX_RUNNING_TIME')):
+            self.log.error('Timed out job %s (Running for %d seconds)'%(self, elapsed))
             self.update(db, result='Aborted: Timed out')
             return False
 
         try:
-            success = utils.execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s %s@%s ps -p `cat /home/jenkins/run_tests.pid`'%(
-                    Configuration().NODE_KEY, Configuration().NODE_USERNAME, self.node_ip), silent=True)
+            # probed is the outcome of a bulk probe made by the caller, which
+            # may be the exception that probe raised
+            if probed is None:
+                probed = self.probeRunning(self.node_ip)
+            if isinstance(probed, Exception):
+                raise probed
+            success = probed
             self.log.info('Gate-is-running on job %s (%s) returned: %s'%(
                           self, self.node_ip, success))
             return success
+        except utils.CommandTimeout, e:
+            # A hung node is retried on the next pass; MAX_RUNNING_TIME
+            # still aborts it eventually
+            self.log.warning('Gate-is-running on job %s (%s) timed out'%(
+                             self, self.node_ip))
+            return True
         except Exception, e:
             self.update(db, result='Aborted: Exception checking for pid')
             self.log.exception(e)
             return False
 
+    NODE_LOG_MASKS = [
+        '/home/jenkins/workspace/testing/logs/*',
+        '/home/jenkins/run_test*'
+    ]
+
+    def readResultFile(self):
+        code, stdout, stderr = utils.execute_command(
+            utils.ssh_command(
+                self.node_ip,
+                Configuration().NODE_USERNAME,
+                Configuration().NODE_KEY,
+                'cat result.txt'),
+            silent=True,
+            return_streams=True
+        )
+        self.log.info('Result: %s (Err: %s)'%(stdout, stderr))
+        return code, stdout
+
+    def resultFrom(self, code, stdout):
+        if code != 0:
+            # This node is broken somehow... Mark it as aborted
+            if self.result and self.result.startswith('Aborted: '):
+                return self.result
+            return constants.NORESULT
+
+        return stdout.splitlines()[0]
+
+    def transfersArchives(self):
+        transfer = Configuration().NODE_LOG_TRANSFER
+        if transfer not in ('sftp', 'tar'):
+            raise Exception('Invalid node log transfer: %s' % transfer)
+        return transfer == 'tar'
+
     def retrieveResults(self, dest_path):
         if not self.node_ip:
             self.log.error('Attempting to retrieve results for %s but no node IP address'%self)
             return constants.NO_IP
         try:
-            code, stdout, stderr = utils.execute_command(
-                'ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null'
-                ' -o StrictHostKeyChecking=no -i %s %s@%s cat result.txt' % (
-                    Configuration().NODE_KEY,
+            code, stdout = self.readResultFile()
+            if self.transfersArchives():
+                self.log.info('Downloading log archives for %s'%self)
+                utils.copy_logs_tar(
+                    self.NODE_LOG_MASKS,
+                    dest_path,
+                    self.node_ip,
                     Configuration().NODE_USERNAME,
-                    self.node_ip),
-                silent=True,
-                return_streams=True
-            )
-            self.log.info('Result: %s (Err: %s)'%(stdout, stderr))
+                    Configuration().NODE_KEY
+                )
+                return self.resultFrom(code, stdout)
+
             self.log.info('Downloading logs for %s'%self)
             utils.copy_logs(
-                [
-                    '/home/jenkins/workspace/testing/logs/*',
-                    '/home/jenkins/run_test*'
-                ],
+                self.NODE_LOG_MASKS,
                 dest_path,
                 self.node_ip,
                 Configuration().NODE_USERNAME,
@@ -200,19 +518,54 @@ class Job(db.Base):
                 dest_path
             )
 
-            if code != 0:
-                # This node is broken somehow... Mark it as aborted
-                if self.result and self.result.startswith('Aborted: '):
-                    return self.result
-                return constants.NORESULT
-
-            return stdout.splitlines()[0]
+            return self.resultFrom(code, stdout)
         except Exception, e:
             self.log.exception(e)
             return constants.COPYFAIL
 
-    def __repr__(self):
-        return "%(id)s (%(project_name)s/%(change_num)s) %(state)s" %self
+    def streamResults(self, uploader, cf_prefix, watch=None):
+        if not self.node_ip:
+            self.log.error('Attempting to retrieve results for %s but no node IP address'%self)
+            return constants.NO_IP, None
+        username = Configuration().NODE_USERNAME
+        key = Configuration().NODE_KEY
+        ssh = None
+        sftp = None
+        try:
+            code, stdout = self.readResultFile()
+            result = self.resultFrom(code, stdout)
+            if not self.transfersArchives():
+                ssh = utils.getSSHObject(self.node_ip, username, key)
+                sftp = ssh.open_sftp()
+        except Exception, e:
+            self.log.exception(e)
+            if ssh is not None:
+                ssh_pool.get_pool().release(ssh)
+            return constants.COPYFAIL, None
+
+        # Logs that cannot be read from the node are a COPYFAIL, as in
+        # retrieveResults; upload failures propagate, as they do from
+        # publishResults, so the collection is tried again
+        self.log.info('Streaming logs for %s'%self)
+        try:
+            if self.transfersArchives():
+                entries = itertools.chain(
+                    utils.stream_node_logs(self.node_ip, username, key,
+                                           self.NODE_LOG_MASKS),
+                    utils.stream_dom0_logs(self.node_ip, username, key))
+            else:
+                entries = itertools.chain(
+                    utils.stream_logs(sftp, self.NODE_LOG_MASKS),
+                    utils.stream_dom0_logs(self.node_ip, username, key))
+            if watch is not None:
+                entries = watch(entries)
+            url = uploader.upload_streams(entries, cf_prefix)
+        except storage.SourceError, e:
+            self.log.exception(e)
+            return constants.COPYFAIL, None
+        finally:
+            if sftp is not None:
+                sftp.close()
+                ssh_pool.get_pool().release(ssh)
 
-    def __getitem__(self, item):
-        return getattr(self, item)
+        return result, url
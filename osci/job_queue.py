@@ -1,6 +1,9 @@
+import datetime
+import hmac
 import os
 import logging
 import paramiko
+import re
 import time
 import threading
 
@@ -8,8 +11,17 @@ from osci.db import DB, and_
 from osci.config import Configuration
 from osci.job import Job
 from osci import constants
+from osci import time_services
+from osci import utils
 from osci.utils import execute_command, copy_logs, vote
 from osci import filesystem_services
+from osci import ssh_pool
+from osci.scheduler import Scheduler, WakeupChannel
+from osci.workers import WorkerPool
+from osci.pipeline import Pipeline, Stage
+from osci.liveness import LivenessProber
+from osci.completion import CompletionListener
+from osci.nodepool_manager import NodeDeleter
 
 
 class DeleteNodeThread(threading.Thread):
@@ -19,31 +31,212 @@ class DeleteNodeThread(threading.Thread):
         threading.Thread.__init__(self, name='DeleteNodeThread')
         self.jobQueue = jobQueue
         self.pool = self.jobQueue.nodepool
+        self.deleter = NodeDeleter(
+            self.pool,
+            Configuration().get_int('DELETE_WORKERS'),
+            Configuration().get_int('DELETE_ATTEMPTS'),
+            Configuration().get_int('DELETE_RETRY_DELAY'))
+        self.wakeup = WakeupChannel(self.name)
         self.daemon = True
 
     def get_jobs(self):
-        delete_list = []
-        with self.jobQueue.db.get_session() as session:
-            finished_node_jobs = session.query(Job).filter(and_(Job.state.in_([constants.COLLECTED,
-                                                                               constants.FINISHED,
-                                                                               constants.OBSOLETE]),
-                                                           Job.node_id != 0))
+        # Uploading jobs have their logs on local disk already
+        return Job.getAllInStates(self.jobQueue.db,
+                                  [constants.UPLOADING,
+                                   constants.COLLECTED,
+                                   constants.FINISHED,
+                                   constants.OBSOLETE],
+                                  Job.node_id > 0)
 
-            for job in finished_node_jobs:
-                delete_list.append(job)
-        return delete_list
+    def deleted(self, node_id):
+        # Called on a deleter worker, so look the jobs up in its session
+        for job in Job.getAllWhere(self.jobQueue.db, node_id=node_id):
+            ssh_pool.get_pool().evict_host(
+                job.node_ip, Configuration().NODE_USERNAME)
+            job.update(self.jobQueue.db, node_id=0)
+        self.jobQueue.scheduler.notify('node %s freed' % node_id)
+
+    def deleteNodes(self):
+        delete_list = self.get_jobs()
+        self.log.debug('Nodes to delete: %s'%delete_list)
+        # Deletions run in the background; a node still being deleted
+        # from an earlier pass is not submitted again
+        return [task for task in
+                [self.deleter.submit(job.node_id, self.deleted)
+                 for job in delete_list]
+                if task is not None]
+
+    def run(self):
+        while True:
+            try:
+                self.deleteNodes()
+                ssh_pool.get_pool().evict_idle()
+            except Exception, e:
+                self.log.exception(e)
+            self.wakeup.wait(10)
+
+
+class ValidateNodesThread(threading.Thread):
+    log = logging.getLogger('citrix.ValidateNodesThread')
+
+    def __init__(self, jobQueue):
+        threading.Thread.__init__(self, name='ValidateNodesThread')
+        self.jobQueue = jobQueue
+        self.pool = self.jobQueue.nodepool
+        self.wakeup = WakeupChannel(self.name)
+        self.daemon = True
+
+    def validate(self):
+        ready = self.pool.getReadyNodes()
+        self.pool.forgetValidations([node_id for node_id, _ in ready])
+        unchecked = [(node_id, node_ip) for node_id, node_ip in ready
+                     if not self.pool.isValidated(node_id)]
+        # Keep a few nodes checked ahead of demand rather than all of them
+        wanted = (Configuration().get_int('VALIDATE_POOL') -
+                  (len(ready) - len(unchecked)))
+        candidates = unchecked[:max(0, wanted)]
+        if not candidates:
+            return []
+
+        results = utils.validate_nodes(
+            [node_ip for _, node_ip in candidates],
+            Configuration().NODE_USERNAME, Configuration().NODE_KEY,
+            Configuration().get_int('VALIDATE_TIMEOUT'))
+        bad = []
+        for (node_id, node_ip), (ok, latency) in zip(candidates, results):
+            if ok:
+                self.log.info('Node %s/%s validated in %.2fs',
+                              node_id, node_ip, latency)
+                self.pool.markValidated(node_id, latency)
+                continue
+            if ok is None:
+                # Left unchecked, so it is tried again on the next pass
+                self.log.warning('Validation of node %s/%s timed out after '
+                                 '%.2fs', node_id, node_ip, latency)
+                continue
+            self.log.error('Node %s/%s failed validation after %.2fs.  '
+                           'Deleting node.', node_id, node_ip, latency)
+            # Claimed first so it cannot be allocated while it is deleted
+            if self.pool.claimNode(node_id):
+                self.pool.deleteNode(node_id)
+                ssh_pool.get_pool().evict_host(
+                    node_ip, Configuration().NODE_USERNAME)
+                bad.append(node_id)
+        return bad
+
+    def run(self):
+        while True:
+            try:
+                self.validate()
+            except Exception, e:
+                self.log.exception(e)
+            self.wakeup.wait(Configuration().get_int('VALIDATE_INTERVAL'))
+
+
+class ArchiveJobsThread(threading.Thread):
+    log = logging.getLogger('citrix.ArchiveJobsThread')
+
+    def __init__(self, jobQueue):
+        threading.Thread.__init__(self, name='ArchiveJobsThread')
+        self.jobQueue = jobQueue
+        self.wakeup = WakeupChannel(self.name)
+        self.daemon = True
+
+    def archive(self):
+        days = Configuration().get_int('ARCHIVE_AFTER_DAYS')
+        before = time_services.now() - datetime.timedelta(days=days)
+        archived = Job.archiveFinished(
+            self.jobQueue.db, before,
+            Configuration().get_int('ARCHIVE_BATCH'))
+        if archived:
+            self.log.info('Archived %d jobs finished before %s',
+                          archived, before)
+        return archived
 
     def run(self):
         while True:
             try:
-                delete_list = self.get_jobs()
-                self.log.debug('Nodes to delete: %s'%delete_list)
-                for job in delete_list:
-                    self.pool.deleteNode(job.node_id)
-                    job.update(self.jobQueue.db, node_id=0)
-                time.sleep(10)
+                self.archive()
             except Exception, e:
                 self.log.exception(e)
+            self.wakeup.wait(Configuration().get_int('ARCHIVE_INTERVAL'))
+
+
+class FailureScanner(object):
+    # Finds the same lines as grep '... FAIL' run_tests.log, but on the
+    # stream as it is uploaded instead of on a downloaded copy
+    PATTERN = re.compile('... FAIL')
+
+    def __init__(self, filename='run_tests.log'):
+        self.filename = filename
+        self.reset()
+
+    def reset(self):
+        self.lines = []
+        self.partial = ''
+
+    def feed(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        self.lines.extend(line for line in lines if self.PATTERN.search(line))
+
+    def finish(self):
+        if self.partial and self.PATTERN.search(self.partial):
+            self.lines.append(self.partial)
+        self.partial = ''
+
+    def output(self):
+        return ''.join('%s\n' % line for line in self.lines)
+
+    def watch(self, entries):
+        for name, size, opener in entries:
+            if name == self.filename:
+                opener = self.wrap(opener)
+            yield name, size, opener
+
+    def wrap(self, opener):
+        def open_scanned():
+            # A retried upload reads the file again from the start
+            self.reset()
+            return ScanningReader(opener(), self)
+        return open_scanned
+
+
+class ScanningReader(object):
+    def __init__(self, fileobj, scanner):
+        self.fileobj = fileobj
+        self.scanner = scanner
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.scanner.feed(data)
+        else:
+            self.scanner.finish()
+        return data
+
+    def close(self):
+        self.scanner.finish()
+        self.fileobj.close()
+
+
+class CollectionContext(object):
+    def __init__(self, job):
+        # Only plain values are kept; each stage runs in a different thread
+        # and must not touch objects owned by another thread's session
+        self.job_id = job.id
+        self.change_num = job.change_num
+        self.change_ref = job.change_ref
+        self.description = repr(job)
+        self.path = None
+        self.result = None
+        self.failed = None
+        self.url = None
+        self.fetched = False
+        self.recorded = False
+
+    def __repr__(self):
+        return self.description
 
 
 class CollectResultsThread(threading.Thread):
@@ -53,6 +246,27 @@ class CollectResultsThread(threading.Thread):
         threading.Thread.__init__(self, name='CollectResultsThread')
         self.daemon = True
         self.jobQueue = jobQueue
+        self.wakeup = WakeupChannel(self.name)
+        self.inFlight = set()
+        self.lock = threading.Lock()
+        config = Configuration()
+        if config.get_bool('COLLECT_STREAMING'):
+            # Logs go from the node to storage without touching local disk
+            stages = [Stage('stream', self.stream,
+                            config.get_int('COLLECT_DOWNLOAD_WORKERS'))]
+        else:
+            stages = [Stage('download', self.download,
+                            config.get_int('COLLECT_DOWNLOAD_WORKERS')),
+                      Stage('analyse', self.jobQueue.analyseResults,
+                            config.get_int('COLLECT_ANALYSE_WORKERS')),
+                      Stage('upload', self.jobQueue.publishResults,
+                            config.get_int('COLLECT_UPLOAD_WORKERS'))]
+        stages.append(Stage('update', self.record,
+                            config.get_int('COLLECT_UPDATE_WORKERS')))
+        self.pipeline = Pipeline(
+            'collect', stages,
+            backlog=config.get_int('COLLECT_BACKLOG'),
+            finish=self.finish)
 
     def get_jobs(self):
         ret_list = []
@@ -62,16 +276,68 @@ class CollectResultsThread(threading.Thread):
             ret_list.append(job)
         return ret_list
 
+    def download(self, ctx):
+        for job in Job.getAllWhere(self.jobQueue.db, id=ctx.job_id,
+                                   state=constants.COLLECTING):
+            if not self.jobQueue.downloadResults(job, ctx):
+                return False
+            self.jobQueue.logsFetched(job, ctx)
+            return True
+        return False
+
+    def stream(self, ctx):
+        for job in Job.getAllWhere(self.jobQueue.db, id=ctx.job_id,
+                                   state=constants.COLLECTING):
+            return self.jobQueue.streamResults(job, ctx)
+        return False
+
+    def record(self, ctx):
+        for job in Job.getAllWhere(self.jobQueue.db, id=ctx.job_id):
+            self.jobQueue.recordResults(job, ctx)
+        return True
+
+    def finish(self, ctx):
+        try:
+            self.jobQueue.cleanupResults(ctx)
+        finally:
+            with self.lock:
+                self.inFlight.discard(ctx.job_id)
+
+    def submit(self, job):
+        with self.lock:
+            if job.id in self.inFlight:
+                return False
+            self.inFlight.add(job.id)
+        # Blocks while the download stage is backed up
+        self.pipeline.submit(CollectionContext(job))
+        return True
+
+    def recoverOrphans(self):
+        # Logs of a job that was uploading when osci stopped were in a
+        # temporary directory, and its node may be gone already
+        for job in Job.getAllWhere(self.jobQueue.db,
+                                   state=constants.UPLOADING):
+            with self.lock:
+                if job.id in self.inFlight:
+                    continue
+            self.log.error('Logs for %s were lost before upload' % job)
+            job.update(self.jobQueue.db, result=constants.COPYFAIL,
+                       state=constants.COLLECTED)
+
     def run(self):
+        try:
+            self.recoverOrphans()
+        except Exception, e:
+            self.log.exception(e)
         while True:
             try:
                 collect_list = self.get_jobs()
                 self.log.debug('Nodes to collect: %s'%collect_list)
                 for job in collect_list:
-                    self.jobQueue.uploadResults(job)
-                time.sleep(10)
+                    self.submit(job)
             except Exception, e:
                 self.log.exception(e)
+            self.wakeup.wait(10)
 
 
 class JobQueue(object):
@@ -81,33 +347,93 @@ class JobQueue(object):
         self.nodepool = nodepool
         self.collectResultsThread = None
         self.deleteNodeThread = None
+        self.validateNodesThread = None
+        self.archiveJobsThread = None
+        self.completionListener = None
+        self.lastProbed = {}
         self.jobs_enabled = Configuration().get_bool('RUN_TESTS')
         self.filesystem = filesystem
         self.uploader = uploader
         self.executor = executor
+        self.scheduler = Scheduler(Configuration().get_int('POLL'))
+        self.dispatchPool = WorkerPool('dispatch',
+                                       Configuration().get_int('DISPATCH_WORKERS'))
+        self.prober = LivenessProber(Job.probeRunning,
+                                     Configuration().get_int('PROBE_WORKERS'),
+                                     Job.probeAllRunning)
 
     def startCleanupThreads(self):
+        # Without a secret anyone could forge a job's completion token
+        if (Configuration().get_int('COMPLETION_PORT') and
+                not Configuration().COMPLETION_SECRET):
+            raise Exception('COMPLETION_SECRET must be set to listen for '
+                            'completions on COMPLETION_PORT')
         if self.collectResultsThread is None:
             self.collectResultsThread = CollectResultsThread(self)
             self.collectResultsThread.start()
         if self.deleteNodeThread is None:
             self.deleteNodeThread = DeleteNodeThread(self)
             self.deleteNodeThread.start()
+        if (self.validateNodesThread is None and
+                Configuration().get_bool('VALIDATE_NODES')):
+            self.validateNodesThread = ValidateNodesThread(self)
+            self.validateNodesThread.start()
+        if (self.archiveJobsThread is None and
+                Configuration().get_int('ARCHIVE_AFTER_DAYS')):
+            self.archiveJobsThread = ArchiveJobsThread(self)
+            self.archiveJobsThread.start()
+        port = Configuration().get_int('COMPLETION_PORT')
+        if self.completionListener is None and port:
+            self.completionListener = CompletionListener(
+                self, port, Configuration().COMPLETION_HOST)
+            self.completionListener.start()
+
+    def wakeCollector(self, reason):
+        if self.collectResultsThread is not None:
+            self.collectResultsThread.wakeup.notify(reason)
+
+    def wakeNodeDeleter(self, reason):
+        if self.deleteNodeThread is not None:
+            self.deleteNodeThread.wakeup.notify(reason)
 
     def addJob(self, change_ref, project_name, commit_id):
         change_num = change_ref.split('/')[3]
-        existing_jobs = Job.retrieve(self.db, project_name, change_num)
-        for existing in existing_jobs:
-            self.log.info('Job for previous patchset (%s) already queued - replacing'%(existing))
-            existing.update(self.db, state=constants.OBSOLETE)
-        job = Job(change_num, change_ref, project_name, commit_id)
-        with self.db.get_session() as session:
+        with self.db.unit_of_work() as session:
+            existing_jobs = Job.retrieve(self.db, project_name, change_num)
+            for existing in existing_jobs:
+                self.log.info('Job for previous patchset (%s) already queued - replacing'%(existing))
+                existing.update(self.db, state=constants.OBSOLETE)
+            job = Job(change_num, change_ref, project_name, commit_id)
             self.log.info("Job for %s queued"%job.change_num)
             session.add(job)
+        if existing_jobs:
+            self.wakeNodeDeleter('%d jobs obsoleted' % len(existing_jobs))
+        self.scheduler.notify('job for %s queued' % change_num)
 
     def triggerJobs(self):
-        for job in self.get_queued_enabled_jobs():
-            job.runJob(self.db, self.nodepool)
+        jobs = self.get_queued_enabled_jobs()
+        if not jobs:
+            return
+        # One allocation for the whole pass rather than one per job
+        nodes = self.nodepool.getNodes(len(jobs))
+        dispatches = zip([job.id for job in jobs], nodes)
+        # Jobs left without a node wait for the next pass, unless they
+        # still hold an old node that has to be deleted
+        dispatches.extend((job.id, None) for job in jobs[len(nodes):]
+                          if job.node_id)
+        self.dispatchPool.map(self._dispatch, dispatches)
+
+    def _dispatch(self, dispatch):
+        self.dispatchJob(*dispatch)
+
+    def dispatchJob(self, job_id, node=None):
+        # Sessions are per-thread, so reload the job in the worker's own
+        # session; this also skips jobs replaced since they were listed
+        for job in Job.getAllWhere(self.db, id=job_id, state=constants.QUEUED):
+            job.runJob(self.db, self.nodepool, node)
+            return
+        if node is not None:
+            self.nodepool.releaseNode(node[0])
 
     def get_queued_enabled_jobs(self):
         allJobs = Job.getAllWhere(self.db, state=constants.QUEUED)
@@ -116,41 +442,136 @@ class JobQueue(object):
             return allJobs
         return []
 
-    def uploadResults(self, job):
-        tmpPath = self.filesystem.mkdtemp(suffix=job.change_num)
+    def downloadResults(self, job, ctx):
+        ctx.path = self.filesystem.mkdtemp(suffix=ctx.change_num)
+        ctx.result = job.retrieveResults(ctx.path)
+        if not ctx.result:
+            logging.info('No result obtained from %s', ctx)
+            return False
+        return True
+
+    def logsFetched(self, job, ctx):
+        # With the logs on local disk the node can be deleted while the
+        # upload and vote carry on
+        job.update(self.db, state=constants.UPLOADING)
+        ctx.fetched = True
+        self.wakeNodeDeleter('logs for %s fetched' % ctx.change_num)
+
+    def analyseResults(self, ctx):
+        code, ctx.failed, stderr = self.executor('grep$... FAIL$%s/run_tests.log'%ctx.path,
+                                                 delimiter='$',
+                                                 return_streams=True)
+        self.log.info('Result: %s (Err: %s)', ctx.failed, stderr)
+        return True
+
+    def publishResults(self, ctx):
+        self.log.info('Copying logs for %s', ctx)
+        ctx.url = self.uploader.upload(ctx.path,
+                                       ctx.change_ref.replace('refs/changes/',''))
+        self.log.info('Uploaded results for %s', ctx)
+        return True
+
+    def streamResults(self, job, ctx):
+        scanner = FailureScanner()
+        self.log.info('Streaming logs for %s', ctx)
+        ctx.result, ctx.url = job.streamResults(
+            self.uploader, ctx.change_ref.replace('refs/changes/',''),
+            scanner.watch)
+        ctx.failed = scanner.output()
+        self.log.info('Result: %s', ctx.failed)
+        self.log.info('Uploaded results for %s', ctx)
+        return True
+
+    def recordResults(self, job, ctx):
+        job.update(self.db, result=ctx.result,
+                   logs_url=ctx.url,
+                   report_url=ctx.url,
+                   failed=ctx.failed)
+        job.update(self.db, state=constants.COLLECTED)
+        ctx.recorded = True
+        self.scheduler.notify('results for %s collected' % ctx.change_num)
+        self.wakeNodeDeleter('results for %s collected' % ctx.change_num)
 
+    def abandonUpload(self, ctx):
+        # Once UPLOADING the node may be gone, and the local logs are
+        # about to be removed, so the collection cannot be tried again
+        for job in Job.getAllWhere(self.db, id=ctx.job_id,
+                                   state=constants.UPLOADING):
+            self.log.error('Upload of logs for %s failed; giving up', ctx)
+            job.update(self.db, result=constants.COPYFAIL,
+                       state=constants.COLLECTED)
+            self.scheduler.notify('upload for %s failed' % ctx.change_num)
+
+    def cleanupResults(self, ctx):
+        try:
+            if ctx.fetched and not ctx.recorded:
+                self.abandonUpload(ctx)
+        finally:
+            if ctx.path:
+                self.filesystem.rmtree(ctx.path)
+
+    def uploadResults(self, job):
+        ctx = CollectionContext(job)
         try:
-            result = job.retrieveResults(tmpPath)
-            if not result:
-                logging.info('No result obtained from %s', job)
-                return
-
-            code, fail_stdout, stderr = self.executor('grep$... FAIL$%s/run_tests.log'%tmpPath,
-                                                      delimiter='$',
-                                                      return_streams=True)
-            self.log.info('Result: %s (Err: %s)', fail_stdout, stderr)
-
-            self.log.info('Copying logs for %s', job)
-            result_url = self.uploader.upload(tmpPath,
-                                                job.change_ref.replace('refs/changes/',''))
-            self.log.info('Uploaded results for %s', job)
-            job.update(self.db, result=result,
-                       logs_url=result_url,
-                       report_url=result_url,
-                       failed=fail_stdout)
-            job.update(self.db, state=constants.COLLECTED)
+            if Configuration().get_bool('COLLECT_STREAMING'):
+                collected = self.streamResults(job, ctx)
+            else:
+                collected = self.downloadResults(job, ctx)
+                if collected:
+                    self.logsFetched(job, ctx)
+                    collected = (self.analyseResults(ctx) and
+                                 self.publishResults(ctx))
+            if collected:
+                self.recordResults(job, ctx)
         finally:
-            self.filesystem.rmtree(tmpPath)
+            self.cleanupResults(ctx)
 
     def processResults(self):
         allJobs = Job.getAllWhere(self.db, state=constants.RUNNING)
         self.log.info('%d jobs running...'%len(allJobs))
-        for job in allJobs:
-            if job.isRunning(self.db):
-                continue
+        self.lastProbed = dict((job.id, self.lastProbed.get(job.id, 0))
+                               for job in allJobs)
+        statuses = self.prober.probe(
+            dict((job.id, job.node_ip) for job in allJobs
+                 if job.needsLivenessProbe() and self.probeDue(job.id)))
+        done = []
+        with self.db.unit_of_work():
+            for job in allJobs:
+                # Jobs not probed this pass are assumed to still be running
+                if job.isRunning(self.db, statuses.get(job.id, True)):
+                    continue
+
+                job.update(self.db, state=constants.COLLECTING)
+                self.log.info('Tests for %s are done! Collecting'%job)
+                done.append(job.change_num)
+        # Only wake the collector once the new states are committed
+        if done:
+            self.wakeCollector('tests for %s are done' % ', '.join(done))
+
+    def probeDue(self, job_id):
+        if self.completionListener is None:
+            return True
+        # Nodes report completion themselves, so polling is only a
+        # fallback for reports that were lost
+        now = time.time()
+        interval = Configuration().get_int('COMPLETION_FALLBACK_POLL')
+        if now - self.lastProbed.get(job_id, 0) < interval:
+            return False
+        self.lastProbed[job_id] = now
+        return True
 
+    def markCompleted(self, job_id, token):
+        if not Configuration().COMPLETION_SECRET:
+            return False
+        for job in Job.getAllWhere(self.db, id=job_id, state=constants.RUNNING):
+            if not hmac.compare_digest(token, job.completionToken()):
+                self.log.error('Bad completion token for %s'%job)
+                return False
             job.update(self.db, state=constants.COLLECTING)
-            self.log.info('Tests for %s are done! Collecting'%job)
+            self.log.info('Tests for %s reported done! Collecting'%job)
+            self.wakeCollector('tests for %s reported done' % job.change_num)
+            return True
+        return False
 
     def postResults(self):
         allJobs = Job.getAllWhere(self.db, state=constants.COLLECTED)
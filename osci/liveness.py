@@ -0,0 +1,34 @@
+import logging
+
+from osci.workers import WorkerPool
+
+
+class LivenessProber(object):
+    log = logging.getLogger('citrix.LivenessProber')
+
+    def __init__(self, probe, workers, probe_many=None):
+        self.probe_func = probe
+        # probe_many checks a list of node IPs at once and returns a
+        # result or exception for each
+        self.probe_many = probe_many
+        self.pool = WorkerPool('probe', workers)
+
+    def _probe(self, node_ip):
+        try:
+            return self.probe_func(node_ip)
+        except Exception, e:
+            # Handed back so the caller can decide what a failure means
+            return e
+
+    def probe(self, targets):
+        # targets maps an id to a node IP; the result maps the id to the
+        # probe's return value or the exception it raised
+        ids = targets.keys()
+        if self.probe_many is not None:
+            try:
+                results = self.probe_many([targets[i] for i in ids])
+            except Exception, e:
+                results = [e] * len(ids)
+            return dict(zip(ids, results))
+        results = self.pool.map(self._probe, [targets[i] for i in ids])
+        return dict(zip(ids, results))
@@ -1,7 +1,6 @@
 import logging
 import optparse
 import re
-import time
 
 from prettytable import PrettyTable
 from threading import Event
@@ -14,7 +13,9 @@ from osci.job import Job
 from osci import utils
 from osci import db
 from osci import filesystem_services
-from osci import swift_upload
+from osci import capacity
+from osci import status
+from osci import storage
 
 
 def get_parser():
@@ -44,13 +45,17 @@ def main():
                         'swiftclient']:
         logging.getLogger(logger_name).setLevel(logging.WARNING)
 
-    database = db.DB(Configuration().DATABASE_URL)
+    config = Configuration()
+    database = db.DB(config.DATABASE_URL,
+                     pool_size=config.get_int('DB_POOL_SIZE'),
+                     max_overflow=config.get_int('DB_MAX_OVERFLOW'),
+                     pool_recycle=config.get_int('DB_POOL_RECYCLE'))
 
     queue = JobQueue(
         database=database,
         nodepool=NodePool(Configuration().NODEPOOL_IMAGE),
         filesystem=filesystem_services.RealFilesystem(),
-        uploader=swift_upload.SwiftUploader(),
+        uploader=storage.get_backend(),
         executor=utils.execute_command)
     
     if options.change_ref:
@@ -61,17 +66,21 @@ def main():
         return
 
     queue.startCleanupThreads()
+    interval = config.get_int('STATUS_INTERVAL')
+    if interval:
+        status.StatusThread(status.get_snapshot(database, queue.uploader),
+                            interval).start()
+    interval = config.get_int('DEMAND_INTERVAL')
+    if interval:
+        capacity.DemandThread(capacity.get_publisher(database),
+                              interval).start()
 
     try:
-        while True:
-            try:
-                queue.postResults()
-                queue.processResults()
-                queue.triggerJobs()
-            except Exception, e:
-                logging.exception(e)
-                # Ignore exception and try again; keeps the app polling
-            time.sleep(Configuration().get_int('POLL'))
+        # Each step is retried on the next wakeup if it raises; the POLL
+        # interval is only a fallback for events we are not notified of
+        queue.scheduler.run_forever([queue.postResults,
+                                     queue.processResults,
+                                     queue.triggerJobs])
     except KeyboardInterrupt:
         logging.info("Terminated by user")
 
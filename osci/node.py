@@ -3,6 +3,28 @@ from osci import executor
 from osci import common_ssh_options
 
 
+# tar flag and compressor program for each archive compression
+COMPRESSIONS = {
+    'none': ('', None),
+    'gzip': ('z', 'gzip'),
+    'bzip2': ('j', 'bzip2'),
+    'xz': ('J', 'xz'),
+}
+
+
+def tar_to_stdout(sources, compression='gzip', level=None, recursive=True):
+    flag, program = COMPRESSIONS[compression]
+    options = ['--ignore-failed-read']
+    if not recursive:
+        options.append('--no-recursion')
+    if program and level is not None:
+        # tar's own flag always uses the default level, so pipe through
+        # the compressor to pick another one
+        return (['tar'] + options + ['-cf', '-'] + sources.split()
+                + ['|', program, '-%d' % level])
+    return ['tar'] + options + ['-c%sf' % flag, '-'] + sources.split()
+
+
 class Node(server.Server):
 
     USERNAME = 'node_username'
@@ -23,9 +45,14 @@ class Node(server.Server):
             + executor.escaped(args)
         )
 
-    def command_to_get_dom0_files_as_tgz_to_stdout(self, sources):
-        return self.run_on_dom0(
-            "tar --ignore-failed-read -czf - {0}".format(
-                sources).split()
-        )
+    def command_to_get_dom0_files_as_tgz_to_stdout(self, sources,
+                                                   compression='gzip',
+                                                   level=None):
+        return self.run_on_dom0(tar_to_stdout(sources, compression, level))
+
+    def command_to_get_files_as_tar_to_stdout(self, sources,
+                                              compression='gzip', level=None):
+        # Only the files matching sources, as copy_logs would fetch them
+        return self.run(
+            tar_to_stdout(sources, compression, level, recursive=False))
 
@@ -1,14 +1,21 @@
 import logging
 import threading
+import time
 import Queue
 from osci.config import Configuration
 from osci import time_services
+from osci.workers import WorkerPool
 
 class NodePool():
     log = logging.getLogger('citrix.nodepool')
 
     def __init__(self, image):
         self.image = image
+        self.managers_config = None
+        self.managers_lock = threading.Lock()
+        # node id -> (time validated, seconds the check took)
+        self.validated = {}
+        self.validated_lock = threading.Lock()
         self.init_nodepool()
 
     def init_nodepool(self):
@@ -23,23 +30,140 @@ class NodePool():
     def getSession(self):
         return self.pool.getDB().getSession()
 
-    def getNode(self):
+    def setState(self, session, node_id, old_state, new_state):
+        # Only changes a node still in old_state, so of several osci
+        # processes racing for a node exactly one gets it
+        node_table = self.nodedb.node_table
+        result = session.session().execute(
+            node_table.update()
+            .where(node_table.c.id == node_id)
+            .where(node_table.c.state == old_state)
+            .values(state=new_state, state_time=int(time.time())))
+        return result.rowcount == 1
+
+    def getReadyNodes(self):
+        with self.getSession() as session:
+            return [(node.id, node.ip) for node in
+                    session.getNodes(image_name=self.image,
+                                     state=self.nodedb.READY)]
+
+    def markValidated(self, node_id, latency):
+        with self.validated_lock:
+            self.validated[node_id] = (time.time(), latency)
+
+    def isValidated(self, node_id):
+        max_age = Configuration().get_int('VALIDATE_MAX_AGE')
+        with self.validated_lock:
+            entry = self.validated.get(node_id)
+        return entry is not None and time.time() - entry[0] < max_age
+
+    def forgetValidations(self, keep):
+        # Only READY nodes are worth remembering
+        keep = set(keep)
+        with self.validated_lock:
+            for node_id in self.validated.keys():
+                if node_id not in keep:
+                    del self.validated[node_id]
+
+    def claimNode(self, node_id):
         with self.getSession() as session:
-            for node in session.getNodes():
-                if node.image_name != self.image:
-                    continue
-                if node.state != self.nodedb.READY:
-                    continue
-                # Allocate this node
-                node.state = self.nodedb.HOLD
-                return node.id, node.ip
+            return self.setState(session, node_id, self.nodedb.READY,
+                                 self.nodedb.HOLD)
+
+    def getNodes(self, count):
+        # Claims up to count READY nodes of our image in one transaction
+        claimed = []
+        if count <= 0:
+            return claimed
+        with self.getSession() as session:
+            nodes = session.getNodes(image_name=self.image,
+                                     state=self.nodedb.READY)
+            # Nodes already known to work go first
+            for node in sorted(nodes,
+                               key=lambda node: not self.isValidated(node.id)):
+                if self.setState(session, node.id, self.nodedb.READY,
+                                 self.nodedb.HOLD):
+                    claimed.append((node.id, node.ip))
+                    if len(claimed) == count:
+                        break
+        if claimed:
+            self.log.info('Allocated nodes %s', [id for id, _ in claimed])
+        return claimed
+
+    def getNode(self):
+        nodes = self.getNodes(1)
+        if nodes:
+            return nodes[0]
         return None, None
 
+    def releaseNode(self, node_id):
+        # Hands back a node that was allocated but not used
+        with self.getSession() as session:
+            self.setState(session, node_id, self.nodedb.HOLD,
+                          self.nodedb.READY)
+
+    def ensureManagers(self):
+        # Reconfiguring builds new provider managers, so only do it when
+        # nodepool's config object has been replaced
+        with self.managers_lock:
+            if self.managers_config is not self.pool.config:
+                self.pool.reconfigureManagers(self.pool.config)
+                self.managers_config = self.pool.config
+
     def deleteNode(self, node_id):
         if not node_id:
             return
-        self.pool.reconfigureManagers(self.pool.config)
+        self.ensureManagers()
         with self.getSession() as session:
             node = session.getNode(node_id)
             if node:
                 self.pool.deleteNode(session, node)
+
+
+class NodeDeleter(object):
+    log = logging.getLogger('citrix.NodeDeleter')
+
+    def __init__(self, nodepool, workers, attempts, retry_delay):
+        self.nodepool = nodepool
+        self.attempts = max(1, attempts)
+        self.retry_delay = retry_delay
+        self.pool = WorkerPool('delete', workers)
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    def inFlight(self):
+        with self.lock:
+            return set(self.in_flight)
+
+    def submit(self, node_id, done=None):
+        # A node is only deleted once however often it is asked for;
+        # done(node_id) is called from the worker after a deletion
+        with self.lock:
+            if node_id in self.in_flight:
+                return None
+            self.in_flight.add(node_id)
+        return self.pool.submit(self._delete, node_id, done)
+
+    def _delete(self, node_id, done):
+        try:
+            attempt = 1
+            while True:
+                try:
+                    start = time.time()
+                    self.nodepool.deleteNode(node_id)
+                    self.log.info('Deleted node %s in %.1fs', node_id,
+                                  time.time() - start)
+                    break
+                except Exception, e:
+                    if attempt >= self.attempts:
+                        raise
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                    self.log.warning('Deleting node %s failed (%s); '
+                                     'retrying in %ss', node_id, e, delay)
+                    time.sleep(delay)
+                    attempt += 1
+            if done is not None:
+                done(node_id)
+        finally:
+            with self.lock:
+                self.in_flight.discard(node_id)
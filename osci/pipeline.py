@@ -0,0 +1,46 @@
+import logging
+
+from osci.workers import WorkerPool
+
+
+class Stage(object):
+    def __init__(self, name, func, workers):
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+class Pipeline(object):
+    log = logging.getLogger('citrix.Pipeline')
+
+    def __init__(self, name, stages, backlog, finish=None):
+        self.name = name
+        self.stages = stages
+        self.finish = finish
+        # The bounded backlog of each stage blocks the stage feeding it,
+        # so a slow stage throttles everything upstream of it
+        self.pools = [WorkerPool('%s-%s' % (name, stage.name),
+                                 stage.workers, backlog)
+                      for stage in stages]
+
+    def submit(self, item):
+        self.pools[0].submit(self._run_stage, 0, item)
+
+    def _run_stage(self, index, item):
+        stage = self.stages[index]
+        try:
+            proceed = stage.func(item)
+        except Exception:
+            self.log.error('%s stage %s failed for %s',
+                           self.name, stage.name, item)
+            self._finish(item)
+            raise
+
+        if proceed and index + 1 < len(self.stages):
+            self.pools[index + 1].submit(self._run_stage, index + 1, item)
+        else:
+            self._finish(item)
+
+    def _finish(self, item):
+        if self.finish is not None:
+            self.finish(item)
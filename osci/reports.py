@@ -1,5 +1,6 @@
 import logging
 import argparse
+import datetime
 import time
 
 from prettytable import PrettyTable
@@ -10,6 +11,7 @@ from osci.job_queue import JobQueue
 from osci import constants
 from osci.job import Job
 from osci import db
+from osci import time_services
 
 
 def get_parser():
@@ -43,31 +45,30 @@ def get_parser():
 
     return parser
 
+def recent_since(options):
+    if not options.recent:
+        return None
+    return time_services.now() - datetime.timedelta(hours=int(options.recent))
+
 def func_list(options, queue):
     table = PrettyTable(["Project", "Change", "State", "IP", "Result",
                          "Age (hours)", "Duration"])
     table.align = 'l'
     now = time.time()
-    all_jobs = Job.getAllWhere(queue.db)
-    state_dict = {}
-    result_dict = {}
+    since = recent_since(options)
     if options.states and len(options.states) > 0:
-        states = options.states.split(',')
+        names = options.states.split(',')
+        states = [state for state, name in constants.STATES.items()
+                  if name in names]
     else:
         states = None
-    for job in all_jobs:
+    # The totals cover every state, not just those listed
+    state_dict = dict((constants.STATES[state], count) for state, count in
+                      Job.countHistory(queue.db, 'state', since).items())
+    result_dict = Job.countHistory(queue.db, 'result', since)
+    for job in Job.iterHistory(queue.db, since=since, states=states):
         updated = time.mktime(job.updated.timetuple())
         age_hours = (now - updated) / 3600
-        if options.recent:
-            if age_hours > int(options.recent):
-                continue
-        state_count = state_dict.get(constants.STATES[job.state], 0) + 1
-        state_dict[constants.STATES[job.state]] = state_count
-        result_count = result_dict.get(job.result, 0)+1
-        result_dict[job.result] = result_count
-
-        if states and constants.STATES[job.state] not in states:
-            continue
         if job.node_id:
             node_ip = job.node_ip
         else:
@@ -94,7 +95,7 @@ def func_show(options, queue):
                              'state', 'created', 'Commit id', 'Node id',
                              'Node ip', 'Result', 'Logs', 'Report',
                              'Updated', 'Gerrit URL'])
-    job = Job.getAllWhere(queue.db, change_ref=options.change_ref)[0]
+    job = Job.getHistoryWhere(queue.db, change_ref=options.change_ref)[0]
     url = 'https://review.openstack.org/%s'%job.change_num
     table.add_column('Value',
                      [job.project_name, job.change_num, job.change_ref,
@@ -110,16 +111,10 @@ def func_failures(options, queue):
                              "Duration", "URL"])
     table.align = 'l'
     now = time.time()
-    all_jobs = Job.getAllWhere(queue.db)
-    for job in all_jobs:
-        if not job.result or (job.result != 'Failed' and
-                              job.result.find('Aborted') != 0):
-            continue
+    for job in Job.iterHistory(queue.db, since=recent_since(options),
+                               failed=True):
         updated = time.mktime(job.updated.timetuple())
         age_hours = (now - updated) / 3600
-        if options.recent:
-            if age_hours > int(options.recent):
-                continue
         age = '%.02f' % (age_hours)
 
         duration = '-'
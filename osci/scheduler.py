@@ -0,0 +1,48 @@
+import logging
+import threading
+
+
+class WakeupChannel(object):
+    log = logging.getLogger('citrix.WakeupChannel')
+
+    def __init__(self, name):
+        self.name = name
+        self.event = threading.Event()
+
+    def notify(self, reason):
+        self.log.debug('Waking %s: %s', self.name, reason)
+        self.event.set()
+
+    def wait(self, timeout):
+        # Returns True if woken by notify, False if the timeout expired
+        woken = self.event.wait(timeout)
+        self.event.clear()
+        return bool(woken)
+
+
+class Scheduler(object):
+    log = logging.getLogger('citrix.Scheduler')
+
+    def __init__(self, poll_interval, channel=None):
+        self.poll_interval = poll_interval
+        self.channel = channel or WakeupChannel('scheduler')
+
+    def notify(self, reason):
+        self.channel.notify(reason)
+
+    def run_once(self, steps):
+        for step in steps:
+            try:
+                step()
+            except Exception, e:
+                self.log.exception(e)
+                # Ignore exception and carry on with the next step
+
+    def wait(self):
+        if not self.channel.wait(self.poll_interval):
+            self.log.debug('Poll interval of %ss expired', self.poll_interval)
+
+    def run_forever(self, steps):
+        while True:
+            self.run_once(steps)
+            self.wait()
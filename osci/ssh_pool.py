@@ -0,0 +1,194 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import paramiko
+
+from osci import common_ssh_options
+from osci.config import Configuration
+
+
+class SSHConnectionPool(object):
+    log = logging.getLogger('citrix.SSHConnectionPool')
+
+    def __init__(self, enabled, control_dir, persist, idle_timeout,
+                 master_timeout=30):
+        self.enabled = enabled
+        self.control_dir = control_dir
+        self.persist = persist
+        self.idle_timeout = idle_timeout
+        self.master_timeout = master_timeout
+        self.clients = {}
+        self.master_locks = {}
+        self.lock = threading.Lock()
+
+    def control_path(self):
+        return os.path.join(self.control_dir, '%r@%h:%p')
+
+    def _make_control_dir(self):
+        if not os.path.isdir(self.control_dir):
+            try:
+                os.makedirs(self.control_dir, 0700)
+            except OSError:
+                # Another thread may have created it already
+                if not os.path.isdir(self.control_dir):
+                    raise
+
+    def ssh_options(self):
+        if not self.enabled:
+            return []
+        self._make_control_dir()
+        # Commands reuse the master's authenticated connection when there
+        # is one, and connect directly when there is not.  They never
+        # become the master themselves: a master forked from a command
+        # keeps that command's stderr open, so reading its output would
+        # wait until the master exits
+        return ['-o', 'ControlMaster=no',
+                '-o', 'ControlPath=%s' % self.control_path()]
+
+    def _master_running(self, target):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(
+                ['ssh', '-o', 'ControlPath=%s' % self.control_path(),
+                 '-O', 'check', target],
+                stdout=devnull, stderr=devnull) == 0
+
+    def start_master(self, host, username, key_filename):
+        if not self.enabled:
+            return
+        target = '%s@%s' % (username, host)
+        with self.lock:
+            master_lock = self.master_locks.setdefault(target,
+                                                       threading.Lock())
+        with master_lock:
+            if self._master_running(target):
+                return
+            self._make_control_dir()
+            self.log.debug('Starting ssh master for %s', target)
+            # ssh -f returns once the master is authenticated; the master
+            # lives on with nothing of ours open until idle for persist secs
+            with open(os.devnull, 'r+') as devnull:
+                process = subprocess.Popen(
+                    ['ssh', '-f', '-N', '-M']
+                    + common_ssh_options.COMMON_SSH_OPTS
+                    + ['-o', 'ControlPath=%s' % self.control_path(),
+                       '-o', 'ControlPersist=%s' % self.persist,
+                       '-i', key_filename, target],
+                    stdin=devnull, stdout=devnull, stderr=devnull,
+                    close_fds=True, preexec_fn=os.setpgrp)
+            deadline = time.time() + self.master_timeout
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                process.wait()
+            if process.returncode != 0:
+                # Not fatal; commands then connect directly
+                self.log.warning('Could not start ssh master for %s (%s)',
+                                 target, process.returncode)
+
+    def _connect(self, host, username, key_filename):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
+        key = paramiko.RSAKey.from_private_key_file(key_filename)
+        ssh.connect(host, username=username, pkey=key)
+        return ssh
+
+    def _is_active(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get_client(self, host, username, key_filename):
+        if not self.enabled:
+            return self._connect(host, username, key_filename)
+
+        # Entries are [client, last used, number of callers holding it]
+        pool_key = (host, username, key_filename)
+        with self.lock:
+            entry = self.clients.get(pool_key)
+            if entry and self._is_active(entry[0]):
+                entry[1] = time.time()
+                entry[2] += 1
+                return entry[0]
+
+        ssh = self._connect(host, username, key_filename)
+        with self.lock:
+            entry = self.clients.get(pool_key)
+            if entry and self._is_active(entry[0]):
+                # Lost a race with another thread; share its connection
+                ssh.close()
+                entry[1] = time.time()
+                entry[2] += 1
+                return entry[0]
+            self.clients[pool_key] = [ssh, time.time(), 1]
+        return ssh
+
+    def release(self, ssh):
+        if not self.enabled:
+            ssh.close()
+            return
+        with self.lock:
+            for entry in self.clients.values():
+                if entry[0] is ssh:
+                    entry[1] = time.time()
+                    entry[2] = max(0, entry[2] - 1)
+                    return
+        # Replaced or evicted while it was held; nobody else can get it
+        ssh.close()
+
+    def _close_entries(self, keys):
+        with self.lock:
+            entries = [self.clients.pop(key) for key in keys
+                       if key in self.clients]
+        for entry in entries:
+            try:
+                entry[0].close()
+            except Exception, e:
+                self.log.exception(e)
+
+    def evict_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        with self.lock:
+            idle = [key for key, entry in self.clients.items()
+                    if entry[2] == 0 and
+                    (entry[1] < cutoff or not self._is_active(entry[0]))]
+        if idle:
+            self.log.debug('Closing idle connections to %s', idle)
+        self._close_entries(idle)
+
+    def evict_host(self, host, username):
+        if not host or not self.enabled:
+            return
+        with self.lock:
+            keys = [key for key in self.clients if key[0] == host]
+        self._close_entries(keys)
+
+        self.log.debug('Stopping ssh master for %s@%s', username, host)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(
+                ['ssh', '-o', 'ControlPath=%s' % self.control_path(),
+                 '-O', 'exit', '%s@%s' % (username, host)],
+                stdout=devnull, stderr=devnull)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            config = Configuration()
+            _pool = SSHConnectionPool(
+                enabled=config.get_bool('SSH_POOL'),
+                control_dir=os.path.expanduser(config.SSH_CONTROL_DIR),
+                persist=config.get_int('SSH_CONTROL_PERSIST'),
+                idle_timeout=config.get_int('SSH_POOL_IDLE'),
+                master_timeout=config.get_int('SSH_MASTER_TIMEOUT'))
+        return _pool
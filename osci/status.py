@@ -0,0 +1,190 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from osci.config import Configuration
+from osci import constants
+from osci import db
+from osci.job import Job
+from osci import reports
+from osci.scheduler import WakeupChannel
+from osci import storage
+from osci import time_services
+
+
+class StatusView(object):
+    def __init__(self, name, render, states=None, recent=None, failed=False,
+                 totals=False):
+        self.name = name
+        self.render = render
+        self.states = states
+        self.recent = recent
+        self.failed = failed
+        # The view prints state and result totals over every job, not
+        # only over the states it lists
+        self.totals = totals
+
+    @property
+    def filename(self):
+        return '%s.txt' % self.name
+
+    def options(self):
+        states = None
+        if self.states is not None:
+            states = ','.join(constants.STATES[state] for state in self.states)
+        return argparse.Namespace(states=states, recent=self.recent)
+
+    def signature(self, database):
+        since = reports.recent_since(self.options())
+        signature = Job.historySignature(database, since, self.states,
+                                         self.failed)
+        if self.totals:
+            for name in ('state', 'result'):
+                # Lists, so the signature compares equal once read back
+                # from the JSON state file
+                signature.append(
+                    [list(item) for item in
+                     sorted(Job.countHistory(database, name, since).items())])
+        return signature
+
+
+VIEWS = [
+    StatusView('current_queue', reports.func_list,
+               states=[constants.RUNNING, constants.QUEUED,
+                       constants.COLLECTING, constants.UPLOADING],
+               totals=True),
+    StatusView('recent_finished', reports.func_list,
+               states=[constants.COLLECTED, constants.FINISHED], recent='24',
+               totals=True),
+    StatusView('all_failures', reports.func_failures, failed=True),
+]
+
+
+class StatusSnapshot(object):
+    log = logging.getLogger('citrix.StatusSnapshot')
+
+    def __init__(self, database, uploader, local_dir, container, prefix,
+                 max_age, views=VIEWS):
+        # The report functions only need .db from the queue they are given
+        self.db = database
+        self.uploader = uploader
+        self.local_dir = local_dir
+        self.container = container
+        self.prefix = prefix
+        self.max_age = max_age
+        self.views = views
+        self.state_file = os.path.join(local_dir, '.status.json')
+        self.state = self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save_state(self):
+        with open(self.state_file, 'w') as state_file:
+            json.dump(self.state, state_file)
+
+    def stale_views(self, now):
+        stale = []
+        for view in self.views:
+            signature = view.signature(self.db)
+            previous = self.state.get(view.name, {})
+            # Ages are part of the report, so refresh those occasionally
+            # even when no job has changed
+            if (signature != previous.get('signature') or
+                    now - previous.get('rendered', 0) >= self.max_age):
+                stale.append((view, signature))
+        return stale
+
+    def refresh(self):
+        if not os.path.isdir(self.local_dir):
+            os.makedirs(self.local_dir)
+        now = time.time()
+        changed = []
+        # Kept apart from self.state until the upload has worked, so a
+        # failed upload is retried on the next pass
+        updates = {}
+        for view, signature in self.stale_views(now):
+            body = view.render(view.options(), self)
+            digest = hashlib.md5(body).hexdigest()
+            entry = dict(self.state.get(view.name, {}))
+            entry['signature'] = signature
+            entry['rendered'] = now
+            updates[view.name] = entry
+            if digest == entry.get('hash'):
+                continue
+            with open(os.path.join(self.local_dir, view.filename), 'w') as f:
+                f.write('%s\n' % time_services.now().strftime(
+                    '%a %b %d %H:%M:%S %Y'))
+                f.write(body)
+            entry['hash'] = digest
+            changed.append(view.filename)
+
+        if changed:
+            self.log.info('Uploading changed status files %s', changed)
+            self.uploader.upload_files(self.local_dir, changed, self.prefix,
+                                       self.container)
+        self.state.update(updates)
+        self.save_state()
+        return changed
+
+
+class StatusThread(threading.Thread):
+    log = logging.getLogger('citrix.StatusThread')
+
+    def __init__(self, snapshot, interval):
+        threading.Thread.__init__(self, name='StatusThread')
+        self.daemon = True
+        self.snapshot = snapshot
+        self.interval = interval
+        self.wakeup = WakeupChannel(self.name)
+
+    def run(self):
+        while True:
+            try:
+                self.snapshot.refresh()
+            except Exception, e:
+                self.log.exception(e)
+            self.wakeup.wait(self.interval)
+
+
+def get_snapshot(database, uploader=None):
+    config = Configuration()
+    return StatusSnapshot(
+        database, uploader or storage.get_backend(),
+        local_dir=config.STATUS_DIR,
+        container=config.STATUS_CONTAINER,
+        prefix=config.STATUS_PREFIX,
+        max_age=config.get_int('STATUS_MAX_AGE'))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Refresh and upload the CI status files that changed')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        default=False, help='enable verbose (debug) logging')
+    return parser
+
+
+def main():
+    parser = get_parser()
+    options = parser.parse_args()
+
+    level = logging.DEBUG if options.verbose else logging.INFO
+    logging.basicConfig(
+        format=u'%(asctime)s %(levelname)s %(name)s %(message)s',
+        level=level)
+
+    for logger_name in ['requests.packages.urllib3.connectionpool',
+                        'swiftclient']:
+        logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+    database = db.DB(Configuration().DATABASE_URL)
+    get_snapshot(database).refresh()
@@ -0,0 +1,354 @@
+import hashlib
+import logging
+import os
+import shutil
+import time
+import zlib
+
+import requests
+
+from osci.config import Configuration
+from osci.workers import WorkerPool
+
+
+def get_content_encoding(filename):
+    if filename.endswith('.gz'):
+        return 'gzip'
+    return None
+
+def get_content_type(filename):
+    split_fn = filename.split('.')
+    if split_fn[-1] in ['gz']:
+        split_fn = split_fn[:-1]
+    if split_fn[-1] in ['txt', 'log', 'conf', 'sh']:
+        return 'text/plain'
+    if split_fn[-1] in ['html']:
+        return 'text/html'
+    return None
+
+_START_STANSA = """
+<html>
+ <head>
+  <title>Test results for %(prefix)s</title>
+ </head>
+ <body>
+  <h1>Test results for %(prefix)s</ht>
+  <table>
+  <tr><th>Name</th><th>Size</th></tr>
+"""
+_FILE_STANSA = """
+  <tr><td><a href="%(filename)s">%(filename)s</a></td><td>%(size)s</td></tr>
+"""
+_END_STANSA = """  </table>
+ </body>
+</html>
+"""
+def _html_start_stansa(prefix):
+    return _START_STANSA % locals()
+
+def _html_file_stansa(filename, size):
+    return _FILE_STANSA % locals()
+
+def _html_end_stansa():
+    return _END_STANSA % locals()
+
+class UploadException(Exception):
+    pass
+
+class SourceError(Exception):
+    # The logs could not be read from where they are; uploading them
+    # again will not help
+    pass
+
+class SourceReader(object):
+    def __init__(self, name, fileobj):
+        self.name = name
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        try:
+            return self.fileobj.read(size)
+        except Exception, e:
+            raise SourceError('Cannot read %s: %s' % (self.name, e))
+
+    def close(self):
+        self.fileobj.close()
+
+def iter_chunks(fileobj, checksum, chunk_size=65536):
+    # The checksum is built from the same reads that feed the upload, so
+    # each file is only read once
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        checksum.update(chunk)
+        yield chunk
+
+def iter_gzipped(fileobj, checksum, level=6, chunk_size=65536):
+    # Compresses as the upload reads, so no compressed copy is written
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        data = compressor.compress(chunk)
+        if data:
+            checksum.update(data)
+            yield data
+    data = compressor.flush()
+    checksum.update(data)
+    yield data
+
+def order_for_index(filenames):
+    filenames = sorted(filenames)
+    if 'run_tests.log' in filenames:
+        filenames.remove('run_tests.log')
+        filenames.insert(0, 'run_tests.log')
+    return filenames
+
+
+class StorageBackend(object):
+    """Upload path shared by the storage backends.
+
+    A backend provides:
+      get_container(container_name=None): the container to upload to
+      put_stream(container, fileobj, name, size, target): store one file
+      store_index(container, target, contents): store the results.html page
+      get_url(container, container_name, target): public URL of an object
+    """
+    logger = logging.getLogger('citrix.storage')
+
+    # Capabilities; the upload path only uses what a backend declares
+    parallel_put = False
+    content_encoding = False
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = Configuration().get_int('UPLOAD_WORKERS')
+        if not self.parallel_put:
+            workers = 1
+        self.pool = WorkerPool('%s-upload' % self.__class__.__name__, workers)
+
+    def should_compress(self, name, size):
+        config = Configuration()
+        if not self.content_encoding or not config.get_bool('COMPRESS_LOGS'):
+            return False
+        if get_content_encoding(name) or not get_content_type(name):
+            return False
+        return size >= config.get_int('COMPRESS_THRESHOLD')
+
+    def read_body(self, fileobj, name, size, checksum):
+        # Returns the Content-Encoding of the body along with it; the
+        # Content-Type stays that of the original so browsers show it inline
+        if self.should_compress(name, size):
+            level = Configuration().get_int('COMPRESS_LEVEL')
+            return 'gzip', iter_gzipped(fileobj, checksum, level)
+        return get_content_encoding(name), iter_chunks(fileobj, checksum)
+
+    def put_file(self, container, source, target):
+        with open(source, 'rb') as fileobj:
+            self.put_stream(container, fileobj, source,
+                            os.path.getsize(source), target)
+
+    def default_container(self, container_name):
+        # SWIFT_CONTAINER predates the other backends and names the
+        # container for all of them
+        return container_name or Configuration().SWIFT_CONTAINER
+
+    def with_retries(self, description, func, *args):
+        attempts = Configuration().get_int('SWIFT_UPLOAD_ATTEMPTS')
+        delay = Configuration().get_int('UPLOAD_RETRY_DELAY')
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except SourceError:
+                raise
+            except Exception, e:
+                self.logger.error('Upload of %s failed: %s'%(description, e))
+            if attempt >= attempts:
+                raise UploadException('Failed to upload %s'%description)
+            time.sleep(delay * (2 ** attempt))
+            attempt += 1
+
+    def upload_one_file(self, container, source, target):
+        self.logger.info('Uploading %s to %s', source, target)
+        self.with_retries(source, self.put_file, container, source, target)
+
+    def upload_one_stream(self, container, name, size, opener, target):
+        # opener returns a fresh file object for each attempt, or raises
+        # UploadException if the stream cannot be replayed
+        def attempt():
+            try:
+                fileobj = SourceReader(name, opener())
+            except UploadException:
+                raise
+            except Exception, e:
+                raise SourceError('Cannot open %s: %s' % (name, e))
+            try:
+                self.put_stream(container, fileobj, name, size, target)
+            finally:
+                fileobj.close()
+        self.logger.info('Streaming %s to %s', name, target)
+        self.with_retries(name, attempt)
+
+    def upload_all(self, container, sources, targets):
+        tasks = [self.pool.submit(self.upload_one_file, container,
+                                  source, target)
+                 for source, target in zip(sources, targets)]
+        failed = []
+        for source, task in zip(sources, tasks):
+            task.wait()
+            if task.exception is not None:
+                failed.append(source)
+        if failed:
+            raise UploadException('Failed to upload %s'%', '.join(failed))
+
+    def upload_files(self, local_dir, filenames, cf_prefix,
+                     container_name=None):
+        container = self.get_container(container_name)
+        self.upload_all(container,
+                        [os.path.join(local_dir, filename)
+                         for filename in filenames],
+                        ["%s/%s"%(cf_prefix, filename)
+                         for filename in filenames])
+
+    def store_results_index(self, container, container_name, cf_prefix,
+                            sizes):
+        contents = _html_start_stansa(cf_prefix)
+        for filename in order_for_index(sizes.keys()):
+            contents = contents + _html_file_stansa(filename, sizes[filename])
+        contents = contents + _html_end_stansa()
+        index = '%s/results.html'%cf_prefix
+        self.store_index(container, index, contents)
+
+        result_url = self.get_url(container, container_name, index)
+        self.logger.info('Result URL: %s', result_url)
+        return result_url
+
+    def upload(self, local_dir, cf_prefix, container_name=None):
+        container = self.get_container(container_name)
+
+        sizes = {}
+        sources = []
+        targets = []
+        for filename in order_for_index(os.listdir(local_dir)):
+            full_path = os.path.join(local_dir, filename)
+
+            stats = os.stat(full_path)
+            sizes[filename] = stats.st_size
+
+            sources.append(full_path)
+            targets.append("%s/%s"%(cf_prefix, filename))
+        self.upload_all(container, sources, targets)
+
+        return self.store_results_index(container, container_name, cf_prefix,
+                                        sizes)
+
+    def upload_streams(self, entries, cf_prefix, container_name=None):
+        """Upload (filename, size, opener) entries straight from their source.
+
+        Each stream is read once, in order, with only a chunk of it held in
+        memory at a time.
+        """
+        container = self.get_container(container_name)
+        sizes = {}
+        for filename, size, opener in entries:
+            self.upload_one_stream(container, filename, size, opener,
+                                   "%s/%s"%(cf_prefix, filename))
+            sizes[filename] = size
+        return self.store_results_index(container, container_name, cf_prefix,
+                                        sizes)
+
+
+class LocalStorage(StorageBackend):
+    parallel_put = True
+
+    def __init__(self, root, base_url=None, workers=None):
+        StorageBackend.__init__(self, workers)
+        self.root = root
+        self.base_url = base_url or 'file://%s' % os.path.abspath(root)
+
+    def get_container(self, container_name=None):
+        return os.path.join(self.root, self.default_container(container_name))
+
+    def _path(self, container, target):
+        path = os.path.join(container, target)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another upload worker may have created it already
+                if not os.path.isdir(directory):
+                    raise
+        return path
+
+    def put_stream(self, container, fileobj, name, size, target):
+        with open(self._path(container, target), 'wb') as target_file:
+            shutil.copyfileobj(fileobj, target_file)
+
+    def store_index(self, container, target, contents):
+        with open(self._path(container, target), 'w') as index:
+            index.write(contents)
+
+    def get_url(self, container, container_name, target):
+        return '%s/%s/%s' % (self.base_url,
+                             self.default_container(container_name), target)
+
+
+class HTTPStorage(StorageBackend):
+    parallel_put = True
+    content_encoding = True
+
+    def __init__(self, base_url, workers=None, timeout=300):
+        StorageBackend.__init__(self, workers)
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def get_container(self, container_name=None):
+        return '%s/%s' % (self.base_url,
+                          self.default_container(container_name))
+
+    def _put(self, url, data, headers):
+        response = self.session.put(url, data=data, headers=headers,
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def put_stream(self, container, fileobj, name, size, target):
+        headers = {}
+        checksum = hashlib.md5()
+        content_encoding, body = self.read_body(fileobj, name, size, checksum)
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+        content_type = get_content_type(name)
+        if content_type:
+            headers['Content-Type'] = content_type
+        response = self._put('%s/%s' % (container, target), body, headers)
+        # Only servers that return an ETag can be checked
+        etag = response.headers.get('ETag', '').strip('"')
+        if etag and etag != checksum.hexdigest():
+            raise UploadException('Checksum mismatch for %s' % target)
+
+    def store_index(self, container, target, contents):
+        self._put('%s/%s' % (container, target), contents,
+                  {'Content-Type': 'text/html'})
+
+    def get_url(self, container, container_name, target):
+        return '%s/%s' % (container, target)
+
+
+def get_backend(name=None):
+    config = Configuration()
+    name = name or config.STORAGE_BACKEND
+    if name == 'swift':
+        from osci import swift_upload
+        return swift_upload.SwiftUploader()
+    if name == 'local':
+        return LocalStorage(os.path.expanduser(config.STORAGE_LOCAL_DIR),
+                            config.STORAGE_LOCAL_URL)
+    if name == 'http':
+        return HTTPStorage(config.STORAGE_HTTP_URL)
+    raise ValueError('Unknown storage backend %s' % name)
@@ -1,9 +1,14 @@
+import datetime
+import hashlib
 import logging
 import optparse
-import os
 import sys
+import threading
 
 from osci.config import Configuration
+from osci.storage import StorageBackend, UploadException
+from osci.storage import get_content_type
+from osci import storage
 import pyrax.exceptions
 import pyrax
 
@@ -18,104 +23,68 @@ def get_parser():
 
     return parser
 
-def get_content_encoding(filename):
-    if filename.endswith('.gz'):
-        return 'gzip'
-    return None
-
-def get_content_type(filename):
-    split_fn = filename.split('.')
-    if split_fn[-1] in ['gz']:
-        split_fn = split_fn[:-1]
-    if split_fn[-1] in ['txt', 'log', 'conf', 'sh']:
-        return 'text/plain'
-    if split_fn[-1] in ['html']:
-        return 'text/html'
-    return None
-
-_START_STANSA = """
-<html>
- <head>
-  <title>Test results for %(prefix)s</title>
- </head>
- <body>
-  <h1>Test results for %(prefix)s</ht>
-  <table>
-  <tr><th>Name</th><th>Size</th></tr>
-"""
-_FILE_STANSA = """
-  <tr><td><a href="%(filename)s">%(filename)s</a></td><td>%(size)s</td></tr>
-"""
-_END_STANSA = """  </table>
- </body>
-</html>
-"""
-def _html_start_stansa(prefix):
-    return _START_STANSA % locals()
-
-def _html_file_stansa(filename, size):
-    return _FILE_STANSA % locals()
-
-def _html_end_stansa():
-    return _END_STANSA % locals()
-
-class UploadException(Exception):
-    pass
-
-class SwiftUploader(object):
+class SwiftUploader(StorageBackend):
     logger = logging.getLogger('citrix.swiftupload')
 
-    def upload_one_file(self, container, source, target, attempt=0):
-        self.logger.info('Uploading %s to %s', source, target)
-        chksum = pyrax.utils.get_checksum(source)
-        content_encoding=get_content_encoding(source)
-        content_type=get_content_type(source)
-
-        obj = container.upload_file(source, target,
-                                    content_encoding=content_encoding,
-                                    content_type=content_type, etag=chksum)
-        if chksum != obj.etag:
-            if attempt < Configuration().get_int('SWIFT_UPLOAD_ATTEMPTS'):
-                self.logger.error('Upload of %s to %s failed - retrying'%(source, target))
-                self.upload_one_file(container, source, target, attempt+1)
-            else:
-                raise UploadException('Failed to upload %s'%source)
-
-    def upload(self, local_dir, cf_prefix, container_name=None):
+    parallel_put = True
+    content_encoding = True
+
+    def __init__(self, workers=None):
+        StorageBackend.__init__(self, workers)
+        # One uploader is shared by all the collection workers
+        self.lock = threading.Lock()
+        self.expires = None
+        self.containers = {}
+        self.cdn_uris = {}
+
+    def put_stream(self, container, fileobj, name, size, target):
+        checksum = hashlib.md5()
+        content_encoding, body = self.read_body(fileobj, name, size, checksum)
+        obj = container.create(data=body, obj_name=target, chunked=True,
+                               content_encoding=content_encoding,
+                               content_type=get_content_type(name))
+        if checksum.hexdigest() != obj.etag:
+            raise UploadException('Checksum mismatch for %s' % target)
+
+    def authenticate(self):
+        refresh = datetime.timedelta(
+            seconds=Configuration().get_int('SWIFT_TOKEN_REFRESH'))
+        if (self.expires is not None and
+                datetime.datetime.now() < self.expires - refresh):
+            return
+        self.logger.info('Authenticating to Swift')
         pyrax.set_setting('identity_type', 'rackspace')
         try:
             pyrax.set_credentials(Configuration().SWIFT_USERNAME, Configuration().SWIFT_API_KEY)
         except pyrax.exceptions.AuthenticationFailed, e:
             self.logger.exception(e)
             raise
-        cf = pyrax.cloudfiles
-
-        if not container_name:
-            container_name = Configuration().SWIFT_CONTAINER
-        container = cf.create_container(container_name)
-
-        contents = _html_start_stansa(cf_prefix)
-        filenames = os.listdir(local_dir)
-        filenames.sort()
-        if 'run_tests.log' in filenames:
-            filenames.remove('run_tests.log')
-            filenames.insert(0, 'run_tests.log')
-        for filename in filenames:
-            full_path = os.path.join(local_dir, filename)
-
-            stats = os.stat(full_path)
-            contents = contents + _html_file_stansa(filename, stats.st_size)
-
-            cf_name = "%s/%s"%(cf_prefix, filename)
-            self.upload_one_file(container, full_path, cf_name)
-
-        contents = contents + _html_end_stansa()
-        container.store_object('%s/results.html'%cf_prefix, contents)
-
-        uri = container.cdn_uri
-        result_url = "%s/%s/results.html"%(uri, cf_prefix)
-        self.logger.info('Result URL: %s', result_url)
-        return result_url
+        self.expires = pyrax.identity.expires
+        # Containers hold the client they were created with
+        self.containers = {}
+
+    def get_container(self, container_name=None):
+        container_name = self.default_container(container_name)
+        with self.lock:
+            self.authenticate()
+            container = self.containers.get(container_name)
+            if container is None:
+                container = pyrax.cloudfiles.create_container(container_name)
+                self.containers[container_name] = container
+            return container
+
+    def get_cdn_uri(self, container, container_name=None):
+        container_name = self.default_container(container_name)
+        with self.lock:
+            if container_name not in self.cdn_uris:
+                self.cdn_uris[container_name] = container.cdn_uri
+            return self.cdn_uris[container_name]
+
+    def store_index(self, container, target, contents):
+        container.store_object(target, contents)
+
+    def get_url(self, container, container_name, target):
+        return "%s/%s"%(self.get_cdn_uri(container, container_name), target)
 
 
 def main():
@@ -134,7 +103,7 @@ def main():
     local_dir = args[0]
     cf_prefix = args[1]
 
-    SwiftUploader().upload(local_dir, cf_prefix, options.container)
+    storage.get_backend().upload(local_dir, cf_prefix, options.container)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,187 @@
+import datetime
+import json
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import yaml
+
+from osci import capacity
+from osci import constants
+from osci import db
+from osci.job import Job
+from osci import time_services
+
+
+class TestWriteAtomically(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'nodepool.yaml')
+
+    def _mode(self):
+        return os.stat(self.path).st_mode & 0777
+
+    def test_new_file_readable(self):
+        capacity.write_atomically(self.path, 'data')
+
+        with open(self.path) as f:
+            self.assertEquals('data', f.read())
+        self.assertEquals(0644, self._mode())
+        self.assertEquals([], [name for name in os.listdir(self.tmpdir)
+                               if name.startswith('.tmp-')])
+
+    def test_mode_of_replaced_file_kept(self):
+        with open(self.path, 'w') as f:
+            f.write('old')
+        os.chmod(self.path, 0640)
+
+        capacity.write_atomically(self.path, 'new')
+
+        with open(self.path) as f:
+            self.assertEquals('new', f.read())
+        self.assertEquals(0640, self._mode())
+
+
+class TestMeasureDemand(unittest.TestCase):
+    def setUp(self):
+        self.database = db.DB('sqlite://')
+        self.database.create_schema()
+
+    def _add_job(self, change_num, state, created, started=None,
+                 stopped=None):
+        with self.database.get_session() as session:
+            job = Job(change_num=change_num, project_name='project',
+                      change_ref='refs/changes/%s/1' % change_num)
+            job.state = state
+            job.created = created
+            job.test_started = started
+            job.test_stopped = stopped
+            session.add(job)
+
+    def test_demand(self):
+        now = time_services.now()
+        hour = datetime.timedelta(hours=1)
+        self._add_job('1', constants.QUEUED, now)
+        self._add_job('2', constants.QUEUED, now)
+        self._add_job('3', constants.RUNNING, now, started=now)
+        self._add_job('4', constants.FINISHED, now - 3 * hour,
+                      started=now - 3 * hour, stopped=now - 2 * hour)
+        self._add_job('5', constants.FINISHED, now - 3 * hour,
+                      started=now - 3 * hour, stopped=now - hour)
+
+        demand = capacity.measure_demand(self.database, 'image', 1800, 10)
+
+        self.assertEquals(2, demand['queued'])
+        self.assertEquals(1, demand['running'])
+        self.assertEquals({'Queued': 2, 'Running': 1, 'Finished': 2},
+                          demand['states'])
+        self.assertEquals(6.0, demand['arrivals_per_hour'])
+        self.assertEquals(5400.0, demand['mean_duration'])
+        self.assertEquals(2, demand['duration_samples'])
+
+    def test_empty(self):
+        demand = capacity.measure_demand(self.database, 'image', 3600, 10)
+
+        self.assertEquals((0, 0.0, None),
+                          (demand['queued'], demand['arrivals_per_hour'],
+                           demand['mean_duration']))
+
+    def test_published_to_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'sub', 'demand.json')
+        self._add_job('1', constants.QUEUED, time_services.now())
+
+        publisher = capacity.DemandPublisher(self.database, path, 'image',
+                                             3600, 10)
+        publisher.publish()
+
+        self.assertEquals(1, capacity.read_demand(path)['queued'])
+        self.assertEquals(['demand.json'], os.listdir(os.path.dirname(path)))
+
+
+class TestCapacityController(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.config_path = os.path.join(tmpdir, 'nodepool.yaml')
+
+    def _write_config(self, config):
+        with open(self.config_path, 'w') as config_file:
+            yaml.safe_dump(config, config_file)
+
+    def _read_config(self):
+        with open(self.config_path) as config_file:
+            return yaml.safe_load(config_file)
+
+    def _controller(self, minimum=1, maximum=10):
+        return capacity.CapacityController(self.config_path, 'XSDSVM',
+                                           minimum, maximum, 900, 600)
+
+    def _demand(self, queued=0, rate=0.0, age=0):
+        return {'queued': queued, 'arrivals_per_hour': rate,
+                'generated': time.time() - age}
+
+    def test_target_follows_demand(self):
+        controller = self._controller()
+        self.assertEquals(1, controller.target(self._demand()))
+        # 10 an hour arrive in the 15 minutes a node takes to build
+        self.assertEquals(6, controller.target(self._demand(3, 10.0)))
+        self.assertEquals(10, controller.target(self._demand(30, 10.0)))
+
+    def test_labels_adjusted(self):
+        self._write_config({
+            'labels': [{'name': 'XSDSVM', 'min-ready': 1},
+                       {'name': 'other', 'min-ready': 7}],
+            'providers': [{'name': 'rax'}]})
+
+        self.assertEquals(4, self._controller().apply(self._demand(4)))
+
+        config = self._read_config()
+        self.assertEquals([4, 7], [label['min-ready']
+                                   for label in config['labels']])
+
+    def test_split_between_provider_images(self):
+        self._write_config({'providers': [
+            {'name': 'iad', 'images': [{'name': 'XSDSVM', 'min-ready': 1}]},
+            {'name': 'dfw', 'images': [{'name': 'XSDSVM', 'min-ready': 1},
+                                       {'name': 'other', 'min-ready': 2}]},
+        ]})
+
+        self._controller().apply(self._demand(5))
+
+        config = self._read_config()
+        self.assertEquals([3, 2, 2],
+                          [image['min-ready']
+                           for provider in config['providers']
+                           for image in provider['images']])
+
+    def test_unchanged_config_not_rewritten(self):
+        self._write_config({'labels': [{'name': 'XSDSVM', 'min-ready': 4}]})
+
+        with mock.patch.object(capacity, 'write_atomically') as mock_write:
+            self.assertEquals(4, self._controller().apply(self._demand(4)))
+            self.assertEquals(0, mock_write.call_count)
+
+    def test_stale_demand_ignored(self):
+        self._write_config({'labels': [{'name': 'XSDSVM', 'min-ready': 1}]})
+
+        self.assertEquals(None,
+                          self._controller().apply(self._demand(4, age=3600)))
+        self.assertEquals(1, self._read_config()['labels'][0]['min-ready'])
+
+    def test_dry_run(self):
+        self._write_config({'labels': [{'name': 'XSDSVM', 'min-ready': 1}]})
+
+        self.assertEquals(
+            4, self._controller().apply(self._demand(4), dry_run=True))
+        self.assertEquals(1, self._read_config()['labels'][0]['min-ready'])
+
+    def test_unknown_image(self):
+        self._write_config({'labels': [{'name': 'other', 'min-ready': 1}]})
+
+        self.assertEquals(None, self._controller().apply(self._demand(4)))
@@ -0,0 +1,50 @@
+import unittest
+import urllib2
+
+import mock
+
+from osci import completion
+
+
+class TestCompletionListener(unittest.TestCase):
+    def setUp(self):
+        self.queue = mock.Mock()
+        self.listener = completion.CompletionListener(self.queue, 0,
+                                                      host='127.0.0.1')
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.stop()
+
+    def _post(self, path):
+        url = 'http://127.0.0.1:%s%s' % (self.listener.port, path)
+        try:
+            return urllib2.urlopen(url, data='').getcode()
+        except urllib2.HTTPError, e:
+            return e.code
+
+    def test_completion_accepted(self):
+        self.queue.markCompleted.return_value = True
+        self.assertEquals(200, self._post('/done/12/abc123'))
+        self.queue.markCompleted.assert_called_once_with(12, 'abc123')
+
+    def test_completion_rejected(self):
+        self.queue.markCompleted.return_value = False
+        self.assertEquals(404, self._post('/done/12/abc123'))
+
+    def test_get_not_allowed(self):
+        url = 'http://127.0.0.1:%s/done/12/abc123' % self.listener.port
+        try:
+            code = urllib2.urlopen(url).getcode()
+        except urllib2.HTTPError, e:
+            code = e.code
+        self.assertEquals(501, code)
+        self.assertEquals(0, self.queue.markCompleted.call_count)
+
+    def test_bad_path(self):
+        self.assertEquals(404, self._post('/something/else'))
+        self.assertEquals(0, self.queue.markCompleted.call_count)
+
+    def test_queue_error_rejected(self):
+        self.queue.markCompleted.side_effect = Exception('db down')
+        self.assertEquals(404, self._post('/done/12/abc123'))
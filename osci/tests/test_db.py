@@ -23,3 +23,55 @@ class TestDB(unittest.TestCase):
             self.assertEquals(
                 [("12",)], session.execute("SELECT * FROM A").fetchall())
 
+
+    def test_create_schema_adds_missing_indexes(self):
+        database = db.DB("sqlite://")
+        database.create_schema()
+        with database.get_session() as session:
+            session.execute("DROP INDEX ix_test_state_updated")
+
+        database.create_schema()
+
+        names = [index['name'] for index in
+                 db.inspect(database.engine).get_indexes('test')]
+        self.assertTrue('ix_test_state_updated' in names)
+        self.assertTrue('ix_test_project_change_state' in names)
+
+    def test_nested_sessions_commit_once(self):
+        database = db.DB("sqlite://")
+        database.create_schema()
+
+        with database.unit_of_work() as outer:
+            with database.get_session() as inner:
+                self.assertTrue(inner is outer)
+                inner.execute("INSERT INTO test (id) VALUES (1)")
+            self.assertTrue(outer.is_active)
+            outer.execute("INSERT INTO test (id) VALUES (2)")
+
+        with database.get_session() as session:
+            self.assertEquals(
+                2, session.execute("SELECT COUNT(*) FROM test").scalar())
+
+    def test_exception_rolls_back_unit_of_work(self):
+        database = db.DB("sqlite://")
+        database.create_schema()
+
+        try:
+            with database.unit_of_work():
+                with database.get_session() as session:
+                    session.execute("INSERT INTO test (id) VALUES (1)")
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with database.get_session() as session:
+            self.assertEquals(
+                0, session.execute("SELECT COUNT(*) FROM test").scalar())
+
+    def test_session_is_released_after_use(self):
+        database = db.DB("sqlite://")
+
+        with database.get_session() as first:
+            pass
+        with database.get_session() as second:
+            self.assertFalse(first is second)
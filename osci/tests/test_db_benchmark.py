@@ -0,0 +1,26 @@
+import unittest
+
+from osci import db
+from osci import db_benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_reports_each_size(self):
+        database = db.DB('sqlite://')
+        database.create_schema()
+
+        table = db_benchmark.run(database, [10, 20], 1)
+
+        self.assertEquals(2, len(table._rows))
+        self.assertEquals([10, 20], [row[0] for row in table._rows])
+
+    def test_history_does_not_add_active_jobs(self):
+        database = db.DB('sqlite://')
+        database.create_schema()
+        db_benchmark.add_active_jobs(database)
+        db_benchmark.fill(database, 0, 50)
+
+        from osci.job import Job
+        from osci import constants
+        self.assertEquals(
+            10, len(Job.getAllWhere(database, state=constants.QUEUED)))
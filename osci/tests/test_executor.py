@@ -1,3 +1,5 @@
+import tempfile
+import time
 import unittest
 
 from osci import executor
@@ -9,3 +11,86 @@ class TestExecutorFactory(unittest.TestCase):
         self.assertEquals('PrintExecutor', exc.__class__.__name__)
 
 
+
+
+class TestOutputBuffer(unittest.TestCase):
+    def test_keeps_last_bytes(self):
+        buf = executor.OutputBuffer(5)
+        buf.write('abc')
+        buf.write('defg')
+        buf.write('h')
+
+        self.assertEquals('defgh', buf.getvalue())
+        self.assertEquals(3, buf.dropped)
+
+    def test_under_limit(self):
+        buf = executor.OutputBuffer(10)
+        buf.write('abc')
+        self.assertEquals('abc', buf.getvalue())
+        self.assertEquals(0, buf.dropped)
+
+
+class TestRunCommand(unittest.TestCase):
+    def test_output_captured(self):
+        result = executor.run_command(['sh', '-c', 'echo out; echo err >&2'])
+
+        self.assertEquals((0, 'out\n', 'err\n', False),
+                          (result.returncode, result.stdout, result.stderr,
+                           result.timed_out))
+
+    def test_stdin_data(self):
+        data = 'x' * 200000
+        result = executor.run_command(['cat'], stdin_data=data)
+        self.assertEquals(data, result.stdout)
+
+    def test_output_bounded(self):
+        result = executor.run_command(
+            ['sh', '-c', 'head -c 100000 /dev/zero; echo end'], limit=10)
+        self.assertEquals(10, len(result.stdout))
+        self.assertTrue(result.stdout.endswith('end\n'))
+
+    def test_output_to_file(self):
+        with tempfile.TemporaryFile() as output:
+            result = executor.run_command(['echo', 'hello'], stdout=output)
+            output.seek(0)
+            self.assertEquals('hello\n', output.read())
+        self.assertEquals(None, result.stdout)
+
+    def test_timeout_kills_process_group(self):
+        start = time.time()
+        # The background sleep keeps stdout open after the shell dies
+        result = executor.run_command(['sh', '-c', 'sleep 30 & sleep 30'],
+                                      timeout=0.2)
+
+        self.assertTrue(result.timed_out)
+        self.assertEquals(-9, result.returncode)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_many_run_together(self):
+        start = time.time()
+        results = executor.run_many(
+            [executor.Command(['sh', '-c', 'sleep 0.5; echo %d' % i])
+             for i in range(4)])
+
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEquals(['0\n', '1\n', '2\n', '3\n'],
+                          [result.stdout for result in results])
+
+    def test_one_timeout_does_not_stop_others(self):
+        results = executor.run_many(
+            [executor.Command(['sleep', '10'], timeout=0.2),
+             executor.Command(['echo', 'done'], timeout=10)])
+
+        self.assertEquals([True, False],
+                          [result.timed_out for result in results])
+        self.assertEquals('done\n', results[1].stdout)
+
+
+class TestRealExecutor(unittest.TestCase):
+    def test_returns_code(self):
+        self.assertEquals(3, executor.RealExecutor().run(
+            ['sh', '-c', 'exit 3']))
+
+    def test_timeout(self):
+        self.assertEquals(-9, executor.RealExecutor(timeout=0.2).run(
+            ['sleep', '10']))
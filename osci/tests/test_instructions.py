@@ -16,3 +16,10 @@ class TestCheckOutTestRunner(unittest.TestCase):
             '/home/jenkins/xenapi-os-testing/run_tests.sh'.split(),
             instructions.execute_test_runner()
         )
+
+    def test_bootstrap_contains_environment(self):
+        script = instructions.bootstrap_test_runner(['line1', 'line2'], 10)
+        self.assertTrue(
+            "OSCI_ENV_EOF'\nline1\nline2\nOSCI_ENV_EOF\n" in script)
+        self.assertTrue(instructions.BOOTSTRAP_READY in script)
+        self.assertTrue('seq 50' in script)
@@ -1,9 +1,12 @@
 import mock
+import shutil
+import tempfile
 import unittest
 import time
 import datetime
 
 from osci import constants
+from osci import storage
 from osci import utils
 from osci.job import Job
 from osci.config import Configuration
@@ -86,7 +89,131 @@ class TestDBMethods(unittest.TestCase):
         self.assertEquals("project", job.project_name)
         self.assertEquals("change_num", job.change_num)
 
+    def test_update_after_query(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        with db.get_session() as session:
+            session.add(Job(change_num="1", project_name="project"))
+
+        job, = Job.getAllWhere(db, change_num="1")
+        job.update(db, state=constants.RUNNING, node_ip='ip')
+
+        job, = Job.getAllWhere(db, change_num="1")
+        self.assertEquals(constants.RUNNING, job.state)
+        self.assertEquals('ip', job.node_ip)
+
+    def test_archive_in_batches(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        with db.get_session() as session:
+            for num in range(3):
+                job = Job(change_num=str(num), project_name="project")
+                job.state = constants.FINISHED
+                session.add(job)
+
+        archived = Job.archiveFinished(
+            db, datetime.datetime.now() + datetime.timedelta(days=1), 1)
+
+        self.assertEquals(3, archived)
+        self.assertEquals([], Job.getAllWhere(db))
+        self.assertEquals(3, len(Job.getHistoryWhere(db, project_name="project")))
+
+    def test_archive_reused_id(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        before = datetime.datetime.now() + datetime.timedelta(days=1)
+        for num in ['1', '2']:
+            with db.get_session() as session:
+                job = Job(change_num=num, project_name="project")
+                job.id = 7
+                job.state = constants.FINISHED
+                session.add(job)
+            Job.archiveFinished(db, before, 10)
+
+        jobs = Job.getHistoryWhere(db, project_name="project")
+        self.assertEquals([7, 7], [job.id for job in jobs])
+        self.assertEquals(['1', '2'], sorted(job.change_num for job in jobs))
+
+    def _add_history(self, db):
+        now = datetime.datetime.now()
+        with db.get_session() as session:
+            for num, state, result, hours in [
+                    ('1', constants.FINISHED, 'Failed', 30),
+                    ('2', constants.FINISHED, 'Passed', 20),
+                    ('3', constants.FINISHED, 'Aborted: No IP', 2),
+                    ('4', constants.RUNNING, None, 1)]:
+                job = Job(change_num=num, project_name="project")
+                job.state = state
+                job.result = result
+                job.updated = now - datetime.timedelta(hours=hours)
+                session.add(job)
+        Job.archiveFinished(db, now - datetime.timedelta(hours=10), 10)
+
+    def test_iter_history_merges_archive_in_update_order(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        self._add_history(db)
+
+        self.assertEquals(
+            ['1', '2', '3', '4'],
+            [job.change_num for job in Job.iterHistory(db, batch_size=1)])
+        self.assertEquals(
+            ['1', '3'],
+            [job.change_num for job in Job.iterHistory(db, failed=True)])
+        self.assertEquals(
+            ['3'],
+            [job.change_num for job in Job.iterHistory(
+                db, since=datetime.datetime.now() - datetime.timedelta(hours=5),
+                states=[constants.FINISHED])])
+
+    def test_iter_history_pages_through_equal_updates(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        now = datetime.datetime.now()
+        with db.get_session() as session:
+            for num in range(5):
+                job = Job(change_num=str(num), project_name="project")
+                job.updated = now
+                session.add(job)
+
+        self.assertEquals(
+            ['0', '1', '2', '3', '4'],
+            [job.change_num for job in Job.iterHistory(db, batch_size=2)])
+
+    def test_count_history(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        self._add_history(db)
+
+        self.assertEquals({constants.FINISHED: 3, constants.RUNNING: 1},
+                          Job.countHistory(db, 'state'))
+        self.assertEquals(
+            {'Aborted: No IP': 1, None: 1},
+            Job.countHistory(db, 'result', since=datetime.datetime.now() -
+                             datetime.timedelta(hours=5)))
+
+    def test_get_all_in_states(self):
+        db = DB('sqlite://')
+        db.create_schema()
+        with db.get_session() as session:
+            for num, state in enumerate([constants.QUEUED, constants.RUNNING,
+                                         constants.FINISHED]):
+                job = Job(change_num=str(num), project_name="project")
+                job.state = state
+                session.add(job)
+
+        jobs = Job.getAllInStates(db, [constants.QUEUED, constants.FINISHED])
+
+        self.assertEquals(['0', '2'], sorted(job.change_num for job in jobs))
+
+
 class TestRun(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('osci.ssh_pool.get_pool')
+        self.mock_get_pool = patcher.start()
+        self.mock_get_pool.return_value.ssh_options.return_value = []
+        self.addCleanup(patcher.stop)
+
     @mock.patch.object(Job, 'update')
     @mock.patch.object(utils, 'getSSHObject')
     def test_runTest_deletes_existing_node(self, mock_getSSHObject, mock_update):
@@ -125,7 +252,7 @@ class TestRun(unittest.TestCase):
 
         nodepool = mock.Mock()
         nodepool.getNode.return_value = ('new_node', 'ip')
-        ssh = mock.Mock()
+        mock_execute_command.return_value = (0, 'OSCI-BOOTSTRAP-READY 42\n', '')
 
         job.runJob("DB", nodepool)
 
@@ -135,6 +262,76 @@ class TestRun(unittest.TestCase):
         update_call1 = mock.call("DB", node_id='new_node', result='', node_ip='ip')
         update_call2 = mock.call("DB", state=constants.RUNNING)
         mock_update.assert_has_calls([update_call1, update_call2])
+        # No fixed sleep; testSSH plus a single bootstrap round trip
+        self.assertEqual(0, mock_sleep.call_count)
+        self.assertEqual(2, mock_execute_command.call_count)
+        self.mock_get_pool.return_value.start_master.assert_called_once_with(
+            'ip', 'jenkins', Configuration().NODE_KEY)
+
+    @mock.patch.object(Job, 'update')
+    @mock.patch.object(utils, 'execute_command')
+    def test_runTest_uses_allocated_node(self, mock_execute_command,
+                                         mock_update):
+        job = Job(change_num="change_num", project_name="project")
+
+        nodepool = mock.Mock()
+        mock_execute_command.return_value = (0, 'OSCI-BOOTSTRAP-READY 42\n', '')
+
+        job.runJob("DB", nodepool, ('allocated_node', 'ip'))
+
+        self.assertEqual(0, nodepool.getNode.call_count)
+        mock_update.assert_any_call("DB", node_id='allocated_node',
+                                    result='', node_ip='ip')
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch.object(Job, 'update')
+    @mock.patch.object(utils, 'execute_command')
+    def test_runTest_skips_check_of_validated_node(self, mock_execute_command,
+                                                   mock_update, mock_conf_file):
+        mock_conf_file.return_value = 'VALIDATE_NODES=True'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        job = Job(change_num="change_num", project_name="project")
+
+        nodepool = mock.Mock()
+        nodepool.isValidated.return_value = True
+        mock_execute_command.return_value = (0, 'OSCI-BOOTSTRAP-READY 42\n', '')
+
+        job.runJob("DB", nodepool, ('new_node', 'ip'))
+
+        nodepool.isValidated.assert_called_once_with('new_node')
+        # Only the bootstrap; no testSSH
+        self.assertEqual(1, mock_execute_command.call_count)
+        mock_update.assert_called_with("DB", state=constants.RUNNING)
+
+    @mock.patch.object(Job, 'update')
+    @mock.patch.object(utils, 'execute_command')
+    def test_runTest_bootstrap_fails(self, mock_execute_command, mock_update):
+        job = Job(change_num="change_num", project_name="project")
+
+        nodepool = mock.Mock()
+        nodepool.getNode.return_value = ('new_node', 'ip')
+        mock_execute_command.return_value = (1, '', 'error')
+
+        job.runJob("DB", nodepool)
+
+        nodepool.deleteNode.assert_called_once_with('new_node')
+        mock_update.assert_called_with("DB", node_id=0)
+        self.assertFalse(
+            mock.call("DB", state=constants.RUNNING) in mock_update.mock_calls)
+
+    @mock.patch.object(utils, 'execute_command')
+    def test_bootstrap_sends_environment_once(self, mock_execute_command):
+        job = Job(change_num="change_num", project_name="project",
+                  change_ref='CHANGE')
+        mock_execute_command.return_value = (0, 'OSCI-BOOTSTRAP-READY 42\n', '')
+
+        self.assertTrue(job.bootstrap('ip'))
+
+        args, kwargs = mock_execute_command.call_args
+        self.assertTrue(args[0].endswith('jenkins@ip bash -s'))
+        self.assertTrue('ZUUL_REF=CHANGE' in kwargs['stdin_data'])
+        self.assertTrue('run_tests.sh' in kwargs['stdin_data'])
 
 class TestRunning(unittest.TestCase):
     def test_isRunning_no_ip(self):
@@ -187,6 +384,83 @@ class TestRunning(unittest.TestCase):
         self.assertEqual(0, mock_update.call_count)
 
 
+    @mock.patch.object(Job, 'update')
+    @mock.patch.object(utils, 'execute_command')
+    def test_isRunning_uses_probed_status(self, mock_execute_command, mock_update):
+        job = Job(change_num="change_num", project_name="project")
+        job.node_ip = 'ip'
+        job.updated = datetime.datetime.now() - datetime.timedelta(seconds=350)
+
+        self.assertFalse(job.isRunning("DB", False))
+        self.assertTrue(job.isRunning("DB", True))
+        self.assertEqual(0, mock_execute_command.call_count)
+
+    @mock.patch.object(utils, 'execute_commands')
+    def test_probeAllRunning(self, mock_execute_commands):
+        mock_execute_commands.return_value = [True, False]
+
+        self.assertEquals([True, False], Job.probeAllRunning(['ip1', 'ip2']))
+        commands = mock_execute_commands.call_args[0][0]
+        self.assertEquals(2, len(commands))
+        self.assertTrue('jenkins@ip2' in commands[1])
+        self.assertEquals(
+            dict(silent=True, timeout=Configuration().get_int('PROBE_TIMEOUT')),
+            mock_execute_commands.call_args[1])
+
+    @mock.patch.object(Job, 'update')
+    def test_isRunning_probe_timeout_keeps_running(self, mock_update):
+        job = Job(change_num="change_num", project_name="project")
+        job.node_ip = 'ip'
+        job.updated = datetime.datetime.now() - datetime.timedelta(seconds=350)
+
+        self.assertTrue(job.isRunning("DB", utils.CommandTimeout()))
+        self.assertEqual(0, mock_update.call_count)
+
+    @mock.patch.object(Job, 'update')
+    def test_isRunning_probe_exception(self, mock_update):
+        job = Job(change_num="change_num", project_name="project")
+        job.node_ip = 'ip'
+        job.updated = datetime.datetime.now() - datetime.timedelta(seconds=350)
+
+        self.assertFalse(job.isRunning("DB", Exception('SSH error')))
+        mock_update.assert_called_with("DB", result='Aborted: Exception checking for pid')
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    def test_runner_reports_completion(self, mock_conf_file):
+        mock_conf_file.return_value = (
+            'COMPLETION_URL=http://osci:8777/\nCOMPLETION_SECRET=secret')
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        job = Job(change_num="change_num", project_name="project")
+        job.id = 12
+
+        env = job.runnerEnvironment()
+
+        self.assertEquals(
+            'curl -s -m 30 -X POST http://osci:8777/done/12/%s || true' %
+            job.completionToken(), env[-1])
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    def test_no_completion_url_without_secret(self, mock_conf_file):
+        mock_conf_file.return_value = 'COMPLETION_URL=http://osci:8777/'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        job = Job(change_num="change_num", project_name="project")
+        job.id = 12
+
+        self.assertEquals(None, job.completionURL())
+
+    def test_needs_liveness_probe(self):
+        job = Job(change_num="change_num", project_name="project")
+        job.node_ip = 'ip'
+        job.updated = datetime.datetime.now()
+        self.assertFalse(job.needsLivenessProbe())
+        job.updated = datetime.datetime.now() - datetime.timedelta(seconds=350)
+        self.assertTrue(job.needsLivenessProbe())
+        job.node_ip = None
+        self.assertFalse(job.needsLivenessProbe())
+
+
 class TestRetrieveResults(unittest.TestCase):
     def setUp(self):
         self.job = Job()
@@ -219,12 +493,13 @@ class TestRetrieveResults(unittest.TestCase):
 
         result = self.run_retrieve_results()
 
+        fake_utils.ssh_command.assert_called_once_with(
+            'ip',
+            'jenkins',
+            '/usr/workspace/scratch/openstack/infrastructure.hg/keys/nodepool',
+            'cat result.txt')
         fake_utils.execute_command.assert_called_once_with(
-            'ssh -q -o BatchMode=yes'
-            ' -o UserKnownHostsFile=/dev/null'
-            ' -o StrictHostKeyChecking=no'
-            ' -i /usr/workspace/scratch/openstack/infrastructure.hg/keys/nodepool'
-            ' jenkins@ip cat result.txt',
+            fake_utils.ssh_command.return_value,
             silent=True, return_streams=True)
 
     @mock.patch('osci.job.utils')
@@ -254,6 +529,28 @@ class TestRetrieveResults(unittest.TestCase):
 
         self.assertEquals(constants.COPYFAIL, result)
 
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch('osci.job.utils')
+    def test_log_archives_copied(self, fake_utils, mock_conf_file):
+        mock_conf_file.return_value = 'NODE_LOG_TRANSFER=tar'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        self.job.node_ip = 'ip'
+        fake_utils.execute_command.return_value = (
+            0, 'Reported status\nAnd some\nRubbish', 'err')
+
+        result = self.run_retrieve_results()
+
+        self.assertEquals('Reported status', result)
+        fake_utils.copy_logs_tar.assert_called_once_with(
+            Job.NODE_LOG_MASKS,
+            'ignored',
+            'ip',
+            'jenkins',
+            '/usr/workspace/scratch/openstack/infrastructure.hg/keys/nodepool')
+        self.assertEquals(0, fake_utils.copy_logs.call_count)
+        self.assertEquals(0, fake_utils.copy_dom0_logs.call_count)
+
     @mock.patch('osci.job.utils')
     def test_status_cannot_be_retrieved_old_status_used(self, fake_utils):
         self.job.node_ip = 'ip'
@@ -287,3 +584,95 @@ class TestRetrieveResults(unittest.TestCase):
         result = self.run_retrieve_results()
 
         self.assertEquals(constants.COPYFAIL, result)
+
+
+class TestStreamResults(unittest.TestCase):
+    def setUp(self):
+        self.job = Job()
+        self.job.node_ip = 'ip'
+        self.uploader = mock.Mock()
+
+    @mock.patch('osci.job.ssh_pool')
+    @mock.patch('osci.job.utils')
+    def test_streamed(self, fake_utils, fake_ssh_pool):
+        fake_utils.execute_command.return_value = (0, 'Passed\n', '')
+        self.uploader.upload_streams.return_value = 'url'
+
+        self.assertEquals(('Passed', 'url'),
+                          self.job.streamResults(self.uploader, 'prefix'))
+        fake_ssh_pool.get_pool.return_value.release.assert_called_once_with(
+            fake_utils.getSSHObject.return_value)
+
+    @mock.patch('osci.job.utils')
+    def test_unreadable_result_is_copyfail(self, fake_utils):
+        fake_utils.execute_command.side_effect = Exception('ssh failed')
+
+        self.assertEquals((constants.COPYFAIL, None),
+                          self.job.streamResults(self.uploader, 'prefix'))
+        self.assertEquals(0, self.uploader.upload_streams.call_count)
+
+    @mock.patch('osci.job.ssh_pool')
+    @mock.patch('osci.job.utils')
+    def test_upload_failure_propagates(self, fake_utils, fake_ssh_pool):
+        fake_utils.execute_command.return_value = (0, 'Passed\n', '')
+        self.uploader.upload_streams.side_effect = Exception('swift failed')
+
+        self.assertRaises(Exception, self.job.streamResults, self.uploader,
+                          'prefix')
+        fake_ssh_pool.get_pool.return_value.release.assert_called_once_with(
+            fake_utils.getSSHObject.return_value)
+
+    @mock.patch('osci.job.ssh_pool')
+    @mock.patch('osci.job.utils')
+    def test_empty_result_is_copyfail(self, fake_utils, fake_ssh_pool):
+        fake_utils.execute_command.return_value = (0, '', '')
+
+        self.assertEquals((constants.COPYFAIL, None),
+                          self.job.streamResults(self.uploader, 'prefix'))
+        self.assertEquals(0, self.uploader.upload_streams.call_count)
+
+    @mock.patch('osci.job.ssh_pool')
+    @mock.patch('osci.job.utils')
+    def test_sftp_failure_is_copyfail(self, fake_utils, fake_ssh_pool):
+        fake_utils.execute_command.return_value = (0, 'Passed\n', '')
+        ssh = fake_utils.getSSHObject.return_value
+        ssh.open_sftp.side_effect = Exception('sftp failed')
+
+        self.assertEquals((constants.COPYFAIL, None),
+                          self.job.streamResults(self.uploader, 'prefix'))
+        fake_ssh_pool.get_pool.return_value.release.assert_called_once_with(
+            ssh)
+
+    @mock.patch('osci.job.ssh_pool')
+    @mock.patch('osci.job.utils')
+    def test_unreadable_logs_are_copyfail(self, fake_utils, fake_ssh_pool):
+        fake_utils.execute_command.return_value = (0, 'Passed\n', '')
+        self.uploader.upload_streams.side_effect = storage.SourceError()
+
+        self.assertEquals((constants.COPYFAIL, None),
+                          self.job.streamResults(self.uploader, 'prefix'))
+        fake_ssh_pool.get_pool.return_value.release.assert_called_once_with(
+            fake_utils.getSSHObject.return_value)
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch('osci.utils.stream_dom0_logs')
+    @mock.patch('osci.utils.stream_node_logs')
+    @mock.patch('osci.utils.execute_command')
+    def test_dead_node_in_tar_mode_is_copyfail(self, mock_execute,
+                                               mock_node_logs,
+                                               mock_dom0_logs,
+                                               mock_conf_file):
+        mock_conf_file.return_value = 'NODE_LOG_TRANSFER=tar'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        mock_execute.return_value = (0, 'Passed\n', '')
+        # The node went away after writing its result; ssh exits 255
+        mock_node_logs.return_value = utils.stream_tar(
+            ['sh', '-c', 'exit 255'], 'none')
+        mock_dom0_logs.return_value = iter([])
+
+        self.assertEquals(
+            (constants.COPYFAIL, None),
+            self.job.streamResults(storage.LocalStorage(root), 'prefix'))
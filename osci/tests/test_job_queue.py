@@ -2,6 +2,9 @@ import unittest
 import logging
 import mock
 import Queue
+import StringIO
+import threading
+import datetime
 
 from osci import db
 from osci import job_queue
@@ -10,11 +13,21 @@ from osci import filesystem_services
 from osci import utils
 from osci import swift_upload
 from osci import constants
+from osci.config import Configuration
 
 
 class FakeNodePool(object):
     def __init__(self):
         self.node_ids = []
+        self.ready = []
+        self.released = []
+
+    def getNodes(self, count):
+        claimed, self.ready = self.ready[:count], self.ready[count:]
+        return claimed
+
+    def releaseNode(self, node_id):
+        self.released.append(node_id)
 
     def deleteNode(self, node_id):
         assert node_id in self.node_ids, "node %s does not exist" % node_id
@@ -56,6 +69,12 @@ class TestInit(unittest.TestCase, QueueHelpers):
         test, = job.Job.getAllWhere(q.db)
         self.assertTrue(test.queued)
 
+    def test_add_test_wakes_scheduler(self):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit')
+
+        self.assertTrue(q.scheduler.channel.wait(0))
+
     def test_add_test_if_job_already_exists(self):
         q = self._make_queue()
         q.addJob('refs/changes/61/65261/7', 'project', 'commit')
@@ -95,6 +114,70 @@ class TestInit(unittest.TestCase, QueueHelpers):
         q = self._make_queue()
         self.assertEquals(0, len(q.get_queued_enabled_jobs()))
 
+    @mock.patch.object(job.Job, 'runJob')
+    def test_trigger_jobs_runs_each_queued_job(self, mock_run_job):
+        q = self._make_queue()
+        q.nodepool.ready = [(1, 'ip1'), (2, 'ip2')]
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        q.addJob('refs/changes/61/65262/7', 'project', 'commit2')
+
+        q.triggerJobs()
+
+        self.assertEquals(2, mock_run_job.call_count)
+        self.assertEquals(
+            [mock.call(q.db, q.nodepool, (1, 'ip1')),
+             mock.call(q.db, q.nodepool, (2, 'ip2'))],
+            sorted(mock_run_job.call_args_list))
+
+    @mock.patch.object(job.Job, 'runJob')
+    def test_trigger_jobs_waits_for_nodes(self, mock_run_job):
+        q = self._make_queue()
+        q.nodepool.ready = [(1, 'ip1')]
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        q.addJob('refs/changes/61/65262/7', 'project', 'commit2')
+
+        q.triggerJobs()
+
+        mock_run_job.assert_called_once_with(q.db, q.nodepool, (1, 'ip1'))
+
+    @mock.patch.object(job.Job, 'runJob')
+    def test_trigger_jobs_cleans_up_old_node_without_new_one(self, mock_run_job):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        with q.db.get_session() as session:
+            j, = session.query(job.Job).all()
+            j.node_id = 5
+
+        q.triggerJobs()
+
+        mock_run_job.assert_called_once_with(q.db, q.nodepool, None)
+
+    @mock.patch.object(job.Job, 'runJob')
+    def test_trigger_jobs_isolates_failures(self, mock_run_job):
+        q = self._make_queue()
+        q.nodepool.ready = [(1, 'ip1'), (2, 'ip2')]
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        q.addJob('refs/changes/61/65262/7', 'project', 'commit2')
+        mock_run_job.side_effect = Exception('node broken')
+
+        q.triggerJobs()
+
+        self.assertEquals(2, mock_run_job.call_count)
+
+    @mock.patch.object(job.Job, 'runJob')
+    def test_dispatch_skips_jobs_no_longer_queued(self, mock_run_job):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        with q.db.get_session() as session:
+            j, = session.query(job.Job).all()
+            j.state = constants.OBSOLETE
+            job_id = j.id
+
+        q.dispatchJob(job_id, (3, 'ip3'))
+
+        self.assertEquals(0, mock_run_job.call_count)
+        self.assertEquals([3], q.nodepool.released)
+
     def test_delete_thread_obsolete(self):
         q = self._make_queue()
         q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
@@ -116,6 +199,84 @@ class TestInit(unittest.TestCase, QueueHelpers):
         self.assertEquals(len(jobs), 1)
         self.assertEquals(2, jobs[0].node_id)
 
+        tasks = dnt.deleteNodes()
+        for task in tasks:
+            self.assertTrue(task.wait(10))
+        self.assertEquals([1], q.nodepool.node_ids)
+        self.assertEquals([], dnt.get_jobs())
+
+
+    def test_delete_thread_uploading(self):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        with q.db.get_session() as session:
+            j, = session.query(job.Job).all()
+            j.state = constants.UPLOADING
+            j.node_id = 3
+
+        jobs = job_queue.DeleteNodeThread(q).get_jobs()
+        self.assertEquals([3], [j.node_id for j in jobs])
+
+
+class TestValidateNodesThread(unittest.TestCase, QueueHelpers):
+    def _make_thread(self, ready, validated=()):
+        q = self._make_queue()
+        q.nodepool = mock.Mock()
+        q.nodepool.getReadyNodes.return_value = ready
+        q.nodepool.isValidated.side_effect = lambda node_id: node_id in validated
+        q.nodepool.claimNode.return_value = True
+        return job_queue.ValidateNodesThread(q)
+
+    @mock.patch('osci.utils.validate_nodes')
+    def test_bad_nodes_deleted(self, mock_validate):
+        vnt = self._make_thread([(1, 'ip1'), (2, 'ip2')])
+        mock_validate.return_value = [(True, 0.5), (False, 30)]
+
+        self.assertEquals([2], vnt.validate())
+
+        vnt.pool.forgetValidations.assert_called_once_with([1, 2])
+        vnt.pool.markValidated.assert_called_once_with(1, 0.5)
+        vnt.pool.claimNode.assert_called_once_with(2)
+        vnt.pool.deleteNode.assert_called_once_with(2)
+
+    @mock.patch('osci.utils.validate_nodes')
+    def test_timed_out_node_kept(self, mock_validate):
+        vnt = self._make_thread([(1, 'ip1')])
+        mock_validate.return_value = [(None, 30)]
+
+        self.assertEquals([], vnt.validate())
+
+        self.assertEquals(0, vnt.pool.markValidated.call_count)
+        self.assertEquals(0, vnt.pool.claimNode.call_count)
+        self.assertEquals(0, vnt.pool.deleteNode.call_count)
+
+    @mock.patch('osci.utils.validate_nodes')
+    def test_only_enough_nodes_checked(self, mock_validate):
+        ready = [(i, 'ip%d' % i) for i in range(10)]
+        vnt = self._make_thread(ready, validated=(0, 1))
+        mock_validate.return_value = [(True, 0.5)] * 2
+
+        vnt.validate()
+
+        ips = mock_validate.call_args[0][0]
+        self.assertEquals(['ip2', 'ip3'], ips)
+
+    @mock.patch('osci.utils.validate_nodes')
+    def test_allocated_node_not_deleted(self, mock_validate):
+        vnt = self._make_thread([(1, 'ip1')])
+        vnt.pool.claimNode.return_value = False
+        mock_validate.return_value = [(False, 30)]
+
+        self.assertEquals([], vnt.validate())
+        self.assertEquals(0, vnt.pool.deleteNode.call_count)
+
+    @mock.patch('osci.utils.validate_nodes')
+    def test_nothing_to_check(self, mock_validate):
+        vnt = self._make_thread([(1, 'ip1')], validated=(1,))
+
+        self.assertEquals([], vnt.validate())
+        self.assertEquals(0, mock_validate.call_count)
+
 
 class TestUploadResults(unittest.TestCase, QueueHelpers):
     def test_job_has_no_results(self):
@@ -133,6 +294,7 @@ class TestUploadResults(unittest.TestCase, QueueHelpers):
         q.executor = mock.Mock(spec=utils.execute_command)
         q.executor.return_value = ("code", "fail_stdout", "fail_stderr")
         q.uploader = mock.Mock(spec=swift_upload.SwiftUploader)
+        q.uploader.upload.return_value = 'http://logs/1/2/3'
         q.nodepool.node_ids = [12]
 
         t = job.Job()
@@ -156,6 +318,333 @@ class TestUploadResults(unittest.TestCase, QueueHelpers):
         )
 
 
+class TestProcessResults(unittest.TestCase, QueueHelpers):
+    def _add_running_job(self, q, ref, node_ip, age):
+        q.addJob(ref, 'project', 'commit')
+        with q.db.get_session() as session:
+            j = session.query(job.Job).filter_by(change_ref=ref).one()
+            j.state = constants.RUNNING
+            j.node_ip = node_ip
+            j.updated = datetime.datetime.now() - datetime.timedelta(seconds=age)
+
+    def test_running_jobs_probed_in_bulk(self):
+        q = self._make_queue()
+        self._add_running_job(q, 'refs/changes/61/65261/7', 'ip1', 400)
+        self._add_running_job(q, 'refs/changes/61/65262/7', 'ip2', 400)
+        self._add_running_job(q, 'refs/changes/61/65263/7', 'ip3', 10)
+        q.prober = mock.Mock()
+        q.prober.probe.side_effect = lambda targets: dict(
+            (job_id, ip == 'ip1') for job_id, ip in targets.items())
+
+        q.processResults()
+
+        targets, = q.prober.probe.call_args[0]
+        self.assertEquals(['ip1', 'ip2'], sorted(targets.values()))
+        states = dict((j.node_ip, j.state) for j in job.Job.getAllWhere(q.db))
+        self.assertEquals({'ip1': constants.RUNNING,
+                           'ip2': constants.COLLECTING,
+                           'ip3': constants.RUNNING}, states)
+
+    def test_probes_skipped_while_completion_is_pushed(self):
+        q = self._make_queue()
+        self._add_running_job(q, 'refs/changes/61/65261/7', 'ip1', 400)
+        q.completionListener = mock.Mock()
+        q.prober = mock.Mock()
+        q.prober.probe.return_value = {}
+
+        q.processResults()
+        q.processResults()
+
+        first_targets = q.prober.probe.call_args_list[0][0][0]
+        second_targets = q.prober.probe.call_args_list[1][0][0]
+        self.assertEquals(['ip1'], first_targets.values())
+        self.assertEquals({}, second_targets)
+
+
+class TestMarkCompleted(unittest.TestCase, QueueHelpers):
+    def setUp(self):
+        patcher = mock.patch.object(Configuration, '_conf_file_contents')
+        patcher.start().return_value = 'COMPLETION_SECRET=secret'
+        self.addCleanup(patcher.stop)
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+
+    def _add_running_job(self, q):
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit')
+        with q.db.get_session() as session:
+            j, = session.query(job.Job).all()
+            j.state = constants.RUNNING
+        j, = job.Job.getAllWhere(q.db)
+        return j
+
+    def test_completion_moves_job_to_collecting(self):
+        q = self._make_queue()
+        j = self._add_running_job(q)
+
+        self.assertTrue(q.markCompleted(j.id, j.completionToken()))
+
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEquals(constants.COLLECTING, j.state)
+
+    def test_bad_token_rejected(self):
+        q = self._make_queue()
+        j = self._add_running_job(q)
+
+        self.assertFalse(q.markCompleted(j.id, 'bad'))
+
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEquals(constants.RUNNING, j.state)
+
+    def test_unknown_job_rejected(self):
+        q = self._make_queue()
+        self.assertFalse(q.markCompleted(1234, 'token'))
+
+    def test_rejected_without_secret(self):
+        q = self._make_queue()
+        j = self._add_running_job(q)
+        token = j.completionToken()
+        Configuration._conf_file_contents.return_value = ''
+        Configuration().reread()
+
+        self.assertFalse(q.markCompleted(j.id, token))
+
+    @mock.patch('osci.job_queue.CompletionListener')
+    def test_listener_refused_without_secret(self, mock_listener):
+        Configuration._conf_file_contents.return_value = 'COMPLETION_PORT=8777'
+        Configuration().reread()
+        q = self._make_queue()
+
+        self.assertRaises(Exception, q.startCleanupThreads)
+        self.assertEquals(0, mock_listener.call_count)
+        self.assertEquals(None, q.collectResultsThread)
+
+
+class TestCollectResultsThread(unittest.TestCase, QueueHelpers):
+    def _make_collecting_job(self, q):
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit')
+        with q.db.get_session() as session:
+            j, = session.query(job.Job).all()
+            j.state = constants.COLLECTING
+        j, = job.Job.getAllWhere(q.db)
+        return j
+
+    @mock.patch.object(job.Job, 'retrieveResults')
+    def test_job_collected_through_pipeline(self, mock_retrieve):
+        mock_retrieve.return_value = 'Passed'
+        q = self._make_queue()
+        q.executor = mock.Mock(spec=utils.execute_command)
+        q.executor.return_value = (0, "fail_stdout", "fail_stderr")
+        q.uploader = mock.Mock(spec=swift_upload.SwiftUploader)
+        q.uploader.upload.return_value = 'url'
+        collected = threading.Event()
+        crt = job_queue.CollectResultsThread(q)
+        crt.pipeline.finish = lambda ctx: (crt.finish(ctx), collected.set())
+        j = self._make_collecting_job(q)
+
+        self.assertTrue(crt.submit(j))
+
+        self.assertTrue(collected.wait(10))
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEquals(constants.COLLECTED, j.state)
+        self.assertEquals('Passed', j.result)
+        self.assertEquals('url', j.logs_url)
+        self.assertEquals({}, q.filesystem.contents)
+        self.assertEquals(set(), crt.inFlight)
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch.object(job.Job, 'streamResults')
+    def test_job_streamed_without_local_copy(self, mock_stream,
+                                             mock_conf_file):
+        mock_conf_file.return_value = 'COLLECT_STREAMING=True'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        def stream(uploader, cf_prefix, watch):
+            entries = watch([('run_tests.log', 10,
+                              lambda: StringIO.StringIO('a ... FAIL\n'))])
+            for _, _, opener in entries:
+                opener().read()
+            return 'Failed', 'url/%s' % cf_prefix
+        mock_stream.side_effect = stream
+        q = self._make_queue()
+        collected = threading.Event()
+        crt = job_queue.CollectResultsThread(q)
+        crt.pipeline.finish = lambda ctx: (crt.finish(ctx), collected.set())
+        j = self._make_collecting_job(q)
+
+        self.assertEquals(['stream', 'update'],
+                          [stage.name for stage in crt.pipeline.stages])
+        self.assertTrue(crt.submit(j))
+
+        self.assertTrue(collected.wait(10))
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEquals(constants.COLLECTED, j.state)
+        self.assertEquals('Failed', j.result)
+        self.assertEquals('a ... FAIL\n', j.failed)
+        self.assertEquals('url/61/65261/7', j.logs_url)
+        self.assertEquals({}, q.filesystem.contents)
+
+    @mock.patch.object(job.Job, 'retrieveResults')
+    def test_node_freed_before_upload(self, mock_retrieve):
+        mock_retrieve.return_value = 'Passed'
+        q = self._make_queue()
+        q.executor = mock.Mock(spec=utils.execute_command)
+        q.executor.return_value = (0, "fail_stdout", "fail_stderr")
+        q.uploader = mock.Mock(spec=swift_upload.SwiftUploader)
+        states = []
+        def upload(path, prefix):
+            j, = job.Job.getAllWhere(q.db)
+            states.append(j.state)
+            return 'url'
+        q.uploader.upload.side_effect = upload
+        q.deleteNodeThread = mock.Mock()
+        collected = threading.Event()
+        crt = job_queue.CollectResultsThread(q)
+        crt.pipeline.finish = lambda ctx: (crt.finish(ctx), collected.set())
+        j = self._make_collecting_job(q)
+
+        self.assertTrue(crt.submit(j))
+
+        self.assertTrue(collected.wait(10))
+        self.assertEquals([constants.UPLOADING], states)
+        q.deleteNodeThread.wakeup.notify.assert_any_call(
+            'logs for 65261 fetched')
+
+    @mock.patch.object(job.Job, 'retrieveResults')
+    def test_failed_upload_recorded_as_copyfail(self, mock_retrieve):
+        mock_retrieve.return_value = 'Passed'
+        q = self._make_queue()
+        q.executor = mock.Mock(spec=utils.execute_command)
+        q.executor.return_value = (0, "fail_stdout", "fail_stderr")
+        q.uploader = mock.Mock(spec=swift_upload.SwiftUploader)
+        q.uploader.upload.side_effect = Exception('swift down')
+        collected = threading.Event()
+        crt = job_queue.CollectResultsThread(q)
+        crt.pipeline.finish = lambda ctx: (crt.finish(ctx), collected.set())
+        j = self._make_collecting_job(q)
+
+        self.assertTrue(crt.submit(j))
+
+        self.assertTrue(collected.wait(10))
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEquals((constants.COLLECTED, constants.COPYFAIL),
+                          (j.state, j.result))
+        self.assertEquals({}, q.filesystem.contents)
+
+    @mock.patch.object(job.Job, 'retrieveResults')
+    def test_failed_download_retried(self, mock_retrieve):
+        mock_retrieve.side_effect = Exception('node unreachable')
+        q = self._make_queue()
+        collected = threading.Event()
+        crt = job_queue.CollectResultsThread(q)
+        crt.pipeline.finish = lambda ctx: (crt.finish(ctx), collected.set())
+        j = self._make_collecting_job(q)
+
+        self.assertTrue(crt.submit(j))
+
+        self.assertTrue(collected.wait(10))
+        j, = job.Job.getAllWhere(q.db)
+        self.assertEquals(constants.COLLECTING, j.state)
+
+    def test_orphaned_uploads_recovered(self):
+        q = self._make_queue()
+        q.addJob('refs/changes/61/65261/7', 'project', 'commit1')
+        q.addJob('refs/changes/61/65262/7', 'project', 'commit2')
+        with q.db.get_session() as session:
+            for j in session.query(job.Job).all():
+                j.state = constants.UPLOADING
+        orphan, busy = job.Job.getAllWhere(q.db)
+        crt = job_queue.CollectResultsThread(q)
+        crt.inFlight.add(busy.id)
+
+        crt.recoverOrphans()
+
+        orphan, = job.Job.getAllWhere(q.db, id=orphan.id)
+        busy, = job.Job.getAllWhere(q.db, id=busy.id)
+        self.assertEquals((constants.COLLECTED, constants.COPYFAIL),
+                          (orphan.state, orphan.result))
+        self.assertEquals(constants.UPLOADING, busy.state)
+
+    def test_job_in_flight_not_resubmitted(self):
+        q = self._make_queue()
+        crt = job_queue.CollectResultsThread(q)
+        crt.pipeline = mock.Mock()
+        j = self._make_collecting_job(q)
+
+        self.assertTrue(crt.submit(j))
+        self.assertFalse(crt.submit(j))
+        self.assertEquals(1, crt.pipeline.submit.call_count)
+
+
+class TestFailureScanner(unittest.TestCase):
+    def test_failures_found_across_chunks(self):
+        scanner = job_queue.FailureScanner()
+        log = ('test_a ... ok\ntest_b ... FAIL\ntest_c ... ok\n'
+               'test_d ... FAIL')
+        opener = scanner.wrap(lambda: StringIO.StringIO(log))
+
+        reader = opener()
+        while reader.read(5):
+            pass
+        reader.close()
+
+        self.assertEquals('test_b ... FAIL\ntest_d ... FAIL\n',
+                          scanner.output())
+
+    def test_only_run_tests_log_watched(self):
+        scanner = job_queue.FailureScanner()
+        opener = lambda: StringIO.StringIO('x ... FAIL\n')
+        entries = list(scanner.watch([('other.log', 1, opener),
+                                      ('run_tests.log', 1, opener)]))
+
+        for _, _, entry_opener in entries:
+            entry_opener().read()
+
+        self.assertTrue(entries[0][2] is opener)
+        self.assertEquals('x ... FAIL\n', scanner.output())
+
+    def test_retry_rescans_from_start(self):
+        scanner = job_queue.FailureScanner()
+        opener = scanner.wrap(lambda: StringIO.StringIO('x ... FAIL\n'))
+
+        opener().read()
+        opener().read()
+
+        self.assertEquals('x ... FAIL\n', scanner.output())
+
+
+class TestArchiveJobsThread(unittest.TestCase, QueueHelpers):
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    def test_old_finished_jobs_archived(self, mock_conf_file):
+        mock_conf_file.return_value = 'ARCHIVE_AFTER_DAYS=30'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        q = self._make_queue()
+        old = datetime.datetime.now() - datetime.timedelta(days=31)
+        with q.db.get_session() as session:
+            for num, state, node_id in [('1', constants.FINISHED, 0),
+                                        ('2', constants.OBSOLETE, None),
+                                        ('3', constants.FINISHED, 5),
+                                        ('4', constants.RUNNING, 6)]:
+                j = job.Job(change_num=num, project_name='project')
+                j.state = state
+                j.node_id = node_id
+                j.updated = old
+                session.add(j)
+            j = job.Job(change_num='5', project_name='project')
+            j.state = constants.FINISHED
+            session.add(j)
+
+        archiver = job_queue.ArchiveJobsThread(q)
+
+        self.assertEquals(2, archiver.archive())
+        self.assertEquals(
+            ['3', '4', '5'],
+            sorted(j.change_num for j in job.Job.getAllWhere(q.db)))
+        self.assertEquals(
+            ['1', '2', '3', '4', '5'],
+            sorted(j.change_num for j in job.Job.getHistoryWhere(q.db)))
+
+
 class FakeQueue(object):
     def __init__(self):
         self.items = []
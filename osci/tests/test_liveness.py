@@ -0,0 +1,39 @@
+import unittest
+
+from osci import liveness
+
+
+class TestLivenessProber(unittest.TestCase):
+    def test_results_mapped_to_ids(self):
+        prober = liveness.LivenessProber(lambda ip: ip == 'up', 2)
+        self.assertEquals({1: True, 2: False},
+                          prober.probe({1: 'up', 2: 'down'}))
+
+    def test_exception_returned(self):
+        error = Exception('ssh broken')
+
+        def probe(ip):
+            raise error
+
+        prober = liveness.LivenessProber(probe, 2)
+        self.assertEquals({1: error}, prober.probe({1: 'ip'}))
+
+    def test_nothing_to_probe(self):
+        prober = liveness.LivenessProber(lambda ip: True, 2)
+        self.assertEquals({}, prober.probe({}))
+
+    def test_probed_together(self):
+        probe_many = lambda ips: [ip == 'up' for ip in ips]
+        prober = liveness.LivenessProber(None, 2, probe_many)
+        self.assertEquals({1: True, 2: False},
+                          prober.probe({1: 'up', 2: 'down'}))
+
+    def test_failure_of_all_returned(self):
+        error = Exception('ssh broken')
+
+        def probe_many(ips):
+            raise error
+
+        prober = liveness.LivenessProber(None, 2, probe_many)
+        self.assertEquals({1: error, 2: error},
+                          prober.probe({1: 'a', 2: 'b'}))
@@ -36,3 +36,30 @@ class TestNode(unittest.TestCase):
         """).strip().split()
         self.assertEquals(expected, cmds)
 
+
+    def test_get_dom0_logs_at_level(self):
+        n = node.Node()
+
+        cmds = n.command_to_get_dom0_files_as_tgz_to_stdout(
+            'a b*', compression='xz', level=3)
+
+        self.assertEquals(
+            'tar --ignore-failed-read -cf - a b\\* \\| xz -3'.split(),
+            cmds[-9:])
+
+    def test_get_node_logs(self):
+        n = node.Node()
+
+        cmds = n.command_to_get_files_as_tar_to_stdout(
+            'logs/* run_test*', compression='bzip2')
+
+        self.assertEquals(
+            n.command_for_this_node() +
+            'tar --ignore-failed-read --no-recursion -cjf - logs/* run_test*'
+            .split(),
+            cmds)
+
+    def test_get_uncompressed_logs_ignores_level(self):
+        self.assertEquals(
+            'tar --ignore-failed-read -cf - a'.split(),
+            node.tar_to_stdout('a', compression='none', level=9))
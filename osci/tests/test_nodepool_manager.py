@@ -2,6 +2,10 @@ import unittest
 import logging
 import mock
 import Queue
+import threading
+
+import sqlalchemy
+from sqlalchemy import orm
 
 from osci import db
 from osci import job_queue
@@ -23,7 +27,11 @@ class FakeNodePool(nodepool_manager.NodePool):
         self.mock_session.getNodes.side_effect = self.mock_get_nodes
         self.mock_session.getNode.side_effect = self.mock_get_node
         self.nodes = []
-        
+        self.managers_config = None
+        self.managers_lock = threading.Lock()
+        self.validated = {}
+        self.validated_lock = threading.Lock()
+
     def getSession(self):
         mock_ret = mock.Mock()
         mock_ret.__enter__ = mock.Mock(return_value=self.mock_session)
@@ -33,8 +41,16 @@ class FakeNodePool(nodepool_manager.NodePool):
     def mock_get_node(self, node_id):
         return [x for x in self.nodes if x.id == node_id][0]
     
-    def mock_get_nodes(self):
-        return self.nodes
+    def mock_get_nodes(self, image_name=None, state=None):
+        return [x for x in self.nodes
+                if x.image_name == image_name and x.state == state]
+
+    def setState(self, session, node_id, old_state, new_state):
+        node = self.mock_get_node(node_id)
+        if node.state != old_state:
+            return False
+        node.state = new_state
+        return True
 
     def mock_delete(self, session, node):
         self.nodes = [x for x in self.nodes if x != node]
@@ -72,3 +88,183 @@ class TestNodepoolManager(unittest.TestCase):
         self.npm.deleteNode(1)
         self.npm.pool.deleteNode.assert_called_with(self.npm.mock_session, node)
         self.assertEquals(0, len(self.npm.nodes))
+
+    def test_managers_reconfigured_when_config_changes(self):
+        self.npm = FakeNodePool('image')
+        self.npm.addNode(1, 'ip_1', self.npm.nodedb.READY)
+        self.npm.addNode(2, 'ip_2', self.npm.nodedb.READY)
+        self.npm.addNode(3, 'ip_3', self.npm.nodedb.READY)
+        first_config = self.npm.pool.config
+
+        self.npm.deleteNode(1)
+        self.npm.deleteNode(2)
+        self.npm.pool.reconfigureManagers.assert_called_once_with(first_config)
+
+        self.npm.pool.config = mock.Mock()
+        self.npm.deleteNode(3)
+        self.npm.pool.reconfigureManagers.assert_called_with(
+            self.npm.pool.config)
+        self.assertEquals(2, self.npm.pool.reconfigureManagers.call_count)
+
+    def test_get_nodes_batch(self):
+        self.npm = FakeNodePool('image')
+        for i in range(4):
+            self.npm.addNode(i, 'ip_%d' % i, self.npm.nodedb.READY)
+        self.npm.nodes[1].state = self.npm.nodedb.HOLD
+        self.npm.nodes[2].image_name = 'other'
+
+        self.assertEquals([(0, 'ip_0'), (3, 'ip_3')], self.npm.getNodes(3))
+        self.assertEquals([], self.npm.getNodes(1))
+        self.npm.mock_session.getNodes.assert_called_with(
+            image_name='mock_image', state='ready')
+
+    def test_get_nodes_stops_at_count(self):
+        self.npm = FakeNodePool('image')
+        for i in range(3):
+            self.npm.addNode(i, 'ip_%d' % i, self.npm.nodedb.READY)
+
+        self.assertEquals([(0, 'ip_0'), (1, 'ip_1')], self.npm.getNodes(2))
+        self.assertEquals(self.npm.nodedb.READY, self.npm.nodes[2].state)
+
+    def test_get_nodes_skips_node_claimed_elsewhere(self):
+        self.npm = FakeNodePool('image')
+        self.npm.addNode(1, 'ip_1', self.npm.nodedb.READY)
+        self.npm.addNode(2, 'ip_2', self.npm.nodedb.READY)
+        # Another process holds node 1 by the time it is claimed
+        ready_nodes = list(self.npm.nodes)
+        self.npm.mock_session.getNodes.side_effect = lambda **kw: ready_nodes
+        self.npm.nodes[0].state = self.npm.nodedb.HOLD
+
+        self.assertEquals((2, 'ip_2'), self.npm.getNode())
+
+    def test_validated_nodes_allocated_first(self):
+        self.npm = FakeNodePool('image')
+        self.npm.addNode(1, 'ip_1', self.npm.nodedb.READY)
+        self.npm.addNode(2, 'ip_2', self.npm.nodedb.READY)
+        self.npm.markValidated(2, 0.5)
+
+        self.assertEquals((2, 'ip_2'), self.npm.getNode())
+
+    @mock.patch('time.time')
+    def test_validation_expires(self, mock_time):
+        self.npm = FakeNodePool('image')
+        mock_time.return_value = 1000
+        self.npm.markValidated(1, 0.5)
+
+        mock_time.return_value = 1299
+        self.assertTrue(self.npm.isValidated(1))
+        mock_time.return_value = 1300
+        self.assertFalse(self.npm.isValidated(1))
+        self.assertFalse(self.npm.isValidated(2))
+
+    def test_forget_validations(self):
+        self.npm = FakeNodePool('image')
+        self.npm.markValidated(1, 0.5)
+        self.npm.markValidated(2, 0.5)
+
+        self.npm.forgetValidations([2, 3])
+
+        self.assertEquals([2], self.npm.validated.keys())
+
+    def test_get_ready_nodes_does_not_claim(self):
+        self.npm = FakeNodePool('image')
+        self.npm.addNode(1, 'ip_1', self.npm.nodedb.READY)
+        self.npm.addNode(2, 'ip_2', self.npm.nodedb.HOLD)
+
+        self.assertEquals([(1, 'ip_1')], self.npm.getReadyNodes())
+        self.assertEquals(self.npm.nodedb.READY, self.npm.nodes[0].state)
+
+    def test_claim_node(self):
+        self.npm = FakeNodePool('image')
+        self.npm.addNode(1, 'ip_1', self.npm.nodedb.READY)
+
+        self.assertTrue(self.npm.claimNode(1))
+        self.assertFalse(self.npm.claimNode(1))
+
+    def test_release_node(self):
+        self.npm = FakeNodePool('image')
+        self.npm.addNode(1, 'ip_1', self.npm.nodedb.HOLD)
+        self.npm.releaseNode(1)
+        self.assertEquals(self.npm.nodedb.READY, self.npm.nodes[0].state)
+
+
+class TestNodeDeleter(unittest.TestCase):
+    def setUp(self):
+        self.nodepool = mock.Mock()
+        patcher = mock.patch('time.sleep')
+        self.mock_sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deletes_and_reports(self):
+        deleter = nodepool_manager.NodeDeleter(self.nodepool, 2, 3, 5)
+        done = mock.Mock()
+
+        task = deleter.submit(1, done)
+
+        self.assertTrue(task.wait(10))
+        self.nodepool.deleteNode.assert_called_once_with(1)
+        done.assert_called_once_with(1)
+        self.assertEquals(set(), deleter.inFlight())
+
+    def test_node_in_flight_not_submitted_twice(self):
+        release = threading.Event()
+        self.nodepool.deleteNode.side_effect = lambda node_id: release.wait(10)
+        deleter = nodepool_manager.NodeDeleter(self.nodepool, 2, 3, 5)
+
+        task = deleter.submit(1)
+        self.assertEquals(None, deleter.submit(1))
+        self.assertEquals(set([1]), deleter.inFlight())
+        release.set()
+
+        self.assertTrue(task.wait(10))
+        self.assertEquals(1, self.nodepool.deleteNode.call_count)
+
+    def test_retries_with_backoff(self):
+        self.nodepool.deleteNode.side_effect = [Exception('api'),
+                                                Exception('api'), None]
+        deleter = nodepool_manager.NodeDeleter(self.nodepool, 1, 3, 5)
+        done = mock.Mock()
+
+        task = deleter.submit(1, done)
+
+        self.assertTrue(task.wait(10))
+        self.assertEquals(3, self.nodepool.deleteNode.call_count)
+        self.assertEquals([mock.call(5), mock.call(10)],
+                          self.mock_sleep.call_args_list)
+        done.assert_called_once_with(1)
+
+    def test_gives_up_after_attempts(self):
+        self.nodepool.deleteNode.side_effect = Exception('api')
+        deleter = nodepool_manager.NodeDeleter(self.nodepool, 1, 2, 5)
+        done = mock.Mock()
+
+        task = deleter.submit(1, done)
+
+        self.assertTrue(task.wait(10))
+        self.assertTrue(task.exception is not None)
+        self.assertEquals(0, done.call_count)
+        # Free to be tried again on the next pass
+        self.assertEquals(set(), deleter.inFlight())
+
+
+class TestSetState(unittest.TestCase):
+    def setUp(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        metadata = sqlalchemy.MetaData()
+        self.npm = FakeNodePool('image')
+        self.npm.nodedb.node_table = sqlalchemy.Table(
+            'node', metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('state', sqlalchemy.String(16)),
+            sqlalchemy.Column('state_time', sqlalchemy.Integer))
+        metadata.create_all(engine)
+        engine.execute(self.npm.nodedb.node_table.insert(),
+                       [dict(id=1, state='ready', state_time=0)])
+        self.session = mock.Mock()
+        self.session.session.return_value = orm.sessionmaker(bind=engine)()
+
+    def test_claims_once(self):
+        claim = nodepool_manager.NodePool.setState
+        self.assertTrue(claim(self.npm, self.session, 1, 'ready', 'hold'))
+        self.assertFalse(claim(self.npm, self.session, 1, 'ready', 'hold'))
+        self.assertFalse(claim(self.npm, self.session, 2, 'ready', 'hold'))
@@ -0,0 +1,69 @@
+import threading
+import unittest
+
+from osci import pipeline
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+        self.finished = []
+        self.done = threading.Event()
+
+    def stage(self, name, proceed=True, error=None):
+        def func(item):
+            self.calls.append((name, item))
+            if error:
+                raise error
+            return proceed
+        return func
+
+    def finish(self, item):
+        self.finished.append(item)
+        self.done.set()
+
+
+class TestPipeline(unittest.TestCase):
+    def _make_pipeline(self, recorder, *funcs):
+        stages = [pipeline.Stage('stage%d' % i, func, 2)
+                  for i, func in enumerate(funcs)]
+        return pipeline.Pipeline('test', stages, 2, finish=recorder.finish)
+
+    def test_item_passes_through_all_stages(self):
+        rec = Recorder()
+        pipe = self._make_pipeline(rec, rec.stage('a'), rec.stage('b'))
+
+        pipe.submit('item')
+
+        self.assertTrue(rec.done.wait(10))
+        self.assertEquals([('a', 'item'), ('b', 'item')], rec.calls)
+        self.assertEquals(['item'], rec.finished)
+
+    def test_stage_can_stop_item(self):
+        rec = Recorder()
+        pipe = self._make_pipeline(rec, rec.stage('a', proceed=False),
+                                   rec.stage('b'))
+
+        pipe.submit('item')
+
+        self.assertTrue(rec.done.wait(10))
+        self.assertEquals([('a', 'item')], rec.calls)
+        self.assertEquals(['item'], rec.finished)
+
+    def test_failed_stage_finishes_item(self):
+        rec = Recorder()
+        pipe = self._make_pipeline(rec, rec.stage('a', error=Exception()),
+                                   rec.stage('b'))
+
+        pipe.submit('item')
+
+        self.assertTrue(rec.done.wait(10))
+        self.assertEquals([('a', 'item')], rec.calls)
+        self.assertEquals(['item'], rec.finished)
+
+    def test_stage_pools_are_bounded(self):
+        rec = Recorder()
+        pipe = self._make_pipeline(rec, rec.stage('a'), rec.stage('b'))
+
+        self.assertEquals([2, 2], [pool.tasks.maxsize for pool in pipe.pools])
+        self.assertEquals([2, 2], [pool.size for pool in pipe.pools])
@@ -0,0 +1,50 @@
+import unittest
+import mock
+
+from osci import scheduler
+
+
+class TestWakeupChannel(unittest.TestCase):
+    def test_wait_times_out(self):
+        channel = scheduler.WakeupChannel('test')
+        self.assertFalse(channel.wait(0))
+
+    def test_notify_wakes(self):
+        channel = scheduler.WakeupChannel('test')
+        channel.notify('reason')
+        self.assertTrue(channel.wait(10))
+
+    def test_notification_consumed(self):
+        channel = scheduler.WakeupChannel('test')
+        channel.notify('reason')
+        channel.wait(10)
+        self.assertFalse(channel.wait(0))
+
+
+class TestScheduler(unittest.TestCase):
+    def test_steps_run_in_order(self):
+        calls = []
+        sched = scheduler.Scheduler(0)
+        sched.run_once([lambda: calls.append(1), lambda: calls.append(2)])
+        self.assertEquals([1, 2], calls)
+
+    def test_failing_step_does_not_stop_others(self):
+        calls = []
+        failing = mock.Mock(side_effect=Exception('broken'))
+        sched = scheduler.Scheduler(0)
+        sched.run_once([failing, lambda: calls.append(2)])
+        self.assertEquals([2], calls)
+        failing.assert_called_once_with()
+
+    def test_wait_uses_poll_interval(self):
+        channel = mock.Mock()
+        channel.wait.return_value = False
+        sched = scheduler.Scheduler(30, channel)
+        sched.wait()
+        channel.wait.assert_called_once_with(30)
+
+    def test_notify_passed_to_channel(self):
+        channel = mock.Mock()
+        sched = scheduler.Scheduler(30, channel)
+        sched.notify('reason')
+        channel.notify.assert_called_once_with('reason')
@@ -0,0 +1,197 @@
+import mock
+import unittest
+
+from osci import ssh_pool
+
+
+class FakePool(ssh_pool.SSHConnectionPool):
+    def __init__(self, enabled=True):
+        ssh_pool.SSHConnectionPool.__init__(
+            self, enabled, '/control', 60, 300)
+        self.connections = []
+
+    def _connect(self, host, username, key_filename):
+        ssh = mock.Mock()
+        ssh.get_transport.return_value.is_active.return_value = True
+        self.connections.append(ssh)
+        return ssh
+
+
+class TestSSHConnectionPool(unittest.TestCase):
+    def test_client_reused(self):
+        pool = FakePool()
+        ssh1 = pool.get_client('host', 'user', 'key')
+        ssh2 = pool.get_client('host', 'user', 'key')
+        self.assertTrue(ssh1 is ssh2)
+        self.assertEquals(1, len(pool.connections))
+
+    def test_client_per_key(self):
+        pool = FakePool()
+        ssh1 = pool.get_client('host', 'user', 'key')
+        ssh2 = pool.get_client('host', 'other', 'key')
+        self.assertFalse(ssh1 is ssh2)
+
+    def test_dead_client_replaced(self):
+        pool = FakePool()
+        ssh1 = pool.get_client('host', 'user', 'key')
+        ssh1.get_transport.return_value.is_active.return_value = False
+        ssh2 = pool.get_client('host', 'user', 'key')
+        self.assertFalse(ssh1 is ssh2)
+
+    def test_release_keeps_pooled_client_open(self):
+        pool = FakePool()
+        ssh = pool.get_client('host', 'user', 'key')
+        pool.release(ssh)
+        self.assertEquals(0, ssh.close.call_count)
+
+    def test_disabled_pool_closes_on_release(self):
+        pool = FakePool(enabled=False)
+        ssh = pool.get_client('host', 'user', 'key')
+        self.assertFalse(ssh is pool.get_client('host', 'user', 'key'))
+        pool.release(ssh)
+        ssh.close.assert_called_once_with()
+
+    def test_disabled_pool_has_no_options(self):
+        pool = FakePool(enabled=False)
+        self.assertEquals([], pool.ssh_options())
+
+    @mock.patch('osci.ssh_pool.time.time')
+    def test_evict_idle(self, mock_time):
+        pool = FakePool()
+        mock_time.return_value = 1000
+        old = pool.get_client('old', 'user', 'key')
+        pool.release(old)
+        mock_time.return_value = 1200
+        recent = pool.get_client('recent', 'user', 'key')
+        pool.release(recent)
+        mock_time.return_value = 1400
+
+        pool.evict_idle()
+
+        old.close.assert_called_once_with()
+        self.assertEquals(0, recent.close.call_count)
+        self.assertEquals([('recent', 'user', 'key')], pool.clients.keys())
+
+    @mock.patch('osci.ssh_pool.time.time')
+    def test_evict_idle_keeps_client_in_use(self, mock_time):
+        pool = FakePool()
+        mock_time.return_value = 1000
+        ssh = pool.get_client('host', 'user', 'key')
+        mock_time.return_value = 2000
+
+        pool.evict_idle()
+
+        self.assertEquals(0, ssh.close.call_count)
+
+    @mock.patch('osci.ssh_pool.time.time')
+    def test_evict_idle_after_last_release(self, mock_time):
+        pool = FakePool()
+        mock_time.return_value = 1000
+        ssh = pool.get_client('host', 'user', 'key')
+        pool.get_client('host', 'user', 'key')
+        pool.release(ssh)
+        mock_time.return_value = 2000
+
+        pool.evict_idle()
+        self.assertEquals(0, ssh.close.call_count)
+
+        # release refreshes the idle time
+        pool.release(ssh)
+        pool.evict_idle()
+        self.assertEquals(0, ssh.close.call_count)
+
+        mock_time.return_value = 3000
+        pool.evict_idle()
+        ssh.close.assert_called_once_with()
+
+    def test_replaced_client_closed_on_release(self):
+        pool = FakePool()
+        ssh1 = pool.get_client('host', 'user', 'key')
+        ssh1.get_transport.return_value.is_active.return_value = False
+        pool.get_client('host', 'user', 'key')
+
+        pool.release(ssh1)
+
+        ssh1.close.assert_called_once_with()
+
+    @mock.patch('osci.ssh_pool.subprocess')
+    def test_evict_host_stops_master(self, mock_subprocess):
+        pool = FakePool()
+        ssh = pool.get_client('host', 'user', 'key')
+
+        pool.evict_host('host', 'user')
+
+        ssh.close.assert_called_once_with()
+        self.assertEquals({}, pool.clients)
+        args = mock_subprocess.call.call_args[0][0]
+        self.assertEquals(
+            ['ssh', '-o', 'ControlPath=/control/%r@%h:%p', '-O', 'exit',
+             'user@host'], args)
+
+    @mock.patch('osci.ssh_pool.os')
+    def test_options(self, mock_os):
+        mock_os.path.isdir.return_value = True
+        mock_os.path.join.return_value = '/control/path'
+        pool = FakePool()
+        self.assertEquals(
+            ['-o', 'ControlMaster=no', '-o', 'ControlPath=/control/path'],
+            pool.ssh_options())
+
+    @mock.patch('osci.ssh_pool.os.path.isdir')
+    @mock.patch('osci.ssh_pool.subprocess')
+    def test_start_master(self, mock_subprocess, mock_isdir):
+        mock_isdir.return_value = True
+        mock_subprocess.call.return_value = 255
+        mock_subprocess.Popen.return_value.poll.return_value = 0
+        mock_subprocess.Popen.return_value.returncode = 0
+        pool = FakePool()
+
+        pool.start_master('host', 'user', 'key')
+
+        args = mock_subprocess.Popen.call_args[0][0]
+        self.assertEquals(['ssh', '-f', '-N', '-M'], args[:4])
+        self.assertEquals(['-o', 'ControlPersist=60', '-i', 'key',
+                           'user@host'], args[-5:])
+        # Nothing of ours may be left open in the daemonized master
+        kwargs = mock_subprocess.Popen.call_args[1]
+        self.assertTrue(kwargs['stdin'] is kwargs['stdout']
+                        is kwargs['stderr'])
+        self.assertFalse(kwargs['stderr'] is mock_subprocess.PIPE)
+
+    @mock.patch('osci.ssh_pool.subprocess')
+    def test_running_master_kept(self, mock_subprocess):
+        mock_subprocess.call.return_value = 0
+        pool = FakePool()
+
+        pool.start_master('host', 'user', 'key')
+
+        self.assertEquals(
+            ['ssh', '-o', 'ControlPath=/control/%r@%h:%p', '-O', 'check',
+             'user@host'], mock_subprocess.call.call_args[0][0])
+        self.assertEquals(0, mock_subprocess.Popen.call_count)
+
+    @mock.patch('osci.ssh_pool.time')
+    @mock.patch('osci.ssh_pool.os.killpg')
+    @mock.patch('osci.ssh_pool.os.path.isdir')
+    @mock.patch('osci.ssh_pool.subprocess')
+    def test_hung_master_killed(self, mock_subprocess, mock_isdir,
+                                mock_killpg, mock_time):
+        mock_isdir.return_value = True
+        mock_subprocess.call.return_value = 255
+        process = mock_subprocess.Popen.return_value
+        process.poll.return_value = None
+        process.returncode = -9
+        mock_time.time.side_effect = [100, 100, 131, 131]
+        pool = FakePool()
+
+        pool.start_master('host', 'user', 'key')
+
+        mock_killpg.assert_called_once_with(process.pid, 9)
+        process.wait.assert_called_once_with()
+
+    @mock.patch('osci.ssh_pool.subprocess')
+    def test_disabled_pool_starts_no_master(self, mock_subprocess):
+        pool = FakePool(enabled=False)
+        pool.start_master('host', 'user', 'key')
+        self.assertEquals(0, mock_subprocess.call.call_count)
+        self.assertEquals(0, mock_subprocess.Popen.call_count)
@@ -0,0 +1,100 @@
+import datetime
+import mock
+import shutil
+import tempfile
+import unittest
+
+from osci import constants
+from osci import db
+from osci import status
+from osci.job import Job
+
+
+class TestStatusSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local_dir)
+        self.database = db.DB('sqlite://')
+        self.database.create_schema()
+        self.uploader = mock.Mock()
+
+    def _make_snapshot(self, max_age=900):
+        return status.StatusSnapshot(self.database, self.uploader,
+                                     self.local_dir, 'status', 'ci_status',
+                                     max_age)
+
+    def _add_job(self, change_num, state, updated=None):
+        with self.database.get_session() as session:
+            job = Job(change_num=change_num, project_name='project',
+                      change_ref='refs/changes/%s/1' % change_num)
+            job.state = state
+            if updated is not None:
+                job.updated = updated
+            session.add(job)
+
+    def test_first_refresh_uploads_everything(self):
+        self._add_job('1', constants.RUNNING)
+
+        changed = self._make_snapshot().refresh()
+
+        self.assertEquals(['current_queue.txt', 'recent_finished.txt',
+                           'all_failures.txt'], changed)
+        self.uploader.upload_files.assert_called_once_with(
+            self.local_dir, changed, 'ci_status', 'status')
+        with open('%s/current_queue.txt' % self.local_dir) as f:
+            self.assertIn('refs/changes/1/1', f.read())
+
+    def test_unchanged_views_not_rendered(self):
+        self._add_job('1', constants.RUNNING)
+        snapshot = self._make_snapshot()
+        snapshot.refresh()
+        self.uploader.reset_mock()
+
+        self.assertEquals([], snapshot.refresh())
+        self.assertEquals(0, self.uploader.upload_files.call_count)
+
+    def test_only_changed_view_uploaded(self):
+        self._add_job('1', constants.RUNNING)
+        self._make_snapshot().refresh()
+        self.uploader.reset_mock()
+
+        # Outside recent_finished's window, but in current_queue's totals
+        self._add_job('2', constants.FINISHED,
+                      datetime.datetime.now() - datetime.timedelta(days=2))
+        # State is kept on disk, so separate runs are incremental too
+        changed = self._make_snapshot().refresh()
+
+        self.assertEquals(['current_queue.txt'], changed)
+
+    def test_totals_changes_uploaded(self):
+        self._add_job('1', constants.RUNNING)
+        self._make_snapshot().refresh()
+
+        # Not listed in recent_finished, but counted in its totals
+        self._add_job('2', constants.QUEUED)
+        changed = self._make_snapshot().refresh()
+
+        self.assertEquals(['current_queue.txt', 'recent_finished.txt'],
+                          changed)
+
+    def test_failed_upload_retried(self):
+        self._add_job('1', constants.RUNNING)
+        snapshot = self._make_snapshot()
+        self.uploader.upload_files.side_effect = Exception('swift down')
+        self.assertRaises(Exception, snapshot.refresh)
+
+        self.uploader.upload_files.side_effect = None
+        changed = self._make_snapshot().refresh()
+
+        self.assertEquals(['current_queue.txt', 'recent_finished.txt',
+                           'all_failures.txt'], changed)
+        self.assertEquals(['current_queue.txt', 'recent_finished.txt',
+                           'all_failures.txt'], snapshot.refresh())
+
+    def test_identical_render_not_uploaded(self):
+        snapshot = self._make_snapshot(max_age=0)
+        snapshot.refresh()
+        self.uploader.reset_mock()
+
+        # Every view is re-rendered, but nothing in them has changed
+        self.assertEquals([], snapshot.refresh())
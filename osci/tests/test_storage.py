@@ -0,0 +1,230 @@
+import mock
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import zlib
+
+from osci import storage
+from osci import utils
+
+
+class TestUtilities(unittest.TestCase):
+    def test_start_stansa(self):
+        prefix = 'test_prefix'
+        self.assertIn(prefix, storage._html_start_stansa(prefix))
+
+    def test_file_stansa(self):
+        filename = 'test_filename'
+        size = 'test_size'
+        html = storage._html_file_stansa(filename, size)
+        self.assertIn(filename, html)
+        self.assertIn(size, html)
+
+    def test_content_encoding_none(self):
+        self.assertEqual(None, storage.get_content_encoding('filename.txt'))
+        self.assertEqual(None, storage.get_content_encoding('filename'))
+        self.assertEqual(None, storage.get_content_encoding('filename.log'))
+
+    def test_content_encoding_gz(self):
+        self.assertEqual('gzip', storage.get_content_encoding('filename.txt.gz'))
+        self.assertEqual('gzip', storage.get_content_encoding('filename.gz'))
+        self.assertEqual('gzip', storage.get_content_encoding('filename.log.gz'))
+
+    def test_content_type_gz(self):
+        self.assertEqual('text/plain', storage.get_content_type('filename.txt.gz'))
+        self.assertEqual('text/plain', storage.get_content_type('filename.log.gz'))
+        self.assertEqual('text/plain', storage.get_content_type('filename.conf.gz'))
+        self.assertEqual('text/plain', storage.get_content_type('filename.sh.gz'))
+        self.assertEqual('text/html', storage.get_content_type('filename.html.gz'))
+        self.assertEqual(None, storage.get_content_type('filename.dat.gz'))
+
+    def test_content_type(self):
+        self.assertEqual('text/plain', storage.get_content_type('filename.txt'))
+        self.assertEqual('text/plain', storage.get_content_type('filename.log'))
+        self.assertEqual('text/plain', storage.get_content_type('filename.conf'))
+        self.assertEqual('text/plain', storage.get_content_type('filename.sh'))
+        self.assertEqual('text/html', storage.get_content_type('filename.html'))
+        self.assertEqual(None, storage.get_content_type('filename.dat'))
+
+class TestCompression(unittest.TestCase):
+    def test_only_large_text_files_compressed(self):
+        backend = storage.HTTPStorage('http://store', workers=1)
+
+        self.assertTrue(backend.should_compress('run_tests.log', 1 << 20))
+        self.assertFalse(backend.should_compress('small.log', 10))
+        self.assertFalse(backend.should_compress('image.dat', 1 << 20))
+        self.assertFalse(backend.should_compress('already.log.gz', 1 << 20))
+
+    def test_not_compressed_without_content_encoding(self):
+        backend = storage.LocalStorage('/tmp', workers=1)
+
+        self.assertFalse(backend.should_compress('run_tests.log', 1 << 20))
+
+
+class TestLocalStorage(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local_dir)
+        for name in ['a.txt', 'run_tests.log']:
+            with open(os.path.join(self.local_dir, name), 'w') as f:
+                f.write(name)
+
+    def test_upload_copies_files_and_index(self):
+        backend = storage.LocalStorage(self.root, 'http://logs', workers=2)
+
+        url = backend.upload(self.local_dir, '1/2/3', 'CILogs')
+
+        self.assertEqual('http://logs/CILogs/1/2/3/results.html', url)
+        target = os.path.join(self.root, 'CILogs', '1', '2', '3')
+        self.assertEqual(['a.txt', 'results.html', 'run_tests.log'],
+                         sorted(os.listdir(target)))
+        with open(os.path.join(target, 'results.html')) as index:
+            self.assertIn('<a href="run_tests.log">', index.read())
+
+    def test_default_url_is_file(self):
+        backend = storage.LocalStorage(self.root)
+
+        backend.upload_files(self.local_dir, ['a.txt'], 'p', 'status')
+
+        self.assertTrue(os.path.exists(
+            os.path.join(self.root, 'status', 'p', 'a.txt')))
+        self.assertEqual('file://%s/status/p/x' % self.root,
+                         backend.get_url(None, 'status', 'p/x'))
+
+
+class TestUploadStreams(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_streams_written_with_index(self):
+        backend = storage.LocalStorage(self.root, 'http://logs', workers=1)
+        entries = [('z.log', 4, lambda: StringIO.StringIO('last')),
+                   ('run_tests.log', 5, lambda: StringIO.StringIO('tests'))]
+
+        url = backend.upload_streams(entries, 'p', 'c')
+
+        self.assertEqual('http://logs/c/p/results.html', url)
+        with open(os.path.join(self.root, 'c', 'p', 'z.log')) as f:
+            self.assertEqual('last', f.read())
+        with open(os.path.join(self.root, 'c', 'p', 'results.html')) as f:
+            index = f.read()
+        self.assertTrue(index.index('run_tests.log') < index.index('z.log'))
+
+    @mock.patch('osci.storage.time.sleep')
+    def test_stream_reopened_on_retry(self, mock_sleep):
+        backend = storage.LocalStorage(self.root, workers=1)
+        opened = []
+        def opener():
+            opened.append(True)
+            return StringIO.StringIO('data')
+        backend.put_stream = mock.Mock(side_effect=[IOError(), None])
+
+        backend.upload_one_stream('c', 'x.log', 4, opener, 'p/x.log')
+
+        self.assertEqual(2, len(opened))
+
+    @mock.patch('osci.storage.time.sleep')
+    @mock.patch('osci.config.Configuration.get_int')
+    def test_stream_not_replayable(self, mock_get_int, mock_sleep):
+        mock_get_int.return_value = 1
+        backend = storage.LocalStorage(self.root, workers=1)
+        backend.put_stream = mock.Mock(side_effect=IOError())
+        opener = utils.StreamOpener('x.log', StringIO.StringIO('data'))
+
+        self.assertRaises(storage.UploadException, backend.upload_one_stream,
+                          'c', 'x.log', 4, opener, 'p/x.log')
+        self.assertEqual(1, backend.put_stream.call_count)
+
+    @mock.patch('osci.storage.time.sleep')
+    def test_unreadable_stream_not_retried(self, mock_sleep):
+        backend = storage.LocalStorage(self.root, workers=1)
+        source = mock.Mock()
+        source.read.side_effect = EOFError()
+
+        self.assertRaises(storage.SourceError, backend.upload_one_stream,
+                          backend.get_container(), 'x.log', 4,
+                          lambda: source, 'p/x.log')
+        self.assertFalse(mock_sleep.called)
+
+    def test_unopenable_stream_not_retried(self):
+        backend = storage.LocalStorage(self.root, workers=1)
+        opener = mock.Mock(side_effect=IOError())
+
+        self.assertRaises(storage.SourceError, backend.upload_one_stream,
+                          'c', 'x.log', 4, opener, 'p/x.log')
+        self.assertEqual(1, opener.call_count)
+
+
+class TestHTTPStorage(unittest.TestCase):
+    def setUp(self):
+        fd, self.source = tempfile.mkstemp(suffix='.log')
+        os.write(fd, 'contents')
+        os.close(fd)
+        self.addCleanup(os.remove, self.source)
+
+    def _backend(self, etag=''):
+        backend = storage.HTTPStorage('http://store/', workers=1)
+        sent = []
+        def put(url, data, headers, timeout):
+            sent.append((url, ''.join(data), headers))
+            return mock.Mock(headers={'ETag': etag})
+        backend.session = mock.Mock()
+        backend.session.put.side_effect = put
+        return backend, sent
+
+    def test_put_file(self):
+        backend, sent = self._backend()
+
+        backend.put_file(backend.get_container('logs'), self.source, 'p/x.log')
+
+        self.assertEqual([('http://store/logs/p/x.log', 'contents',
+                           {'Content-Type': 'text/plain'})], sent)
+
+    def test_gzipped_file_served_as_gzip(self):
+        backend, sent = self._backend()
+        gzipped = self.source + '.gz'
+        shutil.copy(self.source, gzipped)
+        self.addCleanup(os.remove, gzipped)
+
+        backend.put_file('http://store/logs', gzipped, 'p/x.log.gz')
+
+        self.assertEqual({'Content-Type': 'text/plain',
+                          'Content-Encoding': 'gzip'}, sent[0][2])
+
+    @mock.patch('osci.config.Configuration.get_int')
+    def test_large_log_compressed(self, mock_get_int):
+        mock_get_int.return_value = 1
+        backend, sent = self._backend()
+
+        backend.put_file('http://store/logs', self.source, 'p/x.log')
+
+        url, data, headers = sent[0]
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        self.assertEqual('contents', zlib.decompress(data, 16 + zlib.MAX_WBITS))
+
+    def test_put_file_checks_etag(self):
+        backend, _ = self._backend(etag='"bad"')
+
+        self.assertRaises(storage.UploadException, backend.put_file,
+                          'http://store/logs', self.source, 'p/x.log')
+
+
+class TestGetBackend(unittest.TestCase):
+    def test_local(self):
+        backend = storage.get_backend('local')
+        self.assertTrue(isinstance(backend, storage.LocalStorage))
+        self.assertTrue(backend.parallel_put)
+
+    def test_swift(self):
+        from osci import swift_upload
+        backend = storage.get_backend('swift')
+        self.assertTrue(isinstance(backend, swift_upload.SwiftUploader))
+        self.assertTrue(backend.content_encoding)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, storage.get_backend, 'ftp')
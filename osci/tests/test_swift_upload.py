@@ -1,57 +1,24 @@
+import hashlib
 import mock
+import os
+import tempfile
 import unittest
+import zlib
 import time
 import datetime
 
 from osci import constants
 from osci import utils
+from osci import storage
 from osci import swift_upload
 from osci.config import Configuration
 from osci.db import DB
 from osci import time_services
 
 
-class TestUtilities(unittest.TestCase):
-    def test_start_stansa(self):
-        prefix = 'test_prefix'
-        self.assertIn(prefix, swift_upload._html_start_stansa(prefix))
-
-    def test_file_stansa(self):
-        filename = 'test_filename'
-        size = 'test_size'
-        html = swift_upload._html_file_stansa(filename, size)
-        self.assertIn(filename, html)
-        self.assertIn(size, html)
-
-    def test_content_encoding_none(self):
-        self.assertEqual(None, swift_upload.get_content_encoding('filename.txt'))
-        self.assertEqual(None, swift_upload.get_content_encoding('filename'))
-        self.assertEqual(None, swift_upload.get_content_encoding('filename.log'))
-
-    def test_content_encoding_gz(self):
-        self.assertEqual('gzip', swift_upload.get_content_encoding('filename.txt.gz'))
-        self.assertEqual('gzip', swift_upload.get_content_encoding('filename.gz'))
-        self.assertEqual('gzip', swift_upload.get_content_encoding('filename.log.gz'))
-
-    def test_content_type_gz(self):
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.txt.gz'))
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.log.gz'))
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.conf.gz'))
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.sh.gz'))
-        self.assertEqual('text/html', swift_upload.get_content_type('filename.html.gz'))
-        self.assertEqual(None, swift_upload.get_content_type('filename.dat.gz'))
-
-    def test_content_type(self):
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.txt'))
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.log'))
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.conf'))
-        self.assertEqual('text/plain', swift_upload.get_content_type('filename.sh'))
-        self.assertEqual('text/html', swift_upload.get_content_type('filename.html'))
-        self.assertEqual(None, swift_upload.get_content_type('filename.dat'))
-
 class TestSwiftUploader(unittest.TestCase):
     @mock.patch('osci.swift_upload.pyrax')
-    @mock.patch('osci.swift_upload.os')
+    @mock.patch('osci.storage.os')
     def test_upload_failed_auth(self, mock_os, mock_pyrax):
         class AuthenticationFailed(Exception):
             pass
@@ -60,7 +27,7 @@ class TestSwiftUploader(unittest.TestCase):
         self.assertRaises(AuthenticationFailed, swift_upload.SwiftUploader().upload, 'a', 'b')
 
     @mock.patch('osci.swift_upload.pyrax')
-    @mock.patch('osci.swift_upload.os')
+    @mock.patch('osci.storage.os')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_no_files(self, mock_one_file, mock_os, mock_pyrax):
         mock_os.listdir.return_value=[]
@@ -73,8 +40,8 @@ class TestSwiftUploader(unittest.TestCase):
         self.assertEqual(0, mock_one_file.call_count)
 
     @mock.patch('osci.swift_upload.pyrax')
-    @mock.patch('osci.swift_upload.os.listdir')
-    @mock.patch('osci.swift_upload.os.stat')
+    @mock.patch('osci.storage.os.listdir')
+    @mock.patch('osci.storage.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_ordered(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
         mock_os_listdir.return_value=['b', 'd', 'c', 'a']
@@ -83,7 +50,7 @@ class TestSwiftUploader(unittest.TestCase):
         mock_container = mock.Mock()
         mock_pyrax.cloudfiles.create_container.return_value = mock_container
         mock_container.cdn_uri = 'uri'
-        result = swift_upload.SwiftUploader().upload('localdir', 'prefix')
+        result = swift_upload.SwiftUploader(1).upload('localdir', 'prefix')
         self.assertEqual(result, 'uri/prefix/results.html')
         expected_calls = [mock.call(mock_container, 'localdir/a', 'prefix/a')]
         expected_calls.append(mock.call(mock_container, 'localdir/b', 'prefix/b'))
@@ -92,8 +59,8 @@ class TestSwiftUploader(unittest.TestCase):
         mock_one_file.assert_has_calls(expected_calls)
 
     @mock.patch('osci.swift_upload.pyrax')
-    @mock.patch('osci.swift_upload.os.listdir')
-    @mock.patch('osci.swift_upload.os.stat')
+    @mock.patch('osci.storage.os.listdir')
+    @mock.patch('osci.storage.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_run_tests_first(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
         mock_os_listdir.return_value=['b', 'c', 'run_tests.log', 'a']
@@ -102,7 +69,7 @@ class TestSwiftUploader(unittest.TestCase):
         mock_container = mock.Mock()
         mock_pyrax.cloudfiles.create_container.return_value = mock_container
         mock_container.cdn_uri = 'uri'
-        result = swift_upload.SwiftUploader().upload('localdir', 'prefix')
+        result = swift_upload.SwiftUploader(1).upload('localdir', 'prefix')
         self.assertEqual(result, 'uri/prefix/results.html')
         expected_calls = [mock.call(mock_container, 'localdir/run_tests.log', 'prefix/run_tests.log')]
         expected_calls.append(mock.call(mock_container, 'localdir/a', 'prefix/a'))
@@ -111,8 +78,8 @@ class TestSwiftUploader(unittest.TestCase):
         mock_one_file.assert_has_calls(expected_calls)
 
     @mock.patch('osci.swift_upload.pyrax')
-    @mock.patch('osci.swift_upload.os.listdir')
-    @mock.patch('osci.swift_upload.os.stat')
+    @mock.patch('osci.storage.os.listdir')
+    @mock.patch('osci.storage.os.stat')
     @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
     def test_upload_html(self, mock_one_file, mock_os_stat, mock_os_listdir, mock_pyrax):
         mock_os_listdir.return_value=['b', 'c', 'run_tests.log', 'a.txt']
@@ -132,55 +99,165 @@ class TestSwiftUploader(unittest.TestCase):
         self.assertIn('<a href="run_tests.log">run_tests.log</a>', store_args[1])
         self.assertIn('1024', store_args[1])
 
-    @mock.patch('osci.swift_upload.pyrax')
-    def test_upload_one_happy_path(self, mock_pyrax):
-        mock_pyrax.utils.get_checksum.return_value = 'calc_checksum'
+    def _make_source(self, contents):
+        fd, source = tempfile.mkstemp(suffix='.txt')
+        os.write(fd, contents)
+        os.close(fd)
+        self.addCleanup(os.remove, source)
+        return source
+
+    def _mock_container(self, *etags):
+        uploaded = []
+        def create(data, **kwargs):
+            uploaded.append(''.join(data))
+            return mock.Mock(etag=etags[len(uploaded) - 1])
         mock_container = mock.Mock()
-        source = 'source.txt'
-        target = 'target.txt'
-        mock_obj = mock.Mock()
-        mock_obj.etag = 'calc_checksum'
-        mock_container.upload_file.return_value = mock_obj
-        swift_upload.SwiftUploader().upload_one_file(mock_container,
-                                                     source, target)
-        mock_container.upload_file.assert_called_with('source.txt', 'target.txt',
-                                                      etag='calc_checksum',
-                                                      content_encoding=None,
-                                                      content_type='text/plain')
+        mock_container.create.side_effect = create
+        return mock_container, uploaded
 
-    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.storage.time.sleep')
+    def test_upload_one_happy_path(self, mock_sleep):
+        source = self._make_source('contents')
+        mock_container, uploaded = self._mock_container(
+            hashlib.md5('contents').hexdigest())
+
+        swift_upload.SwiftUploader(1).upload_one_file(mock_container,
+                                                      source, 'target.txt')
+
+        self.assertEqual(['contents'], uploaded)
+        _, kwargs = mock_container.create.call_args
+        self.assertEqual('target.txt', kwargs['obj_name'])
+        self.assertEqual(True, kwargs['chunked'])
+        self.assertEqual(None, kwargs['content_encoding'])
+        self.assertEqual('text/plain', kwargs['content_type'])
+        self.assertEqual(0, mock_sleep.call_count)
+
+    @mock.patch.object(storage.StorageBackend, 'should_compress',
+                       mock.Mock(return_value=False))
+    @mock.patch('osci.storage.time.sleep')
     @mock.patch('osci.config.Configuration.get_int')
-    def test_upload_one_failed(self, mock_get_int, mock_pyrax):
-        mock_pyrax.utils.get_checksum.return_value = 'calc_checksum'
-        mock_container = mock.Mock()
+    def test_upload_one_failed(self, mock_get_int, mock_sleep):
+        mock_get_int.return_value = 2
+        source = self._make_source('contents')
+        mock_container, uploaded = self._mock_container(
+            'bad_checksum', 'bad_checksum', hashlib.md5('contents').hexdigest())
+
+        swift_upload.SwiftUploader(1).upload_one_file(mock_container,
+                                                      source, 'target.txt')
+
+        self.assertEqual(['contents'] * 3, uploaded)
+        # Exponential backoff between attempts
+        mock_sleep.assert_has_calls([mock.call(2), mock.call(4)])
+
+    @mock.patch.object(storage.StorageBackend, 'should_compress',
+                       mock.Mock(return_value=False))
+    @mock.patch('osci.storage.time.sleep')
+    @mock.patch('osci.config.Configuration.get_int')
+    def test_upload_fails(self, mock_get_int, mock_sleep):
+        mock_get_int.return_value = 0
+        source = self._make_source('contents')
+        mock_container, uploaded = self._mock_container('bad_checksum')
+
+        self.assertRaises(storage.UploadException,
+                          swift_upload.SwiftUploader(1).upload_one_file,
+                          mock_container, source, 'target.txt')
+        self.assertEqual(['contents'], uploaded)
+
+    @mock.patch('osci.storage.time.sleep')
+    @mock.patch('osci.config.Configuration.get_int')
+    def test_upload_error_retried(self, mock_get_int, mock_sleep):
         mock_get_int.return_value = 1
-        source = 'source.txt'
-        target = 'target.txt'
-        mock_obj_ok = mock.Mock()
-        mock_obj_ok.etag = 'calc_checksum'
-        mock_obj_fail = mock.Mock()
-        mock_obj_fail.etag = 'bad_checksum'
-        mock_container.upload_file.side_effect = [mock_obj_fail, mock_obj_ok]
-        swift_upload.SwiftUploader().upload_one_file(mock_container,
-                                                     source, target)
-        expected = mock.call('source.txt', 'target.txt', etag='calc_checksum',
-                             content_encoding=None, content_type='text/plain') 
-        mock_container.upload_file.assert_has_calls([expected, expected])
+        source = self._make_source('contents')
+        mock_container = mock.Mock()
+        mock_container.create.side_effect = [
+            Exception('connection reset'),
+            mock.Mock(etag=hashlib.md5('').hexdigest())]
+
+        swift_upload.SwiftUploader(1).upload_one_file(mock_container,
+                                                      source, 'target.txt')
+
+        self.assertEqual(2, mock_container.create.call_count)
 
     @mock.patch('osci.swift_upload.pyrax')
-    @mock.patch('osci.config.Configuration.get_int')
-    def test_upload_fails(self, mock_get_int, mock_pyrax):
-        mock_pyrax.utils.get_checksum.return_value = 'calc_checksum'
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_upload_reports_failed_files(self, mock_one_file, mock_pyrax):
+        mock_one_file.side_effect = [None, storage.UploadException()]
+
+        self.assertRaises(storage.UploadException,
+                          swift_upload.SwiftUploader(1).upload_files,
+                          'localdir', ['a', 'b'], 'prefix')
+        self.assertEqual(2, mock_one_file.call_count)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    @mock.patch('osci.swift_upload.SwiftUploader.upload_one_file')
+    def test_upload_files_only_listed(self, mock_one_file, mock_pyrax):
         mock_container = mock.Mock()
-        mock_get_int.return_value = 0
-        source = 'source.txt'
-        target = 'target.txt'
-        mock_obj_fail = mock.Mock()
-        mock_obj_fail.etag = 'bad_checksum'
-        mock_container.upload_file.return_value = mock_obj_fail
-        self.assertRaises(swift_upload.UploadException,
-                          swift_upload.SwiftUploader().upload_one_file,
-                          mock_container, source, target)
-        expected = mock.call('source.txt', 'target.txt', etag='calc_checksum',
-                             content_encoding=None, content_type='text/plain') 
-        mock_container.upload_file.assert_has_calls([expected])
+        mock_pyrax.cloudfiles.create_container.return_value = mock_container
+
+        swift_upload.SwiftUploader().upload_files('localdir', ['b', 'a'],
+                                                  'prefix', 'status')
+
+        mock_pyrax.cloudfiles.create_container.assert_called_once_with('status')
+        mock_one_file.assert_has_calls(
+            [mock.call(mock_container, 'localdir/b', 'prefix/b'),
+             mock.call(mock_container, 'localdir/a', 'prefix/a')])
+        self.assertEqual(0, mock_container.store_object.call_count)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    def test_session_reused(self, mock_pyrax):
+        mock_pyrax.identity.expires = (datetime.datetime.now() +
+                                       datetime.timedelta(hours=24))
+        uploader = swift_upload.SwiftUploader(1)
+
+        first = uploader.get_container('logs')
+        second = uploader.get_container('logs')
+
+        self.assertTrue(first is second)
+        self.assertEqual(1, mock_pyrax.set_credentials.call_count)
+        self.assertEqual(1, mock_pyrax.cloudfiles.create_container.call_count)
+
+    @mock.patch('osci.swift_upload.pyrax')
+    def test_token_refreshed_before_expiry(self, mock_pyrax):
+        mock_pyrax.identity.expires = (datetime.datetime.now() +
+                                       datetime.timedelta(seconds=60))
+        uploader = swift_upload.SwiftUploader(1)
+
+        uploader.get_container('logs')
+        uploader.get_container('logs')
+
+        self.assertEqual(2, mock_pyrax.set_credentials.call_count)
+        self.assertEqual(2, mock_pyrax.cloudfiles.create_container.call_count)
+
+    def test_cdn_uri_cached(self):
+        container = mock.Mock()
+        container.cdn_uri = 'uri'
+        uploader = swift_upload.SwiftUploader(1)
+
+        self.assertEqual('uri', uploader.get_cdn_uri(container, 'logs'))
+        container.cdn_uri = 'other'
+        self.assertEqual('uri', uploader.get_cdn_uri(container, 'logs'))
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    def test_large_text_file_compressed(self, mock_conf_file):
+        mock_conf_file.return_value = 'COMPRESS_THRESHOLD=16'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        contents = 'line of log\n' * 100
+        source = self._make_source(contents)
+        mock_container = mock.Mock()
+        uploaded = []
+        def create(data, **kwargs):
+            uploaded.append(''.join(data))
+            return mock.Mock(etag=hashlib.md5(uploaded[-1]).hexdigest())
+        mock_container.create.side_effect = create
+
+        swift_upload.SwiftUploader(1).upload_one_file(mock_container,
+                                                      source, 'target.txt')
+
+        _, kwargs = mock_container.create.call_args
+        self.assertEqual('gzip', kwargs['content_encoding'])
+        self.assertEqual('text/plain', kwargs['content_type'])
+        self.assertEqual('target.txt', kwargs['obj_name'])
+        self.assertEqual(contents, zlib.decompress(uploaded[0],
+                                                   16 + zlib.MAX_WBITS))
+        self.assertTrue(len(uploaded[0]) < len(contents))
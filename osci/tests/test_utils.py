@@ -2,9 +2,14 @@ import datetime
 import errno
 import json
 import mock
+import os
+import shutil
+import tempfile
 import unittest
 import time
 import stat
+import StringIO
+import tarfile
 
 from osci import constants
 from osci import utils
@@ -12,6 +17,8 @@ from osci.config import Configuration
 from osci import executor
 from osci import localhost
 from osci import node
+from osci import ssh_pool
+from osci import storage
 
 
 class TestGerrit(unittest.TestCase):
@@ -39,23 +46,46 @@ class TestCopyLogs(unittest.TestCase):
         mock_os_listdir.return_value = ['source_file']
         mock_stat = mock.Mock()
         mock_stat.st_mode = stat.S_IFREG
+        mock_stat.st_size = 10
         mock_os_stat.return_value = mock_stat
         sftp = mock.Mock()
         sftp.listdir.return_value = []
         utils.copy_logs_sftp(sftp, ['source/*'], 'target', 'host', 'username', 'key', upload=True)
         sftp.put.assert_called_with('source/source_file', 'target/source_file')
 
-    @mock.patch('os.listdir')
+    def _attrs(self, *filenames):
+        attrs = []
+        for filename in filenames:
+            attr = mock.Mock()
+            attr.filename = filename
+            attr.st_mode = stat.S_IFREG
+            attr.st_size = 10
+            attrs.append(attr)
+        return attrs
+
+    @mock.patch('shutil.rmtree')
     @mock.patch('osci.utils.mkdir_recursive')
-    def test_download_happy_path(self, mock_mkdir, mock_os_listdir):
-        mock_os_listdir.return_value = []
-        mock_stat = mock.Mock()
-        mock_stat.st_mode = stat.S_IFREG
+    def test_download_happy_path(self, mock_mkdir, mock_rmtree):
         sftp = mock.Mock()
-        sftp.listdir.return_value = ['match1', 'nomatch']
-        sftp.stat.return_value = mock_stat
+        sftp.listdir_attr.return_value = self._attrs('match1', 'nomatch')
         utils.copy_logs_sftp(sftp, ['source/match*'], 'target', 'host', 'username', 'key', upload=False)
         sftp.get.assert_called_with('source/match1', 'target/match1')
+        self.assertEqual(0, sftp.stat.call_count)
+        mock_rmtree.assert_called_with('target', ignore_errors=True)
+
+    @mock.patch('shutil.rmtree')
+    @mock.patch('osci.utils.mkdir_recursive')
+    def test_download_over_several_channels(self, mock_mkdir, mock_rmtree):
+        sftp = mock.Mock()
+        sftp.listdir_attr.return_value = self._attrs('a', 'b', 'c', 'd')
+        extra = mock.Mock()
+        utils.copy_logs_sftp(sftp, ['source/*'], 'target', 'host', 'username', 'key', upload=False,
+                             extra_channels=[extra])
+        copied = sorted(call[0] for call in
+                        sftp.get.call_args_list + extra.get.call_args_list)
+        self.assertEqual([('source/a', 'target/a'), ('source/b', 'target/b'),
+                          ('source/c', 'target/c'), ('source/d', 'target/d')],
+                         copied)
 
     @mock.patch('os.listdir')
     @mock.patch('osci.utils.mkdir_recursive')
@@ -70,15 +100,11 @@ class TestCopyLogs(unittest.TestCase):
         self.assertEqual(0, len(sftp.put.mock_calls))
         self.assertEqual(1, len(mock_os_listdir.mock_calls))
 
-    @mock.patch('os.listdir')
+    @mock.patch('shutil.rmtree')
     @mock.patch('osci.utils.mkdir_recursive')
-    def test_download_error_continues(self, mock_mkdir, mock_os_listdir):
-        mock_os_listdir.return_value = []
-        mock_stat = mock.Mock()
-        mock_stat.st_mode = stat.S_IFREG
+    def test_download_error_continues(self, mock_mkdir, mock_rmtree):
         sftp = mock.Mock()
-        sftp.listdir.return_value = ['match1', 'nomatch', 'match2']
-        sftp.stat.return_value = mock_stat
+        sftp.listdir_attr.return_value = self._attrs('match1', 'nomatch', 'match2')
         sftp.get.side_effect = IOError(errno.EIO, 'Unknown failure')
         utils.copy_logs_sftp(sftp, ['source/match*'], 'target', 'host', 'username', 'key', upload=False)
         sftp.get.assert_has_calls([mock.call('source/match1', 'target/match1'),
@@ -95,16 +121,21 @@ class TestCopyLogs(unittest.TestCase):
         sftp.stat.return_value = mock_stat
         self.assertRaises(IOError, utils.copy_logs_sftp, sftp, ['source/*'], 'target', 'host', 'username', 'key', upload=True)
 
+    @mock.patch('osci.ssh_pool.get_pool')
     @mock.patch('osci.utils.getSSHObject')
     @mock.patch('osci.utils.copy_logs_sftp')
-    def test_copy_logs_closes_sftp(self, mock_copy_logs_sftp, mock_get_ssh):
+    def test_copy_logs_closes_sftp(self, mock_copy_logs_sftp, mock_get_ssh,
+                                   mock_get_pool):
         mock_ssh = mock.Mock()
         mock_sftp = mock.Mock()
         mock_get_ssh.return_value = mock_ssh
         mock_ssh.open_sftp.return_value = mock_sftp
         utils.copy_logs(None, None, None, None, None, None)
-        mock_ssh.close.assert_called_with()
+        mock_get_pool.return_value.release.assert_called_with(mock_ssh)
         mock_sftp.close.assert_called_with()
+        channels = Configuration().get_int('SFTP_CHANNELS')
+        self.assertEqual(channels, mock_ssh.open_sftp.call_count)
+        self.assertEqual(channels, mock_sftp.close.call_count)
 
     def test_mkdir(self):
         target = mock.Mock()
@@ -119,6 +150,93 @@ class TestCopyLogs(unittest.TestCase):
                                        mock.call('/'.join(path_elems))])
 
 
+class TestExecuteCommand(unittest.TestCase):
+    def test_streams_returned(self):
+        self.assertEquals((0, 'hello\n', ''),
+                          utils.execute_command('echo hello', return_streams=True))
+
+    def test_stdin_data(self):
+        self.assertEquals((0, 'data', ''),
+                          utils.execute_command('cat', return_streams=True,
+                                                stdin_data='data'))
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(utils.CommandTimeout,
+                          utils.execute_command, 'sleep 10', timeout=0.2)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_finishes_within_timeout(self):
+        self.assertTrue(utils.execute_command('true', timeout=10))
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    def test_default_timeout(self, mock_conf_file):
+        mock_conf_file.return_value = 'COMMAND_TIMEOUT=1'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+
+        self.assertRaises(utils.CommandTimeout,
+                          utils.execute_command, 'sleep 10')
+
+    def test_commands_run_together(self):
+        start = time.time()
+        results = utils.execute_commands(['sleep 10', 'true', 'false'],
+                                         timeout=0.5)
+
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(isinstance(results[0], utils.CommandTimeout))
+        self.assertEquals([True, False], results[1:])
+
+
+class TestValidateNodes(unittest.TestCase):
+    @mock.patch('osci.executor.run_many')
+    def test_node_and_dom0_checked(self, mock_run_many):
+        ok = mock.Mock(returncode=0, timed_out=False, elapsed=0.5)
+        failed = mock.Mock(returncode=255, timed_out=False, elapsed=0.2)
+        mock_run_many.return_value = [ok, failed]
+
+        results = utils.validate_nodes(['ip1', 'ip2'], 'user', 'key', 30)
+
+        self.assertEquals([(True, 0.5), (False, 0.2)], results)
+        commands, = mock_run_many.call_args[0]
+        self.assertEquals([30, 30], [command.timeout for command in commands])
+        args = ' '.join(commands[1].args)
+        self.assertTrue('user@ip2' in args)
+        self.assertTrue(args.endswith('root@192.168.33.2 true'))
+
+    @mock.patch('osci.ssh_pool.get_pool')
+    @mock.patch('osci.executor.run_many')
+    def test_check_never_becomes_master(self, mock_run_many, mock_get_pool):
+        mock_get_pool.return_value = ssh_pool.SSHConnectionPool(
+            True, tempfile.gettempdir(), 60, 300)
+        mock_run_many.return_value = [
+            mock.Mock(returncode=0, timed_out=False, elapsed=0.5)]
+
+        utils.validate_nodes(['ip'], 'user', 'key', 30)
+
+        command, = mock_run_many.call_args[0][0]
+        self.assertTrue('ControlMaster=no' in command.args)
+        self.assertFalse('ControlMaster=auto' in command.args)
+
+    @mock.patch('osci.executor.run_many')
+    def test_timeout_is_unknown(self, mock_run_many):
+        mock_run_many.return_value = [
+            mock.Mock(returncode=-9, timed_out=True, elapsed=30)]
+
+        self.assertEquals([(None, 30)],
+                          utils.validate_nodes(['ip'], 'user', 'key', 30))
+
+
+class TestSSHCommand(unittest.TestCase):
+    @mock.patch('osci.ssh_pool.get_pool')
+    def test_ssh_command_uses_pool_options(self, mock_get_pool):
+        mock_get_pool.return_value.ssh_options.return_value = ['-o', 'opt']
+        self.assertEquals(
+            'ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null'
+            ' -o StrictHostKeyChecking=no -o opt -i key user@ip ls -l',
+            utils.ssh_command('ip', 'user', 'key', 'ls -l'))
+
+
 class TestCopyDom0Logs(unittest.TestCase):
     @mock.patch('osci.utils.Executor')
     def test_copying(self, executor_cls):
@@ -140,3 +258,201 @@ class TestCopyDom0Logs(unittest.TestCase):
         self.assertEquals(
             expected_execution.executed_commands,
             xecutor.executed_commands)
+
+
+class TestStreamLogs(unittest.TestCase):
+    def test_matching_regular_files_streamed(self):
+        mock_stat = mock.Mock()
+        mock_stat.st_mode = stat.S_IFREG
+        mock_stat.st_size = 42
+        sftp = mock.Mock()
+        sftp.listdir.return_value = ['match1', 'nomatch']
+        sftp.stat.return_value = mock_stat
+
+        entries = list(utils.stream_logs(sftp, ['source/match*']))
+
+        self.assertEquals([('match1', 42)],
+                          [(name, size) for name, size, _ in entries])
+        remote = entries[0][2]()
+        sftp.open.assert_called_with('source/match1', 'rb')
+        remote.prefetch.assert_called_with()
+
+    def test_missing_directory_skipped(self):
+        sftp = mock.Mock()
+        sftp.listdir.side_effect = IOError(errno.ENOENT, 'missing')
+
+        self.assertEquals([], list(utils.stream_logs(sftp, ['source/*'])))
+
+    def test_listing_failure_is_source_error(self):
+        sftp = mock.Mock()
+        sftp.listdir.side_effect = EOFError()
+
+        self.assertRaises(storage.SourceError, list,
+                          utils.stream_logs(sftp, ['source/*']))
+
+
+class TestStreamDom0Logs(unittest.TestCase):
+    def _tar(self, files, compression='gz'):
+        data = StringIO.StringIO()
+        archive = tarfile.open(fileobj=data, mode='w:' + compression)
+        for name, contents in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            archive.addfile(info, StringIO.StringIO(contents))
+        archive.close()
+        data.seek(0)
+        return data
+
+    def _tgz(self, files):
+        return self._tar(files)
+
+    @mock.patch('osci.utils.subprocess.Popen')
+    def test_members_streamed_flat(self, mock_popen):
+        mock_popen.return_value.stdout = self._tgz(
+            [('var/log/messages', 'dom0 messages'),
+             ('var/log/xensource.log', 'xapi')])
+        mock_popen.return_value.returncode = 0
+
+        streamed = []
+        for name, size, opener in utils.stream_dom0_logs('ip', 'user', 'key'):
+            fileobj = opener()
+            streamed.append((name, size, fileobj.read()))
+            self.assertRaises(storage.UploadException, opener)
+
+        self.assertEquals(
+            [('messages', 13, 'dom0 messages'), ('xensource.log', 4, 'xapi')],
+            streamed)
+        n = node.Node({
+            'node_username': 'user',
+            'node_host': 'ip',
+            'node_keyfile': 'key'})
+        mock_popen.assert_called_once_with(
+            n.command_to_get_dom0_files_as_tgz_to_stdout(utils.DOM0_LOG_FILES),
+            stdout=utils.subprocess.PIPE)
+        mock_popen.return_value.wait.assert_called_once_with()
+
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch('osci.utils.subprocess.Popen')
+    def test_uncompressed_archive(self, mock_popen, mock_conf_file):
+        mock_conf_file.return_value = 'LOG_ARCHIVE_COMPRESSION=none'
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+        mock_popen.return_value.stdout = self._tar(
+            [('var/log/messages', 'dom0 messages')], compression='')
+        mock_popen.return_value.returncode = 0
+
+        entries = list(utils.stream_dom0_logs('ip', 'user', 'key'))
+
+        self.assertEquals([('messages', 13)],
+                          [(name, size) for name, size, _ in entries])
+
+    @mock.patch('osci.utils.subprocess.Popen')
+    def test_decompressed_locally_when_tarfile_cannot(self, mock_popen):
+        ssh = mock.Mock(returncode=0)
+        xz = mock.Mock(returncode=0)
+        xz.stdout = self._tar([('a/log', 'text')], compression='')
+        mock_popen.side_effect = [ssh, xz]
+
+        entries = list(utils.stream_tar(['ssh'], 'xz'))
+
+        self.assertEquals([('log', 4)],
+                          [(name, size) for name, size, _ in entries])
+        mock_popen.assert_called_with(['xz', '-dc'], stdin=ssh.stdout,
+                                      stdout=utils.subprocess.PIPE)
+        ssh.wait.assert_called_once_with()
+        xz.wait.assert_called_once_with()
+
+    def test_dead_node_is_source_error(self):
+        # ssh exits 255 without writing anything when the node is gone
+        entries = utils.stream_tar(['sh', '-c', 'exit 255'], 'none')
+
+        self.assertRaises(storage.SourceError, list, entries)
+
+    def test_failed_archive_after_members_is_source_error(self):
+        process = mock.Mock(returncode=2)
+        process.stdout = self._tar([('a/log', 'text')], compression='')
+
+        with mock.patch('osci.utils.subprocess.Popen',
+                        return_value=process):
+            entries = utils.stream_tar(['ssh'], 'none')
+            self.assertEquals('log', entries.next()[0])
+            self.assertRaises(storage.SourceError, list, entries)
+
+    def test_changed_file_is_not_a_failure(self):
+        process = mock.Mock(returncode=1)
+        process.stdout = self._tar([('a/log', 'text')], compression='')
+
+        with mock.patch('osci.utils.subprocess.Popen',
+                        return_value=process):
+            entries = list(utils.stream_tar(['ssh'], 'none'))
+
+        self.assertEquals(['log'], [name for name, _, _ in entries])
+
+    def test_invalid_compression(self):
+        with mock.patch.object(Configuration, '_conf_file_contents') as conf:
+            conf.return_value = 'LOG_ARCHIVE_COMPRESSION=lzma'
+            Configuration().reread()
+        self.addCleanup(Configuration().reread)
+
+        self.assertRaises(Exception, utils.archive_compression)
+
+
+class TestStreamNodeLogs(unittest.TestCase):
+    @mock.patch.object(Configuration, '_conf_file_contents')
+    @mock.patch('osci.utils.stream_tar')
+    def test_node_archive_command(self, mock_stream_tar, mock_conf_file):
+        mock_conf_file.return_value = (
+            'LOG_ARCHIVE_COMPRESSION=bzip2\nLOG_ARCHIVE_LEVEL=9')
+        Configuration().reread()
+        self.addCleanup(Configuration().reread)
+
+        utils.stream_node_logs('ip', 'user', 'key', ['logs/*', 'run_test*'])
+
+        n = node.Node({
+            'node_username': 'user',
+            'node_host': 'ip',
+            'node_keyfile': 'key'})
+        mock_stream_tar.assert_called_once_with(
+            n.command_to_get_files_as_tar_to_stdout(
+                'logs/* run_test*', 'bzip2', 9),
+            'bzip2')
+
+
+class TestCopyLogsTar(unittest.TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.target, True)
+
+    def _entries(self, files):
+        for name, contents in files:
+            yield name, len(contents), utils.StreamOpener(
+                name, StringIO.StringIO(contents))
+
+    @mock.patch('osci.utils.stream_dom0_logs')
+    @mock.patch('osci.utils.stream_node_logs')
+    def test_both_archives_saved(self, mock_node_logs, mock_dom0_logs):
+        mock_node_logs.return_value = self._entries(
+            [('run_tests.log', 'tests'), ('screen-n-cpu.txt', 'cpu')])
+        mock_dom0_logs.return_value = self._entries([('messages', 'dom0')])
+
+        utils.copy_logs_tar(['logs/*'], self.target, 'ip', 'user', 'key')
+
+        self.assertEquals(['messages', 'run_tests.log', 'screen-n-cpu.txt'],
+                          sorted(os.listdir(self.target)))
+        with open(os.path.join(self.target, 'messages')) as saved:
+            self.assertEquals('dom0', saved.read())
+        mock_node_logs.assert_called_once_with('ip', 'user', 'key',
+                                               ['logs/*'])
+
+    @mock.patch('osci.utils.stream_dom0_logs')
+    @mock.patch('osci.utils.stream_node_logs')
+    def test_failed_archive_raises(self, mock_node_logs, mock_dom0_logs):
+        mock_node_logs.return_value = self._entries([('log', 'text')])
+        def failing():
+            raise IOError('ssh failed')
+            yield
+        mock_dom0_logs.return_value = failing()
+
+        self.assertRaises(IOError, utils.copy_logs_tar, ['logs/*'],
+                          self.target, 'ip', 'user', 'key')
+        self.assertEquals(['log'], os.listdir(self.target))
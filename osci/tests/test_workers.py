@@ -0,0 +1,48 @@
+import threading
+import unittest
+
+from osci import workers
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_map_returns_results_in_order(self):
+        pool = workers.WorkerPool('test', 3)
+        self.assertEquals([2, 4, 6], pool.map(lambda x: x * 2, [1, 2, 3]))
+
+    def test_failure_is_isolated(self):
+        def func(item):
+            if item == 2:
+                raise Exception('broken')
+            return item
+        pool = workers.WorkerPool('test', 2)
+        self.assertEquals([1, None, 3], pool.map(func, [1, 2, 3]))
+
+    def test_task_records_exception(self):
+        def func():
+            raise ValueError('broken')
+        pool = workers.WorkerPool('test', 1)
+        task = pool.submit(func)
+        self.assertTrue(task.wait(10))
+        self.assertTrue(isinstance(task.exception, ValueError))
+
+    def test_pool_size_is_bounded(self):
+        pool = workers.WorkerPool('test', 2)
+        pool.map(lambda x: x, range(10))
+        self.assertEquals(2, len(pool.threads))
+
+    def test_tasks_run_concurrently(self):
+        barrier = threading.Event()
+        started = []
+
+        def func(item):
+            started.append(item)
+            if len(started) == 2:
+                barrier.set()
+            return barrier.wait(10)
+
+        pool = workers.WorkerPool('test', 2)
+        self.assertEquals([True, True], pool.map(func, [1, 2]))
+
+    def test_minimum_size_is_one(self):
+        pool = workers.WorkerPool('test', 0)
+        self.assertEquals(1, pool.size)
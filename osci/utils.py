@@ -7,11 +7,20 @@ from stat import S_ISREG
 import subprocess
 import errno
 import json
+import Queue
+import shutil
+import tarfile
+import threading
+import time
 
 from osci.config import Configuration
+from osci import executor
 from osci.executor import RealExecutor
 from osci import localhost
 from osci import node
+from osci import common_ssh_options
+from osci import ssh_pool
+from osci import storage
 
 
 Executor = RealExecutor
@@ -26,82 +35,337 @@ def mkdir_recursive(target, target_dir):
 
 def copy_logs(source_masks, target_dir, host, username, key_filename, upload=True):
     ssh = getSSHObject(host, username, key_filename)
-    sftp = ssh.open_sftp()
+    sftps = [ssh.open_sftp()]
     try:
-        copy_logs_sftp(sftp, source_masks, target_dir, host, username, key_filename, upload)
+        # Each SFTP channel has its own window, so several of them keep the
+        # link busy while any one waits for a reply
+        for _ in range(Configuration().get_int('SFTP_CHANNELS') - 1):
+            sftps.append(ssh.open_sftp())
+        copy_logs_sftp(sftps[0], source_masks, target_dir, host, username,
+                       key_filename, upload, extra_channels=sftps[1:])
     finally:
-        sftp.close()
-        ssh.close()
+        for sftp in sftps:
+            sftp.close()
+        ssh_pool.get_pool().release(ssh)
 
-def copy_logs_sftp(sftp, source_masks, target_dir, host, username, key_filename, upload):
+def list_matching(source, source_dir, source_glob):
+    if source is os:
+        for filename in source.listdir(source_dir):
+            if fnmatch.fnmatch(filename, source_glob):
+                yield filename, source.stat(os.path.join(source_dir, filename))
+    else:
+        # One round trip for the whole directory instead of one per file
+        for attrs in source.listdir_attr(source_dir):
+            if fnmatch.fnmatch(attrs.filename, source_glob):
+                yield attrs.filename, attrs
+
+def transfer_files(channel_methods, transfers):
+    logger = logging.getLogger('citrix.copy_logs')
+    pending = Queue.Queue()
+    for transfer in transfers:
+        pending.put(transfer)
+    copied = []
+
+    def work(sftp_method):
+        while True:
+            try:
+                source_file, target_file, size = pending.get_nowait()
+            except Queue.Empty:
+                return
+            logger.info('Copying %s to %s', source_file, target_file)
+            try:
+                sftp_method(source_file, target_file)
+                copied.append(size)
+            except IOError, e:
+                logger.exception(e)
+
+    start = time.time()
+    if len(channel_methods) == 1:
+        work(channel_methods[0])
+    else:
+        threads = [threading.Thread(target=work, args=(sftp_method,))
+                   for sftp_method in channel_methods]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = max(time.time() - start, 0.001)
+    megabytes = sum(copied) / (1024.0 * 1024)
+    logger.info('Copied %d files (%.1f MB) in %.1fs (%.2f MB/s)',
+                len(copied), megabytes, elapsed, megabytes / elapsed)
+
+def copy_logs_sftp(sftp, source_masks, target_dir, host, username, key_filename, upload,
+                   extra_channels=()):
     logger = logging.getLogger('citrix.copy_logs')
+    channels = [sftp] + list(extra_channels)
     if upload:
         source = os
         target = sftp
-        sftp_method = sftp.put
+        channel_methods = [channel.put for channel in channels]
     else:
         source = sftp
         target = os
-        sftp_method = sftp.get
+        channel_methods = [channel.get for channel in channels]
 
+    if target is os:
+        shutil.rmtree(target_dir, ignore_errors=True)
     mkdir_recursive(target, target_dir)
 
-    existing_files = target.listdir(target_dir)
-    for filename in existing_files:
-        target.remove(os.path.join(target_dir, filename))
+    if target is not os:
+        existing_files = target.listdir(target_dir)
+        for filename in existing_files:
+            target.remove(os.path.join(target_dir, filename))
 
+    transfers = []
     for source_mask in source_masks:
         try:
             source_dir = os.path.dirname(source_mask)
             source_glob = os.path.basename(source_mask)
-            for filename in source.listdir(source_dir):
-                if not fnmatch.fnmatch(filename, source_glob):
-                    continue
-                source_file = os.path.join(source_dir, filename)
-                if S_ISREG(source.stat(source_file).st_mode):
-                    logger.info('Copying %s to %s', source_file, target_dir)
-                    try:
-                        sftp_method(os.path.join(source_dir, filename),
-                                    os.path.join(target_dir, filename))
-                    except IOError, e:
-                        logger.exception(e)
+            for filename, attrs in list_matching(source, source_dir,
+                                                 source_glob):
+                if S_ISREG(attrs.st_mode):
+                    transfers.append((os.path.join(source_dir, filename),
+                                      os.path.join(target_dir, filename),
+                                      attrs.st_size or 0))
         except IOError, e:
             if e.errno != errno.ENOENT:
                 raise
             logger.exception(e)
             # Ignore this exception to try again on the next directory
 
-def execute_command(command, delimiter=' ', silent=False, return_streams=False):
-    command_as_array = command.split(delimiter)
-    if not silent:
-        logging.debug("Executing command: %s", command_as_array)
-    p = subprocess.Popen(command_as_array, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, errors = p.communicate()
-    if p.returncode != 0:
+    transfer_files(channel_methods, transfers)
+
+class StreamOpener(object):
+    # A pipe can only be read once, so a retried upload must fail rather
+    # than silently send nothing
+    def __init__(self, name, fileobj):
+        self.name = name
+        self.fileobj = fileobj
+
+    def __call__(self):
+        if self.fileobj is None:
+            # Only an upload that failed asks again
+            raise storage.UploadException('%s cannot be read again' %
+                                          self.name)
+        fileobj, self.fileobj = self.fileobj, None
+        return fileobj
+
+def list_stream_files(sftp, source_dir, source_glob):
+    try:
+        files = []
+        for filename in sftp.listdir(source_dir):
+            if not fnmatch.fnmatch(filename, source_glob):
+                continue
+            source_file = os.path.join(source_dir, filename)
+            stats = sftp.stat(source_file)
+            if S_ISREG(stats.st_mode):
+                files.append((filename, source_file, stats.st_size))
+        return files
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise storage.SourceError('Cannot list %s: %s' % (source_dir, e))
+        logging.getLogger('citrix.stream_logs').exception(e)
+        # Ignore this exception to try again on the next directory
+        return []
+    except Exception, e:
+        raise storage.SourceError('Cannot list %s: %s' % (source_dir, e))
+
+def stream_logs(sftp, source_masks):
+    for source_mask in source_masks:
+        for filename, source_file, size in list_stream_files(
+                sftp, os.path.dirname(source_mask),
+                os.path.basename(source_mask)):
+            def opener(source_file=source_file):
+                remote = sftp.open(source_file, 'rb')
+                remote.prefetch()
+                return remote
+            yield filename, size, opener
+
+# Archive compressions tarfile can read itself; others are piped through
+# their compressor locally
+TAR_READ_MODES = {
+    'none': 'r|',
+    'gzip': 'r|gz',
+    'bzip2': 'r|bz2',
+}
+
+def archive_compression():
+    config = Configuration()
+    compression = config.LOG_ARCHIVE_COMPRESSION
+    if compression not in node.COMPRESSIONS:
+        raise Exception('Invalid log archive compression: %s' % compression)
+    level = config.LOG_ARCHIVE_LEVEL
+    return compression, int(level) if level else None
+
+def stream_tar(command, compression='gzip'):
+    processes = [subprocess.Popen(command, stdout=subprocess.PIPE)]
+    mode = TAR_READ_MODES.get(compression)
+    if mode is None:
+        processes.append(subprocess.Popen(
+            [node.COMPRESSIONS[compression][1], '-dc'],
+            stdin=processes[0].stdout, stdout=subprocess.PIPE))
+        mode = 'r|'
+    try:
+        try:
+            # Read the archive as it arrives; members must be consumed in
+            # order
+            archive = tarfile.open(fileobj=processes[-1].stdout, mode=mode)
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name = os.path.basename(member.name)
+                yield name, member.size, StreamOpener(
+                    name, archive.extractfile(member))
+        except (tarfile.TarError, IOError, EOFError), e:
+            raise storage.SourceError('Cannot read archive from %s: %s' %
+                                      (command, e))
+    finally:
+        for process in processes:
+            process.stdout.close()
+        for process in processes:
+            process.wait()
+    # tar exits 1 when a file changed while it was read; anything else,
+    # such as ssh's 255, means the archive is not to be trusted
+    codes = [process.returncode for process in processes]
+    if [code for code in codes if code not in (0, 1)]:
+        raise storage.SourceError('Archive from %s failed with %s' %
+                                  (command, codes))
+
+def stream_dom0_logs(host, user, keyfile):
+    test_node = node.Node(
+        dict(node_username=user, node_host=host, node_keyfile=keyfile))
+    compression, level = archive_compression()
+    return stream_tar(
+        test_node.command_to_get_dom0_files_as_tgz_to_stdout(
+            DOM0_LOG_FILES, compression, level),
+        compression)
+
+def stream_node_logs(host, user, keyfile, source_masks):
+    test_node = node.Node(
+        dict(node_username=user, node_host=host, node_keyfile=keyfile))
+    compression, level = archive_compression()
+    return stream_tar(
+        test_node.command_to_get_files_as_tar_to_stdout(
+            ' '.join(source_masks), compression, level),
+        compression)
+
+def save_streams(entries, target_dir):
+    count = 0
+    total = 0
+    for name, size, opener in entries:
+        with open(os.path.join(target_dir, name), 'wb') as target:
+            shutil.copyfileobj(opener(), target)
+        count += 1
+        total += size
+    return count, total
+
+def copy_logs_tar(source_masks, target_dir, host, username, key_filename):
+    logger = logging.getLogger('citrix.copy_logs')
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.makedirs(target_dir)
+
+    # One archive from the node and one from dom0, fetched side by side
+    archives = [
+        ('node', stream_node_logs(host, username, key_filename, source_masks)),
+        ('dom0', stream_dom0_logs(host, username, key_filename)),
+    ]
+    failures = []
+    def fetch(label, entries):
+        try:
+            start = time.time()
+            count, total = save_streams(entries, target_dir)
+            logger.info('Fetched %d %s files (%.1f MB) from %s in %.1fs',
+                        count, label, total / 1048576.0, host,
+                        time.time() - start)
+        except Exception, e:
+            logger.exception(e)
+            failures.append(e)
+
+    threads = [threading.Thread(target=fetch, args=archive)
+               for archive in archives]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+
+class CommandTimeout(Exception):
+    pass
+
+def _command(command, delimiter, stdin_data, timeout):
+    if timeout is None:
+        # A hung ssh must not hold up its caller forever
+        timeout = Configuration().get_int('COMMAND_TIMEOUT') or None
+    return executor.Command(
+        command.split(delimiter), stdin_data=stdin_data, timeout=timeout,
+        limit=Configuration().get_int('COMMAND_OUTPUT_LIMIT'))
+
+def _command_result(result, silent, return_streams):
+    if result.timed_out:
+        raise CommandTimeout('Command %s timed out after %.1fs' % (
+            result.args, result.elapsed))
+    if result.returncode != 0:
         if not silent:
             logging.error("Error: Could not execute command. "+\
                           "Failed with code %d and errors: %s",
-                          p.returncode, errors)
+                          result.returncode, result.stderr)
     if not silent:
-        logging.debug("Output:%s", output)
+        logging.debug("Output:%s", result.stdout)
 
     if return_streams:
-        return p.returncode, output, errors
-    return p.returncode == 0
+        return result.returncode, result.stdout, result.stderr
+    return result.returncode == 0
+
+def execute_command(command, delimiter=' ', silent=False, return_streams=False,
+                    stdin_data=None, timeout=None):
+    cmd = _command(command, delimiter, stdin_data, timeout)
+    if not silent:
+        logging.debug("Executing command: %s", cmd.args)
+    return _command_result(executor.run_many([cmd])[0], silent,
+                           return_streams)
+
+def execute_commands(commands, delimiter=' ', silent=False,
+                     return_streams=False, timeout=None):
+    # Runs the commands side by side; each result is what execute_command
+    # would return for it, or the CommandTimeout it would raise
+    cmds = [_command(command, delimiter, None, timeout)
+            for command in commands]
+    if not silent:
+        logging.debug("Executing commands: %s", [cmd.args for cmd in cmds])
+    outcomes = []
+    for result in executor.run_many(cmds):
+        try:
+            outcomes.append(_command_result(result, silent, return_streams))
+        except CommandTimeout, e:
+            outcomes.append(e)
+    return outcomes
+
+def validate_nodes(ips, username, key_filename, timeout):
+    # The same checks as CheckConnection: ssh to the node, and from there
+    # to its dom0.  Returns (ok, seconds taken) for each node, where ok is
+    # None when the check timed out and says nothing about the node
+    dom0_check = ' '.join(node.Node().commands_for_dom0() + ['true'])
+    commands = [executor.Command(
+        ssh_command(ip, username, key_filename, dom0_check).split(' '),
+        timeout=timeout) for ip in ips]
+    return [(None if result.timed_out else result.returncode == 0,
+             result.elapsed) for result in executor.run_many(commands)]
+
+def ssh_command(ip, username, key_filename, remote_command):
+    return ' '.join(
+        ['ssh']
+        + common_ssh_options.COMMON_SSH_OPTS
+        + ssh_pool.get_pool().ssh_options()
+        + ['-i', key_filename, '%s@%s' % (username, ip), remote_command])
 
 def testSSH(ip, username, key_filename):
-    return execute_command('ssh -q -o BatchMode=yes -o UserKnownHostsFile=/dev/null '+\
-                                 '-o StrictHostKeyChecking=no -i %s %s@%s /bin/true'%(
-                                     key_filename, username, ip))
+    return execute_command(ssh_command(ip, username, key_filename, '/bin/true'))
 
 def getSSHObject(ip, username, key_filename):
     if ip is None:
         raise Exception('Seriously?  The host must have an IP address')
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-    key = paramiko.RSAKey.from_private_key_file(key_filename)
-    ssh.connect(ip, username=username, pkey=key)
-    return ssh
+    return ssh_pool.get_pool().get_client(ip, username, key_filename)
 
 def vote(commitid, vote_num, message):
     #ssh -p 29418 review.example.com gerrit review -m '"Test failed on MegaTestSystem <http://megatestsystem.org/tests/1234>"'
@@ -145,10 +409,11 @@ def get_patchset_details(change_id, patchset_id):
     return matching_patches[0]
 
 
+DOM0_LOG_FILES = (
+    '/var/log/messages* /var/log/xensource* /opt/nodepool-scripts/*.log'
+)
+
 def copy_dom0_logs(host, user, keyfile, local_directory):
-    dom0_files = (
-        '/var/log/messages* /var/log/xensource* /opt/nodepool-scripts/*.log'
-    )
 
     xecutor = Executor()
     test_node = node.Node(
@@ -156,7 +421,7 @@ def copy_dom0_logs(host, user, keyfile, local_directory):
     this_host = localhost.Localhost()
 
     xecutor.pipe_run(
-        test_node.command_to_get_dom0_files_as_tgz_to_stdout(dom0_files),
+        test_node.command_to_get_dom0_files_as_tgz_to_stdout(DOM0_LOG_FILES),
         this_host.commands_to_extract_stdout_tgz_to(local_directory)
     )
 
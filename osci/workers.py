@@ -0,0 +1,71 @@
+import logging
+import threading
+import Queue
+
+
+class Task(object):
+    log = logging.getLogger('citrix.Task')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            # One failing task must not take the others down with it
+            self.log.error('Task %s%s failed', self.func, self.args)
+            self.log.exception(e)
+            self.exception = e
+        finally:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+
+class WorkerPool(object):
+    log = logging.getLogger('citrix.WorkerPool')
+
+    def __init__(self, name, size, backlog=0):
+        self.name = name
+        self.size = max(1, int(size))
+        # A bounded backlog makes submit block, pushing back on the caller
+        self.tasks = Queue.Queue(backlog)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(
+                    target=self._work,
+                    name='%s-%d' % (self.name, len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            task.run()
+            self.tasks.task_done()
+
+    def submit(self, func, *args):
+        self._start()
+        task = Task(func, args)
+        self.tasks.put(task)
+        return task
+
+    def map(self, func, items):
+        tasks = [self.submit(func, item) for item in items]
+        results = []
+        for task in tasks:
+            task.wait()
+            results.append(task.result)
+        return results
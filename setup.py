@@ -15,6 +15,9 @@ setup(
             'osci-upload = osci.swift_upload:main',
             'osci-create-dbschema = osci.scripts:create_dbschema',
             'osci-view = osci.reports:main',
+            'osci-db-benchmark = osci.db_benchmark:main',
+            'osci-status = osci.status:main',
+            'osci-capacity-controller = osci.capacity:main',
         ]
     }
 )